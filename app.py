@@ -3,6 +3,8 @@ import logging
 import io
 import threading
 import time
+import uuid
+import atexit
 import camera_manager
 import cv2
 import numpy as np
@@ -21,6 +23,18 @@ from workflow_engine import run_workflow
 from report_generated import generate_daily_report
 from report_scheduler import start_scheduler
 from image_processing import process_image_web, detect_edges, pixels_to_mm
+from reference_index import reference_index
+from inspection_pipeline import inspection_pipeline, PipelineBusy
+from inspection_writer import inspection_writer, DuplicateKey
+from valve_catalog import valve_catalog
+from calibration import calibration_store, calibrate_camera
+from master_templates import master_templates, match_frame
+from frame_features import frame_feature_cache, frame_features
+from defect_masks import defect_masks
+from defect_detector import defect_detector
+from defect_classifier import defect_classifier
+from blob_analysis import blob_records, render_blobs
+from valve_regions import valve_regions
 from functools import wraps
 from flask_apscheduler import APScheduler
 from measurement_edge import detect_and_measure_edges, save_inspection
@@ -28,7 +42,8 @@ from inspection_engine import run_inspection
 from camera_manager import (
     start_camera_service,
     stop_camera_service,
-    get_latest_frame,
+    acquire_frame,
+    frame_stats,
     set_exposure as cam_set_exposure,
     set_gain as cam_set_gain,
     set_trigger as cam_set_trigger,
@@ -36,11 +51,14 @@ from camera_manager import (
     capture_frame as camera_capture_frame
 )
 from apscheduler.schedulers.background import BackgroundScheduler
+from config import CAMERA_ACQUISITION
+from latency_trace import latency_recorder
 
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 TRAINED_IMAGES_FOLDER = os.path.join("static", "trained_images")
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'tif', 'jfif'}
 SESSION_TIMEOUT = 2  
+CAPTURE_TIMEOUT = float(os.environ.get("CAPTURE_TIMEOUT", "10"))
 
 last_daily_notification = {"message": None, "timestamp": None}
 accepted_count = 0
@@ -53,6 +71,12 @@ def allowed_file(filename):
 def get_client_ip():
     return request.headers.get("X-Forwarded-For", request.remote_addr)
 
+def get_part_filter() -> Tuple[Optional[str], bool]:
+    data = request.get_json(silent=True) or {}
+    part_number = str(data.get("part_number") or request.values.get("part_number") or "").strip()
+    fallback = str(data.get("fallback", request.values.get("fallback", "true"))).lower()
+    return part_number or None, fallback not in ("0", "false", "no")
+
 def is_ip_allowed(client_ip: Optional[str], allowed_ips: Optional[str]) -> bool:
     if not client_ip or not allowed_ips:
         return False
@@ -80,6 +104,14 @@ def create_app():
         
         os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         os.makedirs(TRAINED_IMAGES_FOLDER, exist_ok=True)
+        reference_index.load()
+        valve_catalog.load()
+        master_templates.preload()
+        defect_masks.load()
+        defect_classifier.load()
+        inspection_pipeline.start()
+        inspection_writer.start()
+        atexit.register(inspection_writer.stop)
 
         app.config["CAMERA_INITIALIZED"] = False
         app.config["CAMERA_STATUS"] = {"software_open": False, "running": False}
@@ -107,26 +139,26 @@ def create_app():
 
         def daily_notification():
             try:
-                conn = db_manager.get_connection()
-                if not conn:
-                    app.logger.warning("No DB connection for daily notification")
-                    return
-
-                cursor = conn.cursor()
-                today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                cursor.execute(
-                    "SELECT COUNT(*) FROM inspections WHERE Result = 'Rejected' AND [timestamp] >= ?",
-                    (today,)
-                )
-                row = cursor.fetchone()
-                rejection_count = row[0] if row else 0
-
-                global last_daily_notification
-                last_daily_notification = {
-                    "message": f"Check Maximum Defects. Please review.",
-                    "timestamp": datetime.now()
-                }
-                app.logger.info("Daily notification triggered")
+                with db_manager.connection() as conn:
+                    if not conn:
+                        app.logger.warning("No DB connection for daily notification")
+                        return
+
+                    cursor = conn.cursor()
+                    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                    cursor.execute(
+                        "SELECT COUNT(*) FROM inspections WHERE Result = 'Rejected' AND [timestamp] >= ?",
+                        (today,)
+                    )
+                    row = cursor.fetchone()
+                    rejection_count = row[0] if row else 0
+
+                    global last_daily_notification
+                    last_daily_notification = {
+                        "message": f"Check Maximum Defects. Please review.",
+                        "timestamp": datetime.now()
+                    }
+                    app.logger.info("Daily notification triggered")
 
             except Exception as e:
                 app.logger.error(f"Daily notification failed: {str(e)}")
@@ -248,12 +280,14 @@ def create_app():
         @app.route("/video_feed")
         def video_feed():
             def generate():
+                last_seq = 0
                 while True:
-                    frame = get_latest_frame()
-                    if frame is None:
-                        time.sleep(0.05)
+                    ref = acquire_frame(after_seq=last_seq, timeout=1.0)
+                    if ref is None:
                         continue
-                    _, buffer = cv2.imencode('.jpg', frame)
+                    with ref:
+                        last_seq = ref.seq
+                        _, buffer = cv2.imencode('.jpg', ref.frame)
                     yield (b'--frame\r\n'
                            b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
             return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
@@ -261,7 +295,7 @@ def create_app():
         @app.route("/start_camera", methods=["POST"])
         def start_camera():
             try:
-                start_camera_service(camera_type="webcam")
+                start_camera_service(camera_type="webcam", acquisition=CAMERA_ACQUISITION)
                 cam_set_exposure(2079953)
                 cam_set_gain(3.7)
                 cam_set_trigger(True)
@@ -283,19 +317,24 @@ def create_app():
         def capture_frame_route():
             try:
                 
-                frame = camera_capture_frame()
-                if frame is None:
-                    return jsonify({"error": "Camera frame not available"}), 500
-                original_name:str = secure_filename(file.filename)
-                base_name,_ = os.path.splitext(original_name)  
-                timestamp_str = datetime.now().strftime("_%S")  
-                filename = f"{timestamp_str}_{base_name}.jpg"
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                cv2.imwrite(filepath, frame)
-                app.logger.info(f"Frame captured and saved: {filename}")
-                result, best_score, result_img_path, best_match, defect_type, part_number, part_name = process_image_web(
-                    frame, filename
+                part_filter, fallback = get_part_filter()
+                data = request.get_json(silent=True) or {}
+                record = None
+                if str(data.get("save", request.values.get("save", ""))).lower() in ("1", "true", "yes"):
+                    record = {
+                        "location": data.get("location") or "Unknown",
+                        "shifts": data.get("shifts") or "Unknown",
+                    }
+
+                trigger = str(data.get("trigger", request.values.get("trigger", ""))).lower() in ("1", "true", "yes")
+                job = inspection_pipeline.submit(
+                    part_number=part_filter, fallback_to_global=fallback, record=record, trigger=trigger
+                )
+                filename = job.filename
+                result, best_score, result_img_path, best_match, defect_type, part_number, part_name = job.result.result(
+                    timeout=CAPTURE_TIMEOUT
                 )
+                app.logger.info(f"Frame captured and inspected: {filename}")
                 
                 return jsonify({
                    "result": result,
@@ -307,6 +346,8 @@ def create_app():
                    "part_number": part_number,
                    "part_name": part_name
                })
+            except PipelineBusy as e:
+                return jsonify({"error": str(e)}), 503
             except Exception as e:
                 app.logger.exception("Auto capture failed")
                 return jsonify({"error": str(e)}), 500
@@ -362,10 +403,38 @@ def create_app():
         @app.route("/software_trigger", methods=["POST"])
         def software_trigger():
             try:
-                cam_software_trigger()
-                return {"status": "ok"}
+                token = cam_software_trigger()
+                return {"status": "ok", "trigger": token}
             except Exception as e:
                 return {"status": "error", "message": str(e)}, 500
+
+        @app.route("/api/calibration", methods=["GET"])
+        def calibration_status():
+            calibration = calibration_store.active()
+            return jsonify({
+                "station": calibration_store.station,
+                "serial": camera_manager.camera_serial(),
+                "calibration": calibration.as_dict() if calibration else None,
+                "scale": calibration_store.scale().as_dict(),
+            })
+
+        @app.route("/api/calibration", methods=["POST"])
+        def calibrate():
+            data = request.get_json(silent=True) or {}
+            try:
+                calibration = calibrate_camera(
+                    method=data.get("method", "board"),
+                    part_number=data.get("part_number"),
+                    **{k: data[k] for k in ("views", "board", "square_mm", "interval") if k in data}
+                )
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            except RuntimeError as e:
+                return jsonify({"status": "error", "message": str(e)}), 409
+            except Exception as e:
+                app.logger.exception("Calibration failed")
+                return jsonify({"status": "error", "message": str(e)}), 500
+            return jsonify({"status": "ok", "calibration": calibration.as_dict()})
             
         @app.route("/upload", methods=["POST"])
         def upload():
@@ -391,7 +460,10 @@ def create_app():
             if frame is None:
                 return jsonify({"error": "Failed to read saved image"}), 500
 
-            result, best_score, result_img_path, best_match, defect_type, part_number, part_name = process_image_web(frame, filename)
+            part_filter, fallback = get_part_filter()
+            result, best_score, result_img_path, best_match, defect_type, part_number, part_name = process_image_web(
+                frame_features(frame, filename), filename, part_number=part_filter, fallback_to_global=fallback
+            )
 
             payload = {
                 "result": result,
@@ -459,8 +531,18 @@ def create_app():
                     "Surface_Hardness_Nitriding": float(data.get("Surface_Hardness_Nitriding") or 0),
                 }
                 
-                inserted_id = db_manager.insert_inspection(db_payload)
-                return jsonify({"status": "success", "id": inserted_id})
+                # The row is written behind the request, so its database id
+                # does not exist yet. The key does, and /save_inspection/<key>
+                # reports the id once the row is written. A client key the
+                # writer still holds is refused rather than reused.
+                key = data.get("inspection_key")
+                if not isinstance(key, str) or not 0 < len(key) <= 64:
+                    key = uuid.uuid4().hex
+                inspection_writer.submit(db_payload, key=key)
+                return jsonify({"status": "success", "queued": True, "key": key})
+
+            except DuplicateKey as e:
+                return jsonify({"error": str(e)}), 409
 
             except ValueError as ve:
                 app.logger.error("Validation error saving inspection: %s", ve)
@@ -470,49 +552,100 @@ def create_app():
                 app.logger.exception("Failed to save inspection")
                 return jsonify({"error": str(e)}), 500
 
+        @app.route("/save_inspection/<key>", methods=["GET"])
+        def saved_inspection_route(key):
+            state = inspection_writer.lookup(key)
+            if state is None:
+                return jsonify({"error": f"Unknown inspection key {key}"}), 404
+            return jsonify(state)
+
         @app.route("/inspect", methods=["POST"])
         def inspect():
-            success = run_inspection()
+            data = request.get_json(silent=True) or {}
+            success = run_inspection(data.get("part_number") or request.values.get("part_number") or "UNKNOWN")
             return jsonify({"success": success})
 
+        @app.route("/api/master-match/<part_number>", methods=["POST"])
+        def master_match(part_number):
+            master = master_templates.get(part_number)
+            if master is None:
+                return jsonify({"error": f"No master edges for part {part_number}"}), 404
+            if "file" in request.files:
+                data = np.frombuffer(request.files["file"].read(), np.uint8)
+                frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            else:
+                frame = camera_capture_frame()
+            if frame is None:
+                return jsonify({"error": "No image available"}), 400
+            score, _ = match_frame(frame_features(frame), master)
+            return jsonify({"part_number": master.part_number, **score})
+
+        @app.route("/api/defect-detect", methods=["POST"])
+        def defect_detect():
+            if not defect_detector.available:
+                return jsonify({"error": "No defect masks; run python defect_masks.py"}), 503
+            if "file" in request.files:
+                data = np.frombuffer(request.files["file"].read(), np.uint8)
+                frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            else:
+                frame = camera_capture_frame()
+            if frame is None:
+                return jsonify({"error": "No image available"}), 400
+            features = frame_features(frame)
+            regions = None
+            part_number = request.values.get("part_number")
+            master = master_templates.get(part_number) if part_number else None
+            if master is not None:
+                # The part's regions are placed on the frame by its pose against the master.
+                score, _ = match_frame(features, master)
+                regions = valve_regions.locate(part_number, score["pose"], frame.shape)
+            report = defect_detector.detect(features, regions)
+            if request.args.get("overlay"):
+                # The annotated image is only drawn when a client asks for it.
+                overlay = render_blobs(frame, report["blobs"])
+                _, buffer = cv2.imencode(".jpg", overlay)
+                return Response(buffer.tobytes(), mimetype="image/jpeg")
+            report["blobs"] = blob_records(report["blobs"])
+            return jsonify(report)
+
         @app.route("/inspection/<part_number>")
         def inspection_details(part_number):
             try:
-                conn = db_manager.get_connection()
-                if not conn:
-                    return jsonify({"error": "Database connection not available"}), 500
-
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT TOP 1 Part_number, Image_name, Result, ssim_score, Defect_type, Best_match, timestamp
-                    FROM inspections
-                    WHERE Part_number = ?
-                    ORDER BY timestamp DESC
-                """, (part_number,))
-                row = cursor.fetchone()
-
-                if not row:
-                    return render_template("inspection_details.html", error="No inspections found")
-
-                base_name = row[1]
-                uploads_folder = os.path.join("static", "uploads")
-                for ext in [".jpg", ".jpeg", ".png"]:
-                    candidate = os.path.join(uploads_folder, base_name + ext)
-                    if os.path.exists(candidate):
-                        base_name = base_name + ext
-                        break
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return jsonify({"error": "Database connection not available"}), 500
+
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT TOP 1 Part_number, Image_name, Result, ssim_score, Defect_type, Best_match, timestamp
+                        FROM inspections
+                        WHERE Part_number = ?
+                        ORDER BY timestamp DESC
+                    """, (part_number,))
+                    row = cursor.fetchone()
+
+                    if not row:
+                        return render_template("inspection_details.html", error="No inspections found")
+
+                    base_name = row[1]
+                    uploads_folder = os.path.join("static", "uploads")
+                    for ext in [".jpg", ".jpeg", ".png"]:
+                        candidate = os.path.join(uploads_folder, base_name + ext)
+                        if os.path.exists(candidate):
+                            base_name = base_name + ext
+                            break
                         
-                inspection = {
-                    "part_number": row[0],
-                    "image_name": row[1],
-                    "result": row[2],
-                    "ssim_score": round(row[3], 4) if row[3] else None,
-                    "defect_type": row[4],
-                    "trained_image": row[5],
-                    "timestamp": row[6]
-                }
+                    inspection = {
+                        "part_number": row[0],
+                        "image_name": row[1],
+                        "result": row[2],
+                        "ssim_score": round(row[3], 4) if row[3] else None,
+                        "defect_type": row[4],
+                        "trained_image": row[5],
+                        "timestamp": row[6]
+                    }
 
-                return render_template("inspection_details.html", inspection=inspection)
+                    return render_template("inspection_details.html", inspection=inspection)
 
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
@@ -527,31 +660,31 @@ def create_app():
         @app.route("/inspection/")
         def inspection_index():
             try:
-                conn = db_manager.get_connection()
-                if not conn:
-                    return "Database connection not available", 500
-
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT TOP 1 Part_number, Image_name, Result, ssim_score, Defect_type, Best_match, timestamp
-                    FROM inspections
-                    ORDER BY timestamp DESC
-                """)
-                row = cursor.fetchone()
-
-                if row:
-                    inspection = {
-                        "part_number": row[0],
-                        "image_name": row[1],
-                        "result": row[2],
-                        "ssim_score": round(row[3], 4) if row[3] else None,
-                        "defect_type": row[4],
-                        "trained_image": row[5],
-                        "timestamp": row[6]
-                    }
-                    return render_template("inspection_details.html", inspection=inspection)
-
-                return "No inspections found"
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return "Database connection not available", 500
+
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT TOP 1 Part_number, Image_name, Result, ssim_score, Defect_type, Best_match, timestamp
+                        FROM inspections
+                        ORDER BY timestamp DESC
+                    """)
+                    row = cursor.fetchone()
+
+                    if row:
+                        inspection = {
+                            "part_number": row[0],
+                            "image_name": row[1],
+                            "result": row[2],
+                            "ssim_score": round(row[3], 4) if row[3] else None,
+                            "defect_type": row[4],
+                            "trained_image": row[5],
+                            "timestamp": row[6]
+                        }
+                        return render_template("inspection_details.html", inspection=inspection)
+
+                    return "No inspections found"
 
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
@@ -559,21 +692,21 @@ def create_app():
         @app.route("/api/data")
         def dashboard_data():
             try:
-                conn = db_manager.get_connection()
-                if not conn:
-                    return jsonify({"error": "Database connection not available"}), 500
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return jsonify({"error": "Database connection not available"}), 500
 
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM inspections WHERE Result = 'Accepted'")
-                row = cursor.fetchone()
-                accepted = row[0] if row else 0
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT COUNT(*) FROM inspections WHERE Result = 'Accepted'")
+                    row = cursor.fetchone()
+                    accepted = row[0] if row else 0
 
-                cursor.execute("SELECT COUNT(*) FROM inspections WHERE Result = 'Rejected'")
-                row = cursor.fetchone()
-                rejected = row[0] if row else 0
+                    cursor.execute("SELECT COUNT(*) FROM inspections WHERE Result = 'Rejected'")
+                    row = cursor.fetchone()
+                    rejected = row[0] if row else 0
 
-                total = accepted + rejected
-                return jsonify({"accepted": accepted, "rejected": rejected, "total": total})
+                    total = accepted + rejected
+                    return jsonify({"accepted": accepted, "rejected": rejected, "total": total})
                 
             except Exception as e:
                 return jsonify({"error": f"Dashboard fetch failed: {str(e)}"}), 500
@@ -588,38 +721,38 @@ def create_app():
         @app.route("/api/rejected-data/<filter_type>")
         def get_rejected_data(filter_type):
             try:
-                conn = db_manager.get_connection()
-                if not conn:
-                    return jsonify({"error": "Database connection not available"}), 500
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return jsonify({"error": "Database connection not available"}), 500
                     
-                cursor = conn.cursor()
-                now = datetime.utcnow()
-
-                if filter_type == "daily":
-                    start_date = datetime(now.year, now.month, now.day)
-                elif filter_type == "weekly":
-                    start_date = now - timedelta(days=7)
-                elif filter_type == "monthly":
-                    start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                elif filter_type == "3months":
-                    start_date = datetime(now.year, now.month, 1) - timedelta(days=90)
-                elif filter_type == "6months":
-                    start_date = datetime(now.year, now.month, 1) - timedelta(days=180)
-                elif filter_type == "yearly":
-                    start_date = datetime(now.year - 1, now.month, now.day)
-                else:
-                    return jsonify({"error": "Invalid filter type"}), 400
-
-                cursor.execute("""
-                    SELECT Part_number, Result, Defect_type, [timestamp]
-                    FROM inspections
-                    WHERE Result = 'Rejected' AND [timestamp] >= ?
-                """, (start_date,))
-                rows = cursor.fetchall()
-                columns = [col[0] for col in cursor.description]
-                data = [{col: row[i] for i, col in enumerate(columns)} for row in rows]
+                    cursor = conn.cursor()
+                    now = datetime.utcnow()
+
+                    if filter_type == "daily":
+                        start_date = datetime(now.year, now.month, now.day)
+                    elif filter_type == "weekly":
+                        start_date = now - timedelta(days=7)
+                    elif filter_type == "monthly":
+                        start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                    elif filter_type == "3months":
+                        start_date = datetime(now.year, now.month, 1) - timedelta(days=90)
+                    elif filter_type == "6months":
+                        start_date = datetime(now.year, now.month, 1) - timedelta(days=180)
+                    elif filter_type == "yearly":
+                        start_date = datetime(now.year - 1, now.month, now.day)
+                    else:
+                        return jsonify({"error": "Invalid filter type"}), 400
+
+                    cursor.execute("""
+                        SELECT Part_number, Result, Defect_type, [timestamp]
+                        FROM inspections
+                        WHERE Result = 'Rejected' AND [timestamp] >= ?
+                    """, (start_date,))
+                    rows = cursor.fetchall()
+                    columns = [col[0] for col in cursor.description]
+                    data = [{col: row[i] for i, col in enumerate(columns)} for row in rows]
                 
-                return jsonify(data)
+                    return jsonify(data)
                 
             except Exception as e:
                 return jsonify({"error": f"Failed to fetch rejected data: {str(e)}"}), 500
@@ -641,62 +774,61 @@ def create_app():
                 if part_number.lower() in ["none", "null"]:
                     part_number = ""
 
-                conn = db_manager.get_connection()
-                if not conn:
-                    return jsonify({"error": "Database connection not available"}), 500
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return jsonify({"error": "Database connection not available"}), 500
                     
-                cursor = conn.cursor()
-                now = datetime.now()
-
-                if time_filter == "daily":
-                    start_time = now.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif time_filter == "weekly":
-                    start_time = now - timedelta(days=7)
-                elif time_filter == "monthly":
-                    start_time = now - timedelta(days=30)
-                elif time_filter == "yearly":
-                    start_time = now - timedelta(days=365)
-                else:
-                    start_time = now - timedelta(days=1)
-
-                query = """
-                    SELECT 
-                        SUM(CASE WHEN Result='Accepted' THEN 1 ELSE 0 END) AS accepted,
-                        SUM(CASE WHEN Result='Rejected' THEN 1 ELSE 0 END) AS rejected,
-                        COUNT(*) AS total
-                    FROM inspections
-                    WHERE [Timestamp] >= ?
-                """
-                params: List[Any] = [start_time]
-
-                if location and location != "":
-                    query += " AND Location = ?"
-                    params.append(location)
-                if shift and shift != "":
-                    query += " AND Shifts = ?"
-                    params.append(shift)
-                if part_number and part_number != "" and part_number.lower() != "none":
-                    query += " AND Part_number = ?"
-                    params.append(part_number)
-
-                cursor.execute(query, params)
-                row = cursor.fetchone()
-
-                if row is None:
-                    accepted = rejected = total = 0
-                else:
-                    accepted = row[0] or 0
-                    rejected = row[1] or 0
-                    total = row[2] or 0
+                    cursor = conn.cursor()
+                    now = datetime.now()
+
+                    if time_filter == "daily":
+                        start_time = now.replace(hour=0, minute=0, second=0, microsecond=0)
+                    elif time_filter == "weekly":
+                        start_time = now - timedelta(days=7)
+                    elif time_filter == "monthly":
+                        start_time = now - timedelta(days=30)
+                    elif time_filter == "yearly":
+                        start_time = now - timedelta(days=365)
+                    else:
+                        start_time = now - timedelta(days=1)
+
+                    query = """
+                        SELECT 
+                            SUM(CASE WHEN Result='Accepted' THEN 1 ELSE 0 END) AS accepted,
+                            SUM(CASE WHEN Result='Rejected' THEN 1 ELSE 0 END) AS rejected,
+                            COUNT(*) AS total
+                        FROM inspections
+                        WHERE [Timestamp] >= ?
+                    """
+                    params: List[Any] = [start_time]
+
+                    if location and location != "":
+                        query += " AND Location = ?"
+                        params.append(location)
+                    if shift and shift != "":
+                        query += " AND Shifts = ?"
+                        params.append(shift)
+                    if part_number and part_number != "" and part_number.lower() != "none":
+                        query += " AND Part_number = ?"
+                        params.append(part_number)
+
+                    cursor.execute(query, params)
+                    row = cursor.fetchone()
+
+                    if row is None:
+                        accepted = rejected = total = 0
+                    else:
+                        accepted = row[0] or 0
+                        rejected = row[1] or 0
+                        total = row[2] or 0
 
-                cursor.close()
-                conn.close()
+                    cursor.close()
 
-                return jsonify({
-                    "accepted": accepted,
-                    "rejected": rejected,
-                    "total": total
-                })
+                    return jsonify({
+                        "accepted": accepted,
+                        "rejected": rejected,
+                        "total": total
+                    })
                 
             except Exception as e:
                 return jsonify({"error": f"Failed to fetch chart data: {str(e)}"}), 500
@@ -707,52 +839,52 @@ def create_app():
                 part_number = request.args.get("part", "").strip()
                 time_range = request.args.get("time", "").strip().lower()
                 
-                conn = db_manager.get_connection()
-                if not conn:
-                    return jsonify({"error": "Database connection error"}), 500
+                with db_manager.connection() as conn:
+                    if not conn:
+                        return jsonify({"error": "Database connection error"}), 500
                     
-                cursor = conn.cursor()
-                now = datetime.now()
-                start = None
-
-                if time_range == "daily":
-                    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif time_range == "weekly":
-                    monday = now - timedelta(days=now.weekday())
-                    start = monday.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif time_range == "monthly":
-                    start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                elif time_range == "yearly":
-                    start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-
-                query = """
-                    SELECT Defect_type, COUNT(*) 
-                    FROM inspections 
-                    WHERE Result = 'Rejected'
-                """
-                params = []
-
-                if part_number:
-                    query += " AND part_number = ?"
-                    params.append(part_number)
-                if start:
-                    query += " AND [timestamp] >= ?"
-                    params.append(start)
-                query += " GROUP BY Defect_type"
+                    cursor = conn.cursor()
+                    now = datetime.now()
+                    start = None
+
+                    if time_range == "daily":
+                        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+                    elif time_range == "weekly":
+                        monday = now - timedelta(days=now.weekday())
+                        start = monday.replace(hour=0, minute=0, second=0, microsecond=0)
+                    elif time_range == "monthly":
+                        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                    elif time_range == "yearly":
+                        start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+                    query = """
+                        SELECT Defect_type, COUNT(*) 
+                        FROM inspections 
+                        WHERE Result = 'Rejected'
+                    """
+                    params = []
+
+                    if part_number:
+                        query += " AND part_number = ?"
+                        params.append(part_number)
+                    if start:
+                        query += " AND [timestamp] >= ?"
+                        params.append(start)
+                    query += " GROUP BY Defect_type"
                 
-                cursor.execute(query, params)
-                rows = cursor.fetchall()
-                data = [
-                    {"label": row[0], "count": row[1]}
-                    for row in rows
-                    if row[0] not in (None, "", "Defect")
-                ]
-
-                return jsonify({
-                    "part_number": part_number,
-                    "time_range": time_range,
-                    "data": data,
-                })
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall()
+                    data = [
+                        {"label": row[0], "count": row[1]}
+                        for row in rows
+                        if row[0] not in (None, "", "Defect")
+                    ]
+
+                    return jsonify({
+                        "part_number": part_number,
+                        "time_range": time_range,
+                        "data": data,
+                    })
 
             except Exception as e:
                 return jsonify({"error": f"Defect type fetch error: {str(e)}"}), 500
@@ -763,34 +895,25 @@ def create_app():
             if not part_number:
                 return "Part number is required", 400
 
-            try:
-                conn = db_manager.get_connection()
-                if conn is None:
-                    return jsonify({"error": "Database connection not available"}), 500
-                    
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT *
-                    FROM Valve_Details
-                    WHERE [Part Number] = ?
-                """, (part_number,))
-                row = cursor.fetchone()
-
-                if not row:
-                    cursor.close()
-                    conn.close()
-                    return f"No data found for Part Number {part_number}", 404
-                    
-                columns = [col[0] for col in cursor.description]
-                specs = {col: row[i] for i, col in enumerate(columns)}
+            spec = valve_catalog.spec(part_number)
+            if spec is None:
+                return f"No data found for Part Number {part_number}", 404
+            return jsonify(spec.as_dict())
 
-                cursor.close()
-                conn.close()
-                return jsonify(specs)
+        @app.route("/api/valve-specs/tolerances", methods=["GET"])
+        def valve_spec_tolerances():
+            part_number = request.args.get("part_number")
+            if not part_number:
+                return "Part number is required", 400
 
-            except Exception as e:
-                app.logger.error(f"Failed to fetch valve specs: {str(e)}")
-                return f"Error fetching valve specs: {str(e)}", 500
+            spec = valve_catalog.spec(part_number)
+            if spec is None:
+                return f"No data found for Part Number {part_number}", 404
+            return jsonify({
+                "part_number": spec.part_number,
+                "tolerances": {column: t.as_dict() for column, t in spec.tolerances.items()},
+                "unparsed": [column for column, t in spec.tolerances.items() if not t.parsed],
+            })
 
         @app.route("/api/reports/daily", methods=["GET"])
         def download_daily_report():
@@ -1065,8 +1188,51 @@ def create_app():
 
         @app.route('/uploads/<filename>')
         def serve_upload(filename):
+            pending = inspection_pipeline.pending_image(filename)
+            if pending is not None:
+                ok, buffer = cv2.imencode('.jpg', pending)
+                if ok:
+                    return Response(buffer.tobytes(), mimetype="image/jpeg")
             return send_from_directory(UPLOAD_FOLDER, filename)
 
+        @app.route("/api/metrics/latency")
+        def latency_metrics():
+            return jsonify({
+                "inspections": latency_recorder.count,
+                "stages": latency_recorder.snapshot(),
+            })
+
+        @app.route("/api/metrics/db-pool")
+        def db_pool_metrics():
+            return jsonify(db_manager.pool.metrics())
+
+        @app.route("/api/metrics/inspection-writer")
+        def inspection_writer_metrics():
+            return jsonify(inspection_writer.metrics())
+
+        @app.route("/api/metrics/master-templates")
+        def master_template_metrics():
+            return jsonify(master_templates.metrics())
+
+        @app.route("/api/metrics/defect-masks")
+        def defect_mask_metrics():
+            return jsonify(defect_masks.metrics())
+
+        @app.route("/api/metrics/defect-classifier")
+        def defect_classifier_metrics():
+            return jsonify(defect_classifier.metrics())
+
+        @app.route("/api/metrics/valve-regions")
+        def valve_region_metrics():
+            return jsonify(valve_regions.metrics())
+
+        @app.route("/api/metrics/pipeline")
+        def pipeline_metrics():
+            metrics = inspection_pipeline.metrics()
+            metrics["camera"] = frame_stats()
+            metrics["frame_features"] = frame_feature_cache.metrics()
+            return jsonify(metrics)
+
         @app.route('/trained_images/<part_number>/<filename>')
         def serve_trained_image(part_number, filename):
             folder = os.path.join(TRAINED_IMAGES_FOLDER, part_number)
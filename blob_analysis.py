@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from measurement_engine import PROFILE_BANDS, ValveProfile
+
+# One row per blob. Geometry is in frame pixels.
+BLOB_DTYPE = np.dtype([
+    ("label", np.int32),
+    ("area", np.float64),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("w", np.int32),
+    ("h", np.int32),
+    ("cx", np.float64),
+    ("cy", np.float64),
+    ("mean_intensity", np.float64),
+    ("region", "U8"),
+    ("defect_class", "U32"),
+    ("score", np.float64),
+])
+
+# Narrower bands first, so the groove wins over the tip band around it.
+REGIONS = sorted(PROFILE_BANDS, key=lambda name: PROFILE_BANDS[name][1] - PROFILE_BANDS[name][0])
+
+
+def regions(cx: np.ndarray, cy: np.ndarray, profile: Optional[ValveProfile]) -> np.ndarray:
+    """Profile band (head, neck, stem, groove, tip) of every point along the
+    valve axis; 'outside' past the ends and 'unknown' without a profile."""
+    if profile is None:
+        return np.full(cx.shape, "unknown", dtype="U8")
+    ox, oy = profile.origin
+    ax, ay = profile.axis
+    t = ((cx - ox) * ax + (cy - oy) * ay) / profile.length_px
+    conditions = [(t >= PROFILE_BANDS[n][0]) & (t < PROFILE_BANDS[n][1]) for n in REGIONS]
+    return np.select(conditions, REGIONS, default="outside").astype("U8")
+
+
+def majority_regions(labels: np.ndarray, region_labels: np.ndarray, count: int,
+                     names: Sequence[str]) -> np.ndarray:
+    """The region most of each blob's pixels lie in, from a region label
+    map (0 = outside, i = names[i - 1]) the size of the blob labels."""
+    k = len(names) + 1
+    votes = np.bincount(labels.reshape(-1) * k + region_labels.reshape(-1), minlength=count * k)
+    best = votes.reshape(count, k)[1:].argmax(axis=1)
+    return np.asarray(("outside",) + tuple(names), dtype="U8")[best]
+
+
+def analyze_blobs(mask: np.ndarray, gray: np.ndarray, scale: Tuple[float, float] = (1.0, 1.0),
+                  profile: Optional[ValveProfile] = None, offset: Tuple[int, int] = (0, 0),
+                  region_labels: Optional[np.ndarray] = None,
+                  region_names: Sequence[str] = ()) -> Tuple[np.ndarray, np.ndarray]:
+    """Every 8-connected blob of mask as one row of BLOB_DTYPE, from a
+    single connectedComponentsWithStats pass. Returns (blobs, labels).
+
+    gray is the image the blobs are measured in, at the mask's size, for
+    the mean intensity. scale is (x, y) frame pixels per mask pixel and
+    offset the mask's top-left corner when it is a crop of the grid that
+    scale refers to; the areas, boxes and centroids are given in frame
+    pixels so that they can be compared with frame-sized limits and drawn
+    on the frame. A blob's region is the one most of its pixels have in
+    region_labels when that is given, otherwise the profile band of its
+    centroid. The defect_class and score columns are left for the caller
+    to fill.
+    """
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    blobs = np.zeros(count - 1, dtype=BLOB_DTYPE)
+    if count <= 1:
+        return blobs, labels
+    sx, sy = scale
+    ox, oy = offset
+    pixels = stats[1:, cv2.CC_STAT_AREA]
+    sums = np.bincount(labels.reshape(-1), weights=gray.reshape(-1), minlength=count)[1:]
+
+    blobs["label"] = np.arange(1, count)
+    blobs["area"] = pixels * (sx * sy)
+    blobs["x"] = np.floor((stats[1:, cv2.CC_STAT_LEFT] + ox) * sx)
+    blobs["y"] = np.floor((stats[1:, cv2.CC_STAT_TOP] + oy) * sy)
+    blobs["w"] = np.ceil(stats[1:, cv2.CC_STAT_WIDTH] * sx)
+    blobs["h"] = np.ceil(stats[1:, cv2.CC_STAT_HEIGHT] * sy)
+    # Pixel centres of the mask map to (i + 0.5) * scale - 0.5 in the frame.
+    blobs["cx"] = (centroids[1:, 0] + ox + 0.5) * sx - 0.5
+    blobs["cy"] = (centroids[1:, 1] + oy + 0.5) * sy - 0.5
+    blobs["mean_intensity"] = sums / pixels
+    if region_labels is not None:
+        blobs["region"] = majority_regions(labels, region_labels, count, region_names)
+    else:
+        blobs["region"] = regions(blobs["cx"], blobs["cy"], profile)
+    return blobs, labels
+
+
+def blob_records(blobs: np.ndarray) -> List[Dict[str, Any]]:
+    """Blob rows as plain dicts, for JSON."""
+    return [
+        {
+            "area": round(float(b["area"]), 1),
+            "bbox": [int(b["x"]), int(b["y"]), int(b["w"]), int(b["h"])],
+            "centroid": [round(float(b["cx"]), 1), round(float(b["cy"]), 1)],
+            "mean_intensity": round(float(b["mean_intensity"]), 1),
+            "region": str(b["region"]),
+            "defect_class": str(b["defect_class"]),
+            "score": round(float(b["score"]), 4),
+        }
+        for b in blobs
+    ]
+
+
+def render_blobs(frame: np.ndarray, blobs: np.ndarray) -> np.ndarray:
+    """A copy of the frame with every blob boxed and labelled in red."""
+    overlay = frame.copy()
+    for b in blobs:
+        x, y, w, h = int(b["x"]), int(b["y"]), int(b["w"]), int(b["h"])
+        cv2.rectangle(overlay, (x, y), (x + w, y + h), (0, 0, 255), 2)
+        cv2.putText(overlay, f"{b['defect_class']} ({b['region']})", (x, max(15, y - 5)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+    return overlay
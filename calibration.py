@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from config import (
+    STATION_ID,
+    CALIBRATION_DIR,
+    CALIBRATION_BOARD,
+    CALIBRATION_SQUARE_MM,
+    CALIBRATION_VIEWS,
+)
+from measurement_engine import (FEATURE_COLUMNS, ScaleModel, extract_profile, feature_pixels, scale_model,
+                                spec_limits)
+
+logger = logging.getLogger("calibration")
+
+# Features of a golden part whose drawing values set the scale.
+GOLDEN_FEATURES = ("Overall Length", "Stem Diameter", "Head Diameter")
+# A board calibration needs at least this many views with the board found.
+MIN_BOARD_VIEWS = 3
+# Golden-part readings of different features must agree on the scale to
+# within this; a wider spread means a drawing value is not what it claims.
+MAX_GOLDEN_SPREAD = 0.05
+
+_SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+
+def parse_board(board) -> Tuple[int, int]:
+    """'9x6' -> (9, 6): inner corners per row and per column."""
+    if isinstance(board, str):
+        cols, rows = (int(v) for v in board.lower().split("x"))
+        return cols, rows
+    return int(board[0]), int(board[1])
+
+
+def _safe(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(name))
+
+
+class CameraCalibration:
+    """Lens distortion and image-plane scale of one camera at one station.
+
+    The undistortion maps are fixed-point remap tables built once, when the
+    calibration is fitted, and stored with it, so correcting a frame is a
+    single cv2.remap. A calibration without a camera matrix (a golden-part
+    scale with no earlier board calibration) leaves frames as they are.
+    """
+
+    def __init__(self, station: str, serial: str, image_size: Tuple[int, int], mm_per_px: float,
+                 method: str, camera_matrix: Optional[np.ndarray] = None,
+                 dist_coeffs: Optional[np.ndarray] = None, rms: Optional[float] = None,
+                 views: int = 0, created: Optional[str] = None,
+                 map1: Optional[np.ndarray] = None, map2: Optional[np.ndarray] = None):
+        self.station = station
+        self.serial = serial
+        self.image_size = (int(image_size[0]), int(image_size[1]))
+        self.mm_per_px = float(mm_per_px)
+        self.method = method
+        self.camera_matrix = camera_matrix
+        self.dist_coeffs = dist_coeffs
+        self.rms = rms
+        self.views = views
+        self.created = created or datetime.now().isoformat(timespec="seconds")
+        self.map1 = map1
+        self.map2 = map2
+        self._size_warned = False
+        if camera_matrix is not None and map1 is None:
+            self.map1, self.map2 = cv2.initUndistortRectifyMap(
+                camera_matrix, dist_coeffs, None, camera_matrix, self.image_size, cv2.CV_16SC2
+            )
+
+    @property
+    def corrects_distortion(self) -> bool:
+        return self.map1 is not None
+
+    def undistort(self, frame: np.ndarray) -> np.ndarray:
+        """Undistorted copy of frame. Frames of another size than the one
+        calibrated are copied unchanged."""
+        if self.map1 is None:
+            return frame.copy()
+        if (frame.shape[1], frame.shape[0]) != self.image_size:
+            if not self._size_warned:
+                logger.warning(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match calibration "
+                               f"{self.image_size[0]}x{self.image_size[1]} of camera {self.serial}; "
+                               f"frames are not undistorted")
+                self._size_warned = True
+            return frame.copy()
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR)
+
+    def scale(self) -> ScaleModel:
+        return ScaleModel(self.mm_per_px, source=f"calibration:{self.station}/{self.serial}")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "station": self.station,
+            "serial": self.serial,
+            "image_size": list(self.image_size),
+            "mm_per_px": self.mm_per_px,
+            "method": self.method,
+            "rms": self.rms,
+            "views": self.views,
+            "created": self.created,
+            "camera_matrix": None if self.camera_matrix is None else self.camera_matrix.tolist(),
+            "dist_coeffs": None if self.dist_coeffs is None else self.dist_coeffs.ravel().tolist(),
+        }
+
+    def save(self, path: str) -> None:
+        arrays = {"meta": np.array(json.dumps(self.as_dict()))}
+        if self.map1 is not None:
+            arrays.update(camera_matrix=self.camera_matrix, dist_coeffs=self.dist_coeffs,
+                          map1=self.map1, map2=self.map2)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CameraCalibration":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            return cls(
+                meta["station"], meta["serial"], meta["image_size"], meta["mm_per_px"], meta["method"],
+                camera_matrix=data["camera_matrix"] if "camera_matrix" in data else None,
+                dist_coeffs=data["dist_coeffs"] if "dist_coeffs" in data else None,
+                rms=meta.get("rms"), views=meta.get("views", 0), created=meta.get("created"),
+                map1=data["map1"] if "map1" in data else None,
+                map2=data["map2"] if "map2" in data else None,
+            )
+
+
+def find_board(frame: np.ndarray, board=CALIBRATION_BOARD) -> Optional[np.ndarray]:
+    """Sub-pixel inner corners of the checkerboard, or None if it is not fully visible."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+    found, corners = cv2.findChessboardCorners(gray, parse_board(board), flags=flags)
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), _SUBPIX_CRITERIA)
+
+
+def calibrate_board(frames: Sequence[np.ndarray], station: str, serial: str,
+                    board=CALIBRATION_BOARD, square_mm: float = CALIBRATION_SQUARE_MM) -> CameraCalibration:
+    """Fit the camera matrix and lens distortion from views of a checkerboard.
+
+    Views should tilt and move the board across the whole field. The last
+    view in which the board is found must show it lying in the inspection
+    plane: its corner spacing, once undistorted, sets the scale.
+    """
+    cols, rows = parse_board(board)
+    grid = np.zeros((cols * rows, 3), np.float32)
+    grid[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2) * square_mm
+
+    image_points = []
+    for frame in frames:
+        corners = find_board(frame, (cols, rows))
+        if corners is not None:
+            image_points.append(corners)
+    if len(image_points) < MIN_BOARD_VIEWS:
+        raise ValueError(f"Checkerboard {cols}x{rows} found in {len(image_points)} of {len(frames)} views; "
+                         f"need at least {MIN_BOARD_VIEWS}")
+
+    size = (frames[0].shape[1], frames[0].shape[0])
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(
+        [grid] * len(image_points), image_points, size, None, None
+    )
+    plane = cv2.undistortPoints(image_points[-1], camera_matrix, dist_coeffs, P=camera_matrix)
+    plane = plane.reshape(rows, cols, 2)
+    spacing = np.concatenate([
+        np.linalg.norm(np.diff(plane, axis=1), axis=2).ravel(),
+        np.linalg.norm(np.diff(plane, axis=0), axis=2).ravel(),
+    ])
+    mm_per_px = square_mm / float(np.median(spacing))
+    logger.info(f"Board calibration of {station}/{serial}: rms {rms:.3f} px, {mm_per_px:.5f} mm/px "
+                f"from {len(image_points)} views")
+    return CameraCalibration(station, serial, size, mm_per_px, "board", camera_matrix, dist_coeffs,
+                             rms=float(rms), views=len(image_points))
+
+
+def calibrate_golden(frames: Sequence[np.ndarray], spec, station: str, serial: str,
+                     base: Optional[CameraCalibration] = None) -> CameraCalibration:
+    """Fit the scale from a golden part whose drawing dimensions are in spec.
+
+    One silhouette cannot tell lens distortion from part geometry, so the
+    distortion model of base, an earlier board calibration of the same
+    camera, is kept and each view is undistorted with it before measuring.
+
+    Only drawing values that pass measurement_engine.spec_error are used,
+    and the fit is refused when the features disagree on the scale by more
+    than MAX_GOLDEN_SPREAD, so a wrong spec cell cannot set the mm/px that
+    every later measurement uses.
+    """
+    nominal, _, _, errors = spec_limits(spec)
+    use = np.array([column in GOLDEN_FEATURES for column in FEATURE_COLUMNS]) & np.isfinite(nominal)
+    for column, error in zip(FEATURE_COLUMNS, errors):
+        if column in GOLDEN_FEATURES and error is not None:
+            logger.warning(f"Golden part {spec.part_number}: {column} not used, {error}")
+    if not use.any():
+        raise ValueError(f"Part {spec.part_number} has no usable nominal {', '.join(GOLDEN_FEATURES)}")
+
+    ratios = []
+    for frame in frames:
+        if base is not None:
+            frame = base.undistort(frame)
+        profile = extract_profile(frame)
+        if profile is None or not profile.complete:
+            continue
+        pixels = feature_pixels(profile)
+        ok = use & np.isfinite(pixels) & (pixels > 0)
+        ratios.extend(nominal[ok] / pixels[ok])
+    if not ratios:
+        raise ValueError("Golden part was not found whole in any view")
+
+    mm_per_px = float(np.median(ratios))
+    spread = float(np.std(ratios) / mm_per_px)
+    if spread > MAX_GOLDEN_SPREAD:
+        raise ValueError(f"Golden part {spec.part_number} readings disagree on the scale by "
+                         f"{100 * spread:.1f}%; check its drawing values and the views")
+    logger.info(f"Golden-part calibration of {station}/{serial} with {spec.part_number}: "
+                f"{mm_per_px:.5f} mm/px, spread {100 * spread:.2f}% over {len(ratios)} readings")
+    size = (frames[0].shape[1], frames[0].shape[0])
+    if base is not None and base.corrects_distortion and base.image_size == size:
+        return CameraCalibration(station, serial, size, mm_per_px, "golden", base.camera_matrix,
+                                 base.dist_coeffs, rms=base.rms, views=len(frames),
+                                 map1=base.map1, map2=base.map2)
+    return CameraCalibration(station, serial, size, mm_per_px, "golden", views=len(frames))
+
+
+class CalibrationStore:
+    """Calibrations on disk, one file per station and camera serial.
+
+    Each file is read once; the remap tables it holds stay in memory and
+    are shared by every caller.
+    """
+
+    def __init__(self, directory: str = CALIBRATION_DIR, station: str = STATION_ID):
+        self.directory = directory
+        self.station = station
+        self._cache: Dict[Tuple[str, str], Optional[CameraCalibration]] = {}
+        self._lock = threading.Lock()
+
+    def path(self, serial: str, station: Optional[str] = None) -> str:
+        return os.path.join(self.directory, f"{_safe(station or self.station)}_{_safe(serial)}.npz")
+
+    def get(self, serial: str, station: Optional[str] = None) -> Optional[CameraCalibration]:
+        key = (station or self.station, serial)
+        if key in self._cache:
+            return self._cache[key]
+        with self._lock:
+            if key not in self._cache:
+                path = self.path(serial, station)
+                calibration = None
+                if os.path.exists(path):
+                    try:
+                        calibration = CameraCalibration.load(path)
+                        logger.info(f"Loaded calibration {os.path.basename(path)}")
+                    except Exception as e:
+                        logger.error(f"Could not load calibration {path}: {e}")
+                self._cache[key] = calibration
+            return self._cache[key]
+
+    def save(self, calibration: CameraCalibration) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(calibration.serial, calibration.station)
+        calibration.save(path)
+        with self._lock:
+            self._cache[(calibration.station, calibration.serial)] = calibration
+        logger.info(f"Saved calibration {os.path.basename(path)}")
+        return path
+
+    def latest(self, station: Optional[str] = None) -> Optional[CameraCalibration]:
+        """Most recently saved calibration of the station, for tools that run without a camera."""
+        prefix = _safe(station or self.station) + "_"
+        try:
+            names = [n for n in os.listdir(self.directory) if n.startswith(prefix) and n.endswith(".npz")]
+        except OSError:
+            return None
+        if not names:
+            return None
+        newest = max(names, key=lambda n: os.path.getmtime(os.path.join(self.directory, n)))
+        return self.get(newest[len(prefix):-len(".npz")], station)
+
+    def active(self) -> Optional[CameraCalibration]:
+        """Calibration of the camera that is open at this station."""
+        import camera_manager
+
+        serial = camera_manager.camera_serial()
+        return self.get(serial) if serial else None
+
+    def undistort(self, frame: np.ndarray) -> np.ndarray:
+        """Copy of a camera frame, undistorted if the open camera is calibrated."""
+        calibration = self.active()
+        return calibration.undistort(frame) if calibration is not None else frame.copy()
+
+    def scale(self) -> ScaleModel:
+        """mm-per-pixel of the open camera, else of the last calibration of
+        this station, else the configured MEASUREMENT_MM_PER_PX."""
+        calibration = self.active() or self.latest()
+        return calibration.scale() if calibration is not None else scale_model
+
+
+calibration_store = CalibrationStore()
+
+
+def capture_views(count: int = CALIBRATION_VIEWS, interval: float = 0.5,
+                  timeout: float = 5.0) -> List[np.ndarray]:
+    """Grab count distinct raw frames from the running camera service,
+    interval seconds apart so the target can be moved between them."""
+    import camera_manager
+
+    frames, seq = [], None
+    while len(frames) < count:
+        ref = camera_manager.acquire_frame(after_seq=seq, timeout=timeout)
+        if ref is None:
+            raise RuntimeError("Camera frame not available")
+        with ref:
+            frames.append(ref.frame.copy())
+            seq = ref.seq
+        if len(frames) < count:
+            time.sleep(interval)
+    return frames
+
+
+def calibrate_camera(method: str = "board", part_number: Optional[str] = None,
+                     views: int = CALIBRATION_VIEWS, board=CALIBRATION_BOARD,
+                     square_mm: float = CALIBRATION_SQUARE_MM, interval: float = 0.5) -> CameraCalibration:
+    """Capture views through camera_manager, fit and store the calibration
+    of the open camera at this station."""
+    import camera_manager
+
+    serial = camera_manager.camera_serial()
+    if serial is None:
+        raise RuntimeError("No camera is open")
+    if method == "board":
+        calibration = calibrate_board(capture_views(views, interval), calibration_store.station, serial,
+                                      board, square_mm)
+    elif method == "golden":
+        from valve_catalog import valve_catalog
+
+        spec = valve_catalog.spec(part_number)
+        if spec is None:
+            raise ValueError(f"Part number {part_number} not found")
+        calibration = calibrate_golden(capture_views(views, interval), spec, calibration_store.station,
+                                       serial, base=calibration_store.get(serial))
+    else:
+        raise ValueError(f"Unknown calibration method {method!r}")
+    calibration_store.save(calibration)
+    return calibration
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python calibration.py <serial> <board images...>: board calibration from saved frames.
+    if len(sys.argv) < 3:
+        print("usage: python calibration.py <camera serial> <image> [<image> ...]")
+        sys.exit(1)
+    images = [cv2.imread(p) for p in sys.argv[2:]]
+    result = calibrate_board([img for img in images if img is not None], calibration_store.station, sys.argv[1])
+    print(json.dumps({k: v for k, v in result.as_dict().items() if k != "camera_matrix"}, indent=2))
+    print("saved to", calibration_store.save(result))
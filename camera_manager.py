@@ -6,6 +6,7 @@ import logging
 from typing import Optional
 import ctypes
 
+import frame_conversion
 from hik_cam.MvCameraControl_class import (
     MvCamera,
     MV_CC_DEVICE_INFO_LIST,
@@ -19,7 +20,11 @@ from hik_cam.MvCameraControl_class import (
     MV_TRIGGER_MODE_ON,
     MV_TRIGGER_MODE_OFF,
     MV_TRIGGER_SOURCE_SOFTWARE,
+    MV_FRAME_OUT_INFO_EX,
+    MV_GrabStrategy_OneByOne,
+    get_platform_functype,
 )
+from hik_cam.PixelType_header import PixelType_Gvsp_BayerRG8
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("camera_manager")
@@ -29,13 +34,189 @@ _camera_type: str = "hikrobot"
 _device_id: int = 0
 _camera_thread: Optional[threading.Thread] = None
 _running: bool = False
-_lock = threading.Lock()
-_last_frame: Optional[np.ndarray] = None
+_acquisition: str = "poll"
+_callback_active: bool = False
+_trigger_counter = 0
+IMAGE_NODE_NUM = 5
+
+FRAME_CALLBACK = get_platform_functype()(
+    None, ctypes.POINTER(ctypes.c_ubyte), ctypes.POINTER(MV_FRAME_OUT_INFO_EX), ctypes.c_void_p
+)
+FRAME_RING_SLOTS = 4
+
+
+class FrameRef:
+    """Read-only view of a ring slot. The view stays valid until release()."""
+
+    def __init__(self, ring: "FrameRing", slot: "_FrameSlot"):
+        self._ring = ring
+        self._slot = slot
+        self.frame = slot.buffer.view()
+        self.frame.flags.writeable = False
+        self.seq = slot.seq
+        self.timestamp = slot.timestamp
+        self.frame_number = slot.frame_number
+        self.skipped = 0
+
+    def release(self):
+        if self._slot is not None:
+            self._ring._release(self._slot)
+            self._slot = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _FrameSlot:
+    __slots__ = ("buffer", "seq", "timestamp", "frame_number", "readers")
+
+    def __init__(self):
+        self.buffer: Optional[np.ndarray] = None
+        self.seq = 0
+        self.timestamp = 0.0
+        self.frame_number: Optional[int] = None
+        self.readers = 0
+
+
+class FrameRing:
+    """Fixed set of preallocated frame slots shared by the camera thread and
+    its consumers.
+
+    The producer writes into a slot nobody is reading and never into the
+    newest one, so acquire() always finds the latest frame intact. If every
+    slot is held by a reader the incoming frame is dropped and counted.
+    """
+
+    def __init__(self, size: int = FRAME_RING_SLOTS):
+        self._slots = [_FrameSlot() for _ in range(max(2, size))]
+        self._cond = threading.Condition()
+        self._latest: Optional[_FrameSlot] = None
+        self._next = 0
+        self._seq = 0
+        self.dropped = 0
+        self.missed = 0
+
+    def begin_write(self, shape, dtype=np.uint8) -> Optional[_FrameSlot]:
+        """Reserve a free slot sized for shape/dtype, or None if all are busy."""
+        with self._cond:
+            n = len(self._slots)
+            for i in range(n):
+                slot = self._slots[(self._next + i) % n]
+                if slot.readers == 0 and slot is not self._latest:
+                    self._next = (self._next + i + 1) % n
+                    slot.readers = -1  # reserved by the writer
+                    break
+            else:
+                self.dropped += 1
+                return None
+        if slot.buffer is None or slot.buffer.shape != tuple(shape) or slot.buffer.dtype != dtype:
+            slot.buffer = np.empty(shape, dtype=dtype)
+        return slot
+
+    def commit(self, slot: _FrameSlot, timestamp: Optional[float] = None,
+               frame_number: Optional[int] = None) -> int:
+        with self._cond:
+            self._seq += 1
+            slot.seq = self._seq
+            slot.timestamp = time.time() if timestamp is None else timestamp
+            slot.frame_number = frame_number
+            slot.readers = 0
+            self._latest = slot
+            self._cond.notify_all()
+            return slot.seq
+
+    def abort(self, slot: _FrameSlot) -> None:
+        with self._cond:
+            slot.readers = 0
+
+    def write(self, frame: np.ndarray, timestamp: Optional[float] = None) -> Optional[int]:
+        slot = self.begin_write(frame.shape, frame.dtype)
+        if slot is None:
+            return None
+        np.copyto(slot.buffer, frame)
+        return self.commit(slot, timestamp)
+
+    def acquire(self, after_seq: Optional[int] = None, timeout: Optional[float] = None) -> Optional[FrameRef]:
+        """Latest frame, or the latest frame newer than after_seq (waiting up
+        to timeout for one). The caller must release() it."""
+        with self._cond:
+            def ready():
+                return self._latest is not None and (after_seq is None or self._latest.seq > after_seq)
+            if not ready() and not self._cond.wait_for(ready, timeout=timeout):
+                return None
+            slot = self._latest
+            slot.readers += 1
+            ref = FrameRef(self, slot)
+            if after_seq is not None:
+                ref.skipped = max(0, slot.seq - after_seq - 1)
+                self.missed += ref.skipped
+            return ref
+
+    def latest_seq(self) -> int:
+        with self._cond:
+            return self._latest.seq if self._latest else 0
+
+    def _release(self, slot: _FrameSlot) -> None:
+        with self._cond:
+            slot.readers -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": len(self._slots),
+                "latest_seq": self._latest.seq if self._latest else 0,
+                "in_use": sum(1 for s in self._slots if s.readers > 0),
+                "dropped": self.dropped,
+                "missed": self.missed,
+            }
+
+
+_ring = FrameRing()
+
+
+def _deliver_sdk_frame(ring: FrameRing, address, pixel_type, width, height,
+                       frame_len, frame_number, host_timestamp) -> bool:
+    """Convert an SDK-owned frame straight into a ring slot (callback path)."""
+    if not frame_conversion.is_supported(pixel_type):
+        logger.warning(f"Unsupported pixel type: {pixel_type}")
+        return False
+    if frame_len < frame_conversion.source_bytes(pixel_type, width, height):
+        logger.warning("Incomplete frame from camera")
+        return False
+
+    slot = ring.begin_write(frame_conversion.output_shape(width, height), np.uint8)
+    if slot is None:
+        return False
+    try:
+        frame_conversion.convert_sdk_frame(address, pixel_type, width, height, slot.buffer)
+    except Exception:
+        ring.abort(slot)
+        raise
+    ring.commit(slot, host_timestamp, frame_number)
+    return True
+
 
 class BaseCamera:
+    supports_callback = False
+    # Identifies the physical camera, e.g. to pick its calibration.
+    serial: Optional[str] = None
+
     def read(self):
         raise NotImplementedError
 
+    def start_callback(self, ring: FrameRing):
+        raise NotImplementedError
+
+    def grab(self, ring: FrameRing) -> bool:
+        ret, frame = self.read()
+        if not ret or frame is None:
+            return False
+        ring.write(frame)
+        return True
+
     def release(self):
         raise NotImplementedError
 
@@ -59,6 +240,7 @@ class WebcamCamera(BaseCamera):
 
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+        self.serial = f"webcam{device_id}"
         logger.info("Webcam opened")
 
     def read(self):
@@ -69,6 +251,8 @@ class WebcamCamera(BaseCamera):
         logger.info("Webcam released")
 
 class MockCamera(BaseCamera):
+    serial = "mock"
+
     def read(self):
         frame = np.zeros((480, 640, 3), dtype=np.uint8)
         cv2.putText(
@@ -85,7 +269,92 @@ class MockCamera(BaseCamera):
     def release(self):
         logger.info("Mock camera released")
 
+class SimulatedCamera(BaseCamera):
+    """Stand-in for a Hikrobot camera in callback mode.
+
+    Frames are rendered into a raw sensor buffer of the given pixel type and
+    delivered through the same conversion path as MV_CC_RegisterImageCallBackEx,
+    with incrementing frame numbers. In trigger mode exactly one frame is
+    produced per software_trigger, exposure_delay seconds later.
+    """
+
+    supports_callback = True
+    serial = "simulated"
+
+    def __init__(self, width: int = 1280, height: int = 1024, fps: float = 15.0,
+                 pixel_type: int = PixelType_Gvsp_BayerRG8, exposure_delay: float = 0.005):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pixel_type = pixel_type
+        self.exposure_delay = exposure_delay
+        self.frame_number = 0
+        self._trigger_mode = False
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        n = frame_conversion.source_bytes(pixel_type, width, height)
+        self._raw = (ctypes.c_ubyte * n)()
+        self._raw_view = np.ctypeslib.as_array(self._raw)
+        logger.info("Simulated camera opened")
+
+    def _render(self):
+        self.frame_number += 1
+        image = np.full((self.height, self.width), 40, dtype=np.uint8)
+        cx = self.width // 2 + (self.frame_number % 5) - 2
+        cv2.rectangle(image, (cx - 20, self.height // 5), (cx + 20, self.height - 60), 200, -1)
+        cv2.ellipse(image, (cx, self.height // 5), (110, 40), 0, 0, 360, 200, -1)
+        cv2.putText(image, str(self.frame_number), (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, 255, 2)
+        channels = frame_conversion.CONVERSIONS[self.pixel_type][0]
+        self._raw_view[:] = np.repeat(image.ravel(), channels)
+
+    def _deliver(self, ring: FrameRing) -> bool:
+        self._render()
+        return _deliver_sdk_frame(
+            ring, ctypes.addressof(self._raw), self.pixel_type, self.width, self.height,
+            len(self._raw), self.frame_number, time.time()
+        )
+
+    def read(self):
+        self._render()
+        frame = np.empty(frame_conversion.output_shape(self.width, self.height), dtype=np.uint8)
+        frame_conversion.convert_sdk_frame(ctypes.addressof(self._raw), self.pixel_type,
+                                           self.width, self.height, frame)
+        return True, frame
+
+    def start_callback(self, ring: FrameRing):
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                if self._trigger_mode:
+                    if not self._trigger.wait(timeout=0.1):
+                        continue
+                    self._trigger.clear()
+                    time.sleep(self.exposure_delay)
+                else:
+                    time.sleep(1.0 / self.fps)
+                self._deliver(ring)
+
+        self._thread = threading.Thread(target=run, name="simulated-camera", daemon=True)
+        self._thread.start()
+
+    def set_trigger(self, enable: bool):
+        self._trigger_mode = enable
+
+    def software_trigger(self):
+        self._trigger.set()
+
+    def release(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+        logger.info("Simulated camera released")
+
 class HikrobotCamera(BaseCamera):
+    supports_callback = True
+
     def __init__(self):
         self.cam = MvCamera()
 
@@ -101,6 +370,12 @@ class HikrobotCamera(BaseCamera):
             ctypes.POINTER(MV_CC_DEVICE_INFO)
         ).contents
 
+        if device.nTLayerType == MV_GIGE_DEVICE:
+            serial = device.SpecialInfo.stGigEInfo.chSerialNumber
+        else:
+            serial = device.SpecialInfo.stUsb3VInfo.chSerialNumber
+        self.serial = bytes(serial).split(b"\0")[0].decode("ascii", "ignore") or None
+
         self.cam.MV_CC_CreateHandle(device)
         self.cam.MV_CC_OpenDevice(MV_ACCESS_Exclusive, 0)
 
@@ -109,25 +384,89 @@ class HikrobotCamera(BaseCamera):
         self.cam.MV_CC_SetEnumValue("TriggerMode", MV_TRIGGER_MODE_OFF)
 
         self.cam.MV_CC_StartGrabbing()
-        logger.info("Hikrobot camera opened")
+        logger.info(f"Hikrobot camera {self.serial} opened")
 
-    def read(self):
+    def _fetch(self, out_provider):
+        """Convert one SDK frame into the buffer returned by out_provider.
+
+        The SDK buffer is viewed in place and demosaiced/copied exactly once
+        into the destination before it is handed back to the SDK.
+        """
         frame_out = MV_FRAME_OUT()
         ret = self.cam.MV_CC_GetImageBuffer(frame_out, 1000)
         if ret != 0:
-            return False, None
+            return None, None
 
-        w = frame_out.stFrameInfo.nWidth
-        h = frame_out.stFrameInfo.nHeight
+        try:
+            info = frame_out.stFrameInfo
+            w, h, pixel_type = info.nWidth, info.nHeight, info.enPixelType
+            if not frame_conversion.is_supported(pixel_type):
+                logger.warning(f"Unsupported pixel type: {pixel_type}")
+                return None, None
+            if info.nFrameLen < frame_conversion.source_bytes(pixel_type, w, h):
+                logger.warning("Incomplete frame from camera")
+                return None, None
+
+            target = out_provider(frame_conversion.output_shape(w, h))
+            if target is None:
+                return None, None
+            frame = target if isinstance(target, np.ndarray) else target.buffer
+            frame_conversion.convert_sdk_frame(frame_out.pBufAddr, pixel_type, w, h, frame)
+            return target, info
+        finally:
+            self.cam.MV_CC_FreeImageBuffer(frame_out)
 
-        buf = ctypes.cast(
-            frame_out.pBufAddr,
-            ctypes.POINTER(ctypes.c_ubyte * (w * h))
-        ).contents
+    def read(self):
+        frame, _ = self._fetch(lambda shape: np.empty(shape, dtype=np.uint8))
+        return frame is not None, frame
 
-        frame = np.frombuffer(buf, dtype=np.uint8).reshape(h, w)
-        self.cam.MV_CC_FreeImageBuffer(frame_out)
-        return True, frame
+    def grab(self, ring: FrameRing) -> bool:
+        reserved = []
+
+        def provider(shape):
+            slot = ring.begin_write(shape, np.uint8)
+            if slot is not None:
+                reserved.append(slot)
+            return slot
+
+        try:
+            slot, _ = self._fetch(provider)
+        except Exception:
+            for s in reserved:
+                ring.abort(s)
+            raise
+        if slot is None:
+            for s in reserved:
+                ring.abort(s)
+            return False
+        ring.commit(slot)
+        return True
+
+    def start_callback(self, ring: FrameRing):
+        """Switch to SDK-driven delivery: every frame is converted into the
+        ring from the SDK callback thread, tagged with its frame number."""
+        self.cam.MV_CC_StopGrabbing()
+        self.cam.MV_CC_SetImageNodeNum(IMAGE_NODE_NUM)
+        self.cam.MV_CC_SetGrabStrategy(MV_GrabStrategy_OneByOne)
+
+        def on_frame(p_data, p_info, p_user):
+            try:
+                info = p_info.contents
+                _deliver_sdk_frame(
+                    ring, ctypes.cast(p_data, ctypes.c_void_p).value, info.enPixelType,
+                    info.nWidth, info.nHeight, info.nFrameLen, info.nFrameNum, time.time()
+                )
+            except Exception as e:
+                logger.error(f"Frame callback error: {e}")
+
+        # Keep a reference so the ctypes thunk outlives this call.
+        self._callback = FRAME_CALLBACK(on_frame)
+        ret = self.cam.MV_CC_RegisterImageCallBackEx(self._callback, None)
+        if ret != 0:
+            self.cam.MV_CC_StartGrabbing()
+            raise RuntimeError(f"MV_CC_RegisterImageCallBackEx failed: {ret:#x}")
+        self.cam.MV_CC_StartGrabbing()
+        logger.info("Hikrobot camera in callback acquisition mode")
 
     def set_exposure(self, value: float):
         self.cam.MV_CC_SetEnumValue("ExposureAuto", MV_EXPOSURE_AUTO_MODE_OFF)
@@ -187,23 +526,30 @@ def _open_camera():
     if _camera_type == "mock":
         return MockCamera()
 
+    if _camera_type == "simulated":
+        return SimulatedCamera()
+
     raise ValueError("Invalid camera type")
 
 def _camera_loop():
-    global _camera, _last_frame, _camera_type
+    global _camera, _camera_type, _callback_active
     logger.info("Camera service started")
     while _running:
         try:
             if _camera is None:
                 _camera = _open_camera()
+                if _acquisition == "callback" and _camera.supports_callback:
+                    _camera.start_callback(_ring)
+                    _callback_active = True
                 time.sleep(0.2)
 
-            ret, frame = _camera.read()
-            if not ret or frame is None:
+            if _callback_active:
+                time.sleep(0.1)
+                continue
+
+            if not _camera.grab(_ring):
                 time.sleep(0.01)
                 continue
-            with _lock:
-                _last_frame = frame
         except Exception as e:
             logger.error(f"Camera error: {e}")
             try:
@@ -213,20 +559,25 @@ def _camera_loop():
                 pass
 
             _camera = None
+            _callback_active = False
             time.sleep(1)
     if _camera:
         _camera.release()
         _camera = None
+    _callback_active = False
 
 
-def start_camera_service(camera_type="hikrobot", device_id=0):
-    global _camera_thread, _running, _camera_type, _device_id
+def start_camera_service(camera_type="hikrobot", device_id=0, acquisition="poll"):
+    """acquisition="callback" lets cameras that support it push frames from
+    the SDK callback instead of being polled by the camera thread."""
+    global _camera_thread, _running, _camera_type, _device_id, _acquisition
 
     if _running:
         return
 
     _camera_type = camera_type
     _device_id = device_id
+    _acquisition = acquisition
     _running = True
 
     _camera_thread = threading.Thread(
@@ -240,13 +591,36 @@ def stop_camera_service():
     _running = False
 
 
-def get_latest_frame() -> Optional[np.ndarray]:
-    with _lock:
-        return None if _last_frame is None else _last_frame.copy()
+def acquire_frame(after_seq: Optional[int] = None, timeout: Optional[float] = None) -> Optional[FrameRef]:
+    """Zero-copy access to the newest frame; release() the result when done."""
+    return _ring.acquire(after_seq, timeout)
 
 
-def capture_frame() -> Optional[np.ndarray]:
-    return get_latest_frame()
+def frame_stats():
+    return _ring.stats()
+
+
+def camera_serial() -> Optional[str]:
+    """Serial of the open camera, None until one is open."""
+    return _camera.serial if _camera is not None else None
+
+
+def get_latest_frame(trace=None, transform=None) -> Optional[np.ndarray]:
+    """Copy of the newest frame. transform(frame) -> new array, e.g. an
+    undistortion, replaces the plain copy out of the ring."""
+    ref = _ring.acquire(timeout=0)
+    if ref is None:
+        return None
+    try:
+        if trace is not None:
+            trace.mark("frame_arrival", ref.timestamp)
+        return ref.frame.copy() if transform is None else transform(ref.frame)
+    finally:
+        ref.release()
+
+
+def capture_frame(trace=None, transform=None) -> Optional[np.ndarray]:
+    return get_latest_frame(trace, transform)
 
 
 def set_exposure(value: float):
@@ -264,6 +638,23 @@ def set_trigger(enable: bool):
         _camera.set_trigger(enable)
 
 
-def software_trigger():
-    if _camera:
-        _camera.software_trigger()
+def software_trigger(trace=None) -> Optional[dict]:
+    """Fire a software trigger. The returned token identifies the frames
+    that can have been produced by it; pass it to wait_for_trigger_frame."""
+    global _trigger_counter
+    if not _camera:
+        return None
+    _trigger_counter += 1
+    token = {"trigger_id": _trigger_counter, "timestamp": time.time(), "after_seq": _ring.latest_seq()}
+    if trace is not None:
+        trace.mark("trigger", token["timestamp"])
+    _camera.software_trigger()
+    return token
+
+
+def wait_for_trigger_frame(token: dict, timeout: float = 1.0, trace=None) -> Optional[FrameRef]:
+    """First ring frame delivered after the trigger, or None on timeout."""
+    ref = _ring.acquire(after_seq=token["after_seq"], timeout=timeout)
+    if ref is not None and trace is not None:
+        trace.mark("frame_arrival", ref.timestamp)
+    return ref
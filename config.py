@@ -18,3 +18,69 @@ MAX_FILE_SIZE_MB = 16
 ALLOWED_EXTENSIONS = {
     'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'tif', 'jfif'
 }
+REFERENCE_INDEX_PATH = os.environ.get(
+    'REFERENCE_INDEX_PATH',
+    os.path.join(os.getcwd(), "trained_data", "reference_index.json")
+)
+INSPECTION_WORKERS = int(os.environ.get('INSPECTION_WORKERS', '2'))
+ACQUIRE_QUEUE_SIZE = int(os.environ.get('ACQUIRE_QUEUE_SIZE', '4'))
+INSPECT_QUEUE_SIZE = int(os.environ.get('INSPECT_QUEUE_SIZE', '8'))
+PERSIST_QUEUE_SIZE = int(os.environ.get('PERSIST_QUEUE_SIZE', '32'))
+INSPECTION_EXECUTOR = os.environ.get('INSPECTION_EXECUTOR', 'thread')
+INSPECTION_PROCESSES = int(os.environ.get('INSPECTION_PROCESSES', str(os.cpu_count() or 1)))
+CAMERA_ACQUISITION = os.environ.get('CAMERA_ACQUISITION', 'poll')
+LATENCY_LOG_PATH = os.environ.get('LATENCY_LOG_PATH', '')
+LATENCY_WINDOW = int(os.environ.get('LATENCY_WINDOW', '2048'))
+INSPECTION_WRITER_BATCH = int(os.environ.get('INSPECTION_WRITER_BATCH', '50'))
+INSPECTION_WRITER_INTERVAL = float(os.environ.get('INSPECTION_WRITER_INTERVAL', '0.5'))
+INSPECTION_WRITER_BUFFER = int(os.environ.get('INSPECTION_WRITER_BUFFER', '1000'))
+INSPECTION_SPOOL_PATH = os.environ.get(
+    'INSPECTION_SPOOL_PATH',
+    os.path.join(os.getcwd(), "spool", "inspections.jsonl")
+)
+INSPECTION_SPOOL_RETRY = float(os.environ.get('INSPECTION_SPOOL_RETRY', '5'))
+VALVE_CSV_PATH = os.environ.get(
+    'VALVE_CSV_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "Valve_Details.csv")
+)
+VALVE_SPEC_SOURCE = os.environ.get('VALVE_SPEC_SOURCE', 'auto')
+VALVE_CATALOG_TTL = float(os.environ.get('VALVE_CATALOG_TTL', '300'))
+MEASUREMENT_MM_PER_PX = float(os.environ.get('MEASUREMENT_MM_PER_PX', '0.125'))
+STATION_ID = os.environ.get('STATION_ID', 'station1')
+CALIBRATION_DIR = os.environ.get(
+    'CALIBRATION_DIR',
+    os.path.join(os.getcwd(), "trained_data", "calibration")
+)
+CALIBRATION_BOARD = os.environ.get('CALIBRATION_BOARD', '9x6')
+CALIBRATION_SQUARE_MM = float(os.environ.get('CALIBRATION_SQUARE_MM', '5.0'))
+CALIBRATION_VIEWS = int(os.environ.get('CALIBRATION_VIEWS', '15'))
+MASTER_DIR = os.environ.get(
+    'MASTER_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "masters")
+)
+MASTER_EDGE_SIZE = int(os.environ.get('MASTER_EDGE_SIZE', '512'))
+MASTER_TOLERANCE_PX = float(os.environ.get('MASTER_TOLERANCE_PX', '2'))
+MASTER_OVERLAP_THRESHOLD = float(os.environ.get('MASTER_OVERLAP_THRESHOLD', '0.90'))
+POSE_ALIGN = os.environ.get('POSE_ALIGN', 'true').lower() in ('1', 'true', 'yes')
+POSE_LEVELS = int(os.environ.get('POSE_LEVELS', '3'))
+POSE_ITERATIONS = int(os.environ.get('POSE_ITERATIONS', '4'))
+POSE_ANGLE_STEP_DEG = float(os.environ.get('POSE_ANGLE_STEP_DEG', '0.5'))
+POSE_MAX_POINTS = int(os.environ.get('POSE_MAX_POINTS', '2000'))
+POSE_TRUNCATE_PX = float(os.environ.get('POSE_TRUNCATE_PX', '8'))
+FRAME_FEATURE_CACHE = int(os.environ.get('FRAME_FEATURE_CACHE', '8'))
+DEFECT_MASK_DIR = os.environ.get(
+    'DEFECT_MASK_DIR',
+    os.path.join(os.getcwd(), "trained_data", "defect_masks")
+)
+DEFECT_MASK_SIZE = int(os.environ.get('DEFECT_MASK_SIZE', '512'))
+DEFECT_SCORE_MIN = float(os.environ.get('DEFECT_SCORE_MIN', '0.05'))
+REGION_MARGIN_PX = float(os.environ.get('REGION_MARGIN_PX', '12'))
+REGION_SENSITIVITY = os.environ.get(
+    'REGION_SENSITIVITY',
+    'head=1.0,seat=1.5,neck=1.0,stem=1.0,groove=1.5,tip=1.0'
+)
+DEFECT_CLASSIFIER_DIR = os.environ.get(
+    'DEFECT_CLASSIFIER_DIR',
+    os.path.join(os.getcwd(), "trained_data", "defect_classifier")
+)
+DEFECT_CLASSIFIER_MIN_CONFIDENCE = float(os.environ.get('DEFECT_CLASSIFIER_MIN_CONFIDENCE', '0.4'))
@@ -1,15 +1,201 @@
 import os
 import time
+import threading
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Any, List, Dict, Tuple
+from typing import Optional, Any, List, Dict, Tuple, Callable
 import pandas as pd
 from werkzeug.security import generate_password_hash, check_password_hash
 import pyodbc
+from latency_trace import span
+from valve_catalog import valve_catalog, normalize_part_number
+
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_IDLE_CHECK = float(os.environ.get("DB_POOL_IDLE_CHECK", "30"))
+
+INSPECTION_COLUMNS = (
+    "Part_number", "Part_name", "Image_name", "ssim_score", "Result",
+    "Best_match", "Defect_type", "Timestamp", "Location", "Shifts",
+    "Core_Hardness_stem", "Crown_Face_runout", "Datum_to_End",
+    "End_Finish", "End_Radius", "Groove_Diameter", "Groove_Chamfer_Angle",
+    "Head_Diameter", "Neck_Diameter", "Overall_Length", "Stem_Diameter",
+    "Seat_Angle", "Surface_Hardness_Nitriding",
+)
+# Lower-case keys in the record dicts map onto the first ten columns.
+INSPECTION_KEYS = (
+    "part_number", "part_name", "image_name", "ssim_score", "result",
+    "best_match", "defect_type", "timestamp", "location", "shifts",
+) + INSPECTION_COLUMNS[10:]
+NUMERIC_COLUMNS = ("ssim_score",) + INSPECTION_COLUMNS[10:]
+# SQL Server allows 2100 parameters per statement.
+INSERT_ROWS_PER_STATEMENT = 2000 // len(INSPECTION_COLUMNS)
+
+
+def inspection_params(data: Dict[str, Any]) -> Tuple[Any, ...]:
+    """Row parameters for an inspections INSERT, with numeric columns coerced."""
+    values = []
+    for key in INSPECTION_KEYS:
+        val = data.get(key)
+        if key == "timestamp":
+            val = val or datetime.now()
+        elif key in NUMERIC_COLUMNS and val is not None and val != "":
+            try:
+                val = float(val)
+            except Exception:
+                pass
+        values.append(val)
+    return tuple(values)
+
+
+class ConnectionPool:
+    """Thread-safe pool of pyodbc connections.
+
+    A connection that sat idle longer than idle_check seconds gets a
+    SELECT 1 before it is handed out; recently used ones are trusted.
+    Connections are rolled back when they come back, so none re-enters
+    the pool with a transaction open (autocommit is off, and even a
+    read-only borrow leaves one running).
+    """
+
+    def __init__(self, connect: Callable[[], pyodbc.Connection], min_size: int = DB_POOL_MIN,
+                 max_size: int = DB_POOL_MAX, timeout: float = DB_POOL_TIMEOUT,
+                 idle_check: float = DB_POOL_IDLE_CHECK):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._idle: deque = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "borrowed": 0, "waited": 0, "timeouts": 0, "created": 0,
+            "discarded": 0, "health_checks": 0, "wait_total": 0.0, "wait_max": 0.0,
+        }
+
+    def fill(self) -> None:
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._create()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _create(self) -> pyodbc.Connection:
+        conn = self._connect()
+        with self._cond:
+            self.stats["created"] += 1
+        return conn
+
+    def healthy(self, conn: pyodbc.Connection) -> bool:
+        """Whether conn still answers a SELECT 1."""
+        with self._cond:
+            self.stats["health_checks"] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1").fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn: pyodbc.Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.stats["discarded"] += 1
+            self._cond.notify()
+
+    def acquire(self, timeout: Optional[float] = None) -> pyodbc.Connection:
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+        while True:
+            create = False
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise TimeoutError("Timed out waiting for a database connection")
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            if create:
+                try:
+                    conn = self._create()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - last_used > self.idle_check and not self.healthy(conn):
+                self._discard(conn)
+                continue
+
+            wait = time.monotonic() - start
+            with self._cond:
+                self.stats["borrowed"] += 1
+                self.stats["waited"] += int(waited)
+                self.stats["wait_total"] += wait
+                self.stats["wait_max"] = max(self.stats["wait_max"], wait)
+            return conn
+
+    def release(self, conn: pyodbc.Connection, broken: bool = False) -> None:
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            borrowed = self.stats["borrowed"]
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "borrowed": borrowed,
+                "waited": self.stats["waited"],
+                "timeouts": self.stats["timeouts"],
+                "created": self.stats["created"],
+                "discarded": self.stats["discarded"],
+                "health_checks": self.stats["health_checks"],
+                "avg_wait_ms": round(1000 * self.stats["wait_total"] / borrowed, 3) if borrowed else 0.0,
+                "max_wait_ms": round(1000 * self.stats["wait_max"], 3),
+            }
 
 
 class DatabaseManager:
     def __init__(self):
-        self.conn: Optional[pyodbc.Connection] = None
         self.conn_str = os.environ.get(
             "DATABASE_URL",
             (
@@ -26,219 +212,261 @@ class DatabaseManager:
             )
         )
 
-    def get_connection(self) -> Optional[pyodbc.Connection]:
-        """Return a live DB connection or None if unable."""
-        if self.conn:
-            try:
-                self.conn.cursor().execute("SELECT 1").fetchone()
-                return self.conn
-            except:
-                self.conn = None
+        self.pool = ConnectionPool(self._connect)
+        self._output_identity = True
+
+    def _connect(self) -> pyodbc.Connection:
+        conn = pyodbc.connect(self.conn_str, autocommit=False)
+        print("[DB] Connected successfully.")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection for the duration of the block.
+
+        Yields None when no connection can be obtained. Whatever the block
+        did not commit is rolled back when the connection is returned; after
+        a block that raises, a connection that fails its health check is
+        dropped.
+        """
+        try:
+            conn = self.pool.acquire()
+        except Exception as e:
+            print(f"[DB] Connection failed: {e}")
+            yield None
+            return
 
-        for attempt in range(3):
+        broken = False
+        try:
+            yield conn
+        except Exception:
             try:
-                self.conn = pyodbc.connect(self.conn_str, autocommit=False)
-                print("[DB] Connected successfully.")
-                return self.conn
-            except Exception as e:
-                print(f"[DB] Connection failed: {e}")
-                time.sleep(1)
-        return None
+                conn.rollback()
+            except Exception:
+                broken = True
+            if not broken:
+                broken = not self.pool.healthy(conn)
+            raise
+        finally:
+            self.pool.release(conn, broken=broken)
 
     def check_connection(self) -> Tuple[bool, str]:
-        conn = self.get_connection()
-        if not conn:
-            return False, "Connection Failed"
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT GETDATE()")
-            server_time = cursor.fetchone()
-            cursor.close()
-            if server_time is None:
-                return False, "No response from server"
-            return True, f"Connected. Server Time: {server_time[0]}"
+            self.pool.fill()
         except Exception as e:
-            return False, f"Check failed: {e}"
+            print(f"[DB] Connection failed: {e}")
+        with self.connection() as conn:
+            if not conn:
+                return False, "Connection Failed"
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT GETDATE()")
+                server_time = cursor.fetchone()
+                cursor.close()
+                if server_time is None:
+                    return False, "No response from server"
+                return True, f"Connected. Server Time: {server_time[0]}"
+            except Exception as e:
+                return False, f"Check failed: {e}"
 
     def get_part_name_from_details(self, part_number: str) -> Optional[str]:
         if not part_number:
             return None
-        conn = self.get_connection()
-        if not conn:
-            return None
-        try:
-            cursor = conn.cursor()
-            query = """
-                SELECT [Part Name]
-                FROM valve_details
-                WHERE LTRIM(RTRIM([Part Number])) = ?
-            """
-            cursor.execute(query, (str(part_number).strip(),))
-            row = cursor.fetchone()
-            cursor.close()
-            return row[0] if row is not None else None
-        except Exception as e:
-            print(f"[DB] get_part_name_from_details ERROR: {e}")
-            return None
+        return valve_catalog.part_name(part_number)
 
-    def insert_inspection(self, data: Dict[str, Any]) -> Any:
-        conn = self.get_connection()
-        if not conn:
-            print("[DB] No connection available")
-            return False
+    def fetch_valve_details(self) -> Optional[List[Dict[str, Any]]]:
+        """Every row of Valve_Details, for the valve catalog to index."""
+        with self.connection() as conn:
+            if not conn:
+                return None
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM Valve_Details")
+                columns = [col[0] for col in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                cursor.close()
+                return rows
+            except Exception as e:
+                print(f"[DB] fetch_valve_details ERROR: {e}")
+                return None
+
+    def insert_inspection(self, data: Dict[str, Any], trace=None) -> Any:
+        with span(trace, "db_insert"):
+            return self._insert_inspection(data)
 
+    def _insert_inspection(self, data: Dict[str, Any]) -> Any:
         part_number = str(data.get("part_number", "")).strip()
         data["part_name"] = self.get_part_name_from_details(part_number) or "Unknown_Part"
 
-        numeric_columns = [
-            "ssim_score", "Core_Hardness_stem", "Crown_Face_runout",
-            "Datum_to_End", "End_Finish", "End_Radius", "Groove_Diameter",
-            "Groove_Chamfer_Angle", "Head_Diameter", "Neck_Diameter",
-            "Overall_Length", "Stem_Diameter", "Seat_Angle",
-            "Surface_Hardness_Nitriding"
-        ]
-        for col in numeric_columns:
-            val = data.get(col)
-            if val is None or val == "":
-                continue
+        with self.connection() as conn:
+            if not conn:
+                print("[DB] No connection available")
+                return False
+
+            query = f"""
+            INSERT INTO inspections ({", ".join(INSPECTION_COLUMNS)})
+            VALUES ({", ".join("?" * len(INSPECTION_COLUMNS))})
+            """
             try:
-                data[col] = float(val)
-            except Exception:
-                pass
+                cursor = conn.cursor()
+                cursor.execute(query, inspection_params(data))
+                conn.commit()
+                cursor.execute("SELECT SCOPE_IDENTITY()")
+                row = cursor.fetchone()
+                cursor.close()
+                return row[0] if row is not None else True
+            except Exception as e:
+                print(f"[DB] insert_inspection ERROR: {e}")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                return False
 
-        query = """
-        INSERT INTO inspections (
-            Part_number, Part_name, Image_name, ssim_score, Result,
-            Best_match, Defect_type, Timestamp, Location, Shifts,
-            Core_Hardness_stem, Crown_Face_runout, Datum_to_End,
-            End_Finish, End_Radius, Groove_Diameter, Groove_Chamfer_Angle,
-            Head_Diameter, Neck_Diameter, Overall_Length, Stem_Diameter,
-            Seat_Angle, Surface_Hardness_Nitriding
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    def write_inspection_batch(self, records: List[Dict[str, Any]]) -> List[Any]:
+        """Insert several inspections in one transaction and return their ids.
+
+        Unlike the other helpers this raises on failure so the caller can
+        tell an outage from a bad row.
         """
-        params = (
-            data.get("part_number"),
-            data.get("part_name"),
-            data.get("image_name"),
-            data.get("ssim_score"),
-            data.get("result"),
-            data.get("best_match"),
-            data.get("defect_type"),
-            data.get("timestamp") or datetime.now(),
-            data.get("location"),
-            data.get("shifts"),
-            data.get("Core_Hardness_stem"),
-            data.get("Crown_Face_runout"),
-            data.get("Datum_to_End"),
-            data.get("End_Finish"),
-            data.get("End_Radius"),
-            data.get("Groove_Diameter"),
-            data.get("Groove_Chamfer_Angle"),
-            data.get("Head_Diameter"),
-            data.get("Neck_Diameter"),
-            data.get("Overall_Length"),
-            data.get("Stem_Diameter"),
-            data.get("Seat_Angle"),
-            data.get("Surface_Hardness_Nitriding"),
-        )
+        part_names = valve_catalog.part_names(r.get("part_number") for r in records)
+        for record in records:
+            record["part_name"] = part_names.get(normalize_part_number(record.get("part_number"))) or "Unknown_Part"
 
-        try:
+        with self.connection() as conn:
+            if not conn:
+                raise ConnectionError("No database connection available")
+
+            params = [inspection_params(r) for r in records]
             cursor = conn.cursor()
-            cursor.execute(query, params)
-            conn.commit()
-            cursor.execute("SELECT SCOPE_IDENTITY()")
-            row = cursor.fetchone()
-            cursor.close()
-            return row[0] if row is not None else True
-        except Exception as e:
-            print(f"[DB] insert_inspection ERROR: {e}")
             try:
-                conn.rollback()
-            except Exception:
-                pass
-            return False
+                ids = self._insert_rows(cursor, params)
+                conn.commit()
+                return ids
+            finally:
+                cursor.close()
+
+    def _insert_rows(self, cursor, params: List[Tuple[Any, ...]]) -> List[Any]:
+        if self._output_identity:
+            try:
+                return self._insert_rows_returning_ids(cursor, params)
+            except pyodbc.ProgrammingError as e:
+                if "identity" not in str(e).lower():
+                    raise
+                # No identity column on this table: ids stay None, as SCOPE_IDENTITY() would return.
+                cursor.connection.rollback()
+                self._output_identity = False
+
+        cursor.fast_executemany = True
+        cursor.executemany(
+            f"INSERT INTO inspections ({', '.join(INSPECTION_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(INSPECTION_COLUMNS))})",
+            params,
+        )
+        return [None] * len(params)
+
+    def _insert_rows_returning_ids(self, cursor, params: List[Tuple[Any, ...]]) -> List[Any]:
+        row_sql = f"({', '.join('?' * len(INSPECTION_COLUMNS))})"
+        image_col = INSPECTION_COLUMNS.index("Image_name")
+        ids: List[Any] = []
+        for i in range(0, len(params), INSERT_ROWS_PER_STATEMENT):
+            chunk = params[i:i + INSERT_ROWS_PER_STATEMENT]
+            cursor.execute(
+                f"INSERT INTO inspections ({', '.join(INSPECTION_COLUMNS)}) "
+                f"OUTPUT INSERTED.$IDENTITY, INSERTED.Image_name "
+                f"VALUES {', '.join([row_sql] * len(chunk))}",
+                [value for row in chunk for value in row],
+            )
+            # OUTPUT row order is not guaranteed; match ids back by image name.
+            by_name: Dict[Any, deque] = {}
+            for row_id, image_name in cursor.fetchall():
+                by_name.setdefault(image_name, deque()).append(row_id)
+            for row in chunk:
+                pending = by_name.get(row[image_col])
+                ids.append(pending.popleft() if pending else None)
+        return ids
 
     def fetch_inspections(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> pd.DataFrame:
-        conn = self.get_connection()
-        if not conn:
-            return pd.DataFrame()
-
-        query = "SELECT * FROM inspections WHERE 1=1"
-        params: List[Any] = []
-        if date_from:
-            query += " AND [Timestamp] >= ?"
-            params.append(date_from)
-        if date_to:
-            query += " AND [Timestamp] <= ?"
-            params.append(date_to)
-        query += " ORDER BY [Timestamp] DESC"
+        with self.connection() as conn:
+            if not conn:
+                return pd.DataFrame()
 
-        try:
-            return pd.read_sql_query(query, conn, params=params)  # type: ignore
-        except Exception as e:
-            print(f"[DB] fetch_inspections ERROR: {e}")
-            return pd.DataFrame()
+            query = "SELECT * FROM inspections WHERE 1=1"
+            params: List[Any] = []
+            if date_from:
+                query += " AND [Timestamp] >= ?"
+                params.append(date_from)
+            if date_to:
+                query += " AND [Timestamp] <= ?"
+                params.append(date_to)
+            query += " ORDER BY [Timestamp] DESC"
+
+            try:
+                return pd.read_sql_query(query, conn, params=params)  # type: ignore
+            except Exception as e:
+                print(f"[DB] fetch_inspections ERROR: {e}")
+                return pd.DataFrame()
 
     def get_recent_inspections(self, limit: int = 10) -> List[Tuple[Any, ...]]:
-        conn = self.get_connection()
-        if not conn:
-            return []
-        try:
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT TOP {limit} * FROM inspections ORDER BY [Timestamp] DESC")
-            rows = cursor.fetchall()
-            cursor.close()
-            return [tuple(row) for row in rows]
-        except Exception as e:
-            print(f"[DB] get_recent_inspections ERROR: {e}")
-            return []
+        with self.connection() as conn:
+            if not conn:
+                return []
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT TOP {limit} * FROM inspections ORDER BY [Timestamp] DESC")
+                rows = cursor.fetchall()
+                cursor.close()
+                return [tuple(row) for row in rows]
+            except Exception as e:
+                print(f"[DB] get_recent_inspections ERROR: {e}")
+                return []
 
     def get_user(self, username: str) -> Optional[Dict[str, Any]]:
-        conn = self.get_connection()
-        if not conn:
-            return None
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM Users WHERE username=?", (username,))
-        row = cur.fetchone()
-        if not row:
+        with self.connection() as conn:
+            if not conn:
+                return None
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM Users WHERE username=?", (username,))
+            row = cur.fetchone()
+            if not row:
+                cur.close()
+                return None
+            cols = [c[0] for c in cur.description]
             cur.close()
-            return None
-        cols = [c[0] for c in cur.description]
-        cur.close()
-        return dict(zip(cols, row))
+            return dict(zip(cols, row))
 
     def create_user(self, username: str, password: str, role: str, location: str, ip: str) -> bool:
-        conn = self.get_connection()
-        if not conn:
-            return False
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO Users (username,password_hash,role,location,allowed_ip) VALUES (?,?,?,?,?)",
-            (username, generate_password_hash(password), role, location, ip)
-        )
-        conn.commit()
-        cur.close()
-        return True
+        with self.connection() as conn:
+            if not conn:
+                return False
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO Users (username,password_hash,role,location,allowed_ip) VALUES (?,?,?,?,?)",
+                (username, generate_password_hash(password), role, location, ip)
+            )
+            conn.commit()
+            cur.close()
+            return True
 
     def approve_user(self, username: str) -> bool:
-        conn = self.get_connection()
-        if not conn:
-            return False
-        cur = conn.cursor()
-        cur.execute("UPDATE Users SET is_active=1 WHERE username=?", (username,))
-        conn.commit()
-        cur.close()
-        return True
+        with self.connection() as conn:
+            if not conn:
+                return False
+            cur = conn.cursor()
+            cur.execute("UPDATE Users SET is_active=1 WHERE username=?", (username,))
+            conn.commit()
+            cur.close()
+            return True
 
     def get_pending_users(self) -> List[Tuple[Any, Any, Any]]:
-        conn = self.get_connection()
-        if not conn:
-            return []
-        cur = conn.cursor()
-        cur.execute("SELECT username, location, role FROM Users WHERE is_active=0")
-        rows = cur.fetchall()
-        cur.close()
-        return [tuple(row) for row in rows]
+        with self.connection() as conn:
+            if not conn:
+                return []
+            cur = conn.cursor()
+            cur.execute("SELECT username, location, role FROM Users WHERE is_active=0")
+            rows = cur.fetchall()
+            cur.close()
+            return [tuple(row) for row in rows]
 
     def fetch_filtered_inspections(
         self,
@@ -247,32 +475,32 @@ class DatabaseManager:
         shift: Optional[str] = None,
         part_number: Optional[str] = None
     ) -> pd.DataFrame:
-        conn = self.get_connection()
-        if not conn:
-            return pd.DataFrame()
-
-        cursor = conn.cursor()
-        query = "SELECT * FROM inspections WHERE [timestamp] >= ?"
-        params: List[Any] = [start_time]
-
-        if location:
-            query += " AND Location = ?"
-            params.append(location)
-        if shift:
-            query += " AND Shifts = ?"
-            params.append(shift)
-        if part_number:
-            query += " AND Part_number = ?"
-            params.append(part_number)
-
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        columns = [col[0] for col in cursor.description]
-
-        data = [dict(zip(columns, row)) for row in rows]
-        df = pd.DataFrame(data)
-        cursor.close()
-        return df
+        with self.connection() as conn:
+            if not conn:
+                return pd.DataFrame()
+
+            cursor = conn.cursor()
+            query = "SELECT * FROM inspections WHERE [timestamp] >= ?"
+            params: List[Any] = [start_time]
+
+            if location:
+                query += " AND Location = ?"
+                params.append(location)
+            if shift:
+                query += " AND Shifts = ?"
+                params.append(shift)
+            if part_number:
+                query += " AND Part_number = ?"
+                params.append(part_number)
+
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            columns = [col[0] for col in cursor.description]
+
+            data = [dict(zip(columns, row)) for row in rows]
+            df = pd.DataFrame(data)
+            cursor.close()
+            return df
 
 db_manager = DatabaseManager()
 connected, message = db_manager.check_connection()
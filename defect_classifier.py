@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from config import DEFECT_FOLDER, DEFECT_CLASSIFIER_DIR, DEFECT_CLASSIFIER_MIN_CONFIDENCE
+from defect_masks import class_images
+from frame_pyramid import FramePyramid
+
+logger = logging.getLogger("defect_classifier")
+
+CLASSIFIER_VERSION = 2
+MODEL_NAME = "model.yml"
+META_NAME = "meta.json"
+
+CROP_SIZE = 64
+# 7x7 blocks of 2x2 cells, 9 orientations: 1764 values per crop.
+HOG = cv2.HOGDescriptor((CROP_SIZE, CROP_SIZE), (16, 16), (8, 8), (8, 8), 9)
+EDGE_BINS = 16
+INTENSITY_BINS = 16
+TREES = 100
+MAX_DEPTH = 12
+# Frames are reduced to the pyramid level just above this side before
+# their features are taken.
+FRAME_SIDE = 4 * CROP_SIZE
+
+
+def _gray(image: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def crop_features(crops: Sequence[np.ndarray]) -> np.ndarray:
+    """One float32 row per crop: HOG, an edge orientation histogram and an
+    intensity histogram of the crop reduced to CROP_SIZE x CROP_SIZE.
+
+    The crops are stacked into one tall image so that HOG runs once for
+    the whole batch, and the histograms are taken for all crops at once.
+    """
+    n = len(crops)
+    tiles = np.empty((n, CROP_SIZE, CROP_SIZE), np.uint8)
+    for i, crop in enumerate(crops):
+        tiles[i] = cv2.resize(np.ascontiguousarray(_gray(crop)), (CROP_SIZE, CROP_SIZE),
+                              interpolation=cv2.INTER_AREA)
+    locations = [(0, i * CROP_SIZE) for i in range(n)]
+    hog = HOG.compute(tiles.reshape(n * CROP_SIZE, CROP_SIZE), locations=locations).reshape(n, -1)
+
+    values = tiles.astype(np.float32)
+    gy, gx = np.gradient(values, axis=(1, 2))
+    magnitude = np.hypot(gx, gy).reshape(n, -1)
+    # Unsigned orientation, so a part and its mirror image read alike.
+    angle = np.mod(np.arctan2(gy, gx), np.pi).reshape(n, -1)
+    bins = np.minimum((angle * (EDGE_BINS / np.pi)).astype(np.intp), EDGE_BINS - 1)
+    rows = np.arange(n)[:, None] * EDGE_BINS
+    edges = np.bincount((rows + bins).reshape(-1), weights=magnitude.reshape(-1),
+                        minlength=n * EDGE_BINS).reshape(n, EDGE_BINS)
+    edges /= edges.sum(axis=1, keepdims=True) + 1e-6
+
+    levels = (tiles.reshape(n, -1) >> 4).astype(np.intp)
+    rows = np.arange(n)[:, None] * INTENSITY_BINS
+    intensity = np.bincount((rows + levels).reshape(-1), minlength=n * INTENSITY_BINS)
+    intensity = intensity.reshape(n, INTENSITY_BINS) / float(CROP_SIZE * CROP_SIZE)
+
+    return np.hstack([hog, edges, intensity]).astype(np.float32)
+
+
+def augment(image: np.ndarray, rng: np.random.Generator) -> List[np.ndarray]:
+    """The image in its eight rotations and mirror images, each whole, with
+    its central 80% and with a random 70% window: 24 training crops."""
+    crops = []
+    for flipped in (image, cv2.flip(image, 1)):
+        for turns in range(4):
+            view = np.rot90(flipped, turns)
+            h, w = view.shape[:2]
+            crops.append(view)
+            crops.append(view[h // 10:h - h // 10, w // 10:w - w // 10])
+            ch, cw = max(1, int(h * 0.7)), max(1, int(w * 0.7))
+            y, x = rng.integers(0, h - ch + 1), rng.integers(0, w - cw + 1)
+            crops.append(view[y:y + ch, x:x + cw])
+    return crops
+
+
+def frame_input(pyramid: FramePyramid) -> np.ndarray:
+    """What the classifier sees of a whole frame: its grey pyramid level
+    just above FRAME_SIDE. Training, evaluation and inspection all go
+    through here, so the model is scored on the input it is given."""
+    return pyramid.gray(pyramid.level_above(FRAME_SIDE, FRAME_SIDE))
+
+
+def _read(path: str) -> np.ndarray:
+    return frame_input(FramePyramid(cv2.imread(path, cv2.IMREAD_COLOR)))
+
+
+def _dataset(dataset: str) -> Dict[str, List[str]]:
+    try:
+        names = sorted(os.listdir(dataset))
+    except OSError:
+        return {}
+    classes = {}
+    for name in names:
+        folder = os.path.join(dataset, name)
+        if os.path.isdir(folder):
+            paths = [p for p in class_images(folder) if cv2.imread(p, cv2.IMREAD_REDUCED_GRAYSCALE_8) is not None]
+            if paths:
+                classes[name] = paths
+    return classes
+
+
+def split(classes: Dict[str, List[str]], holdout: float, seed: int) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    """(train, test) by image, per class. A class with a single image has
+    nothing to hold out and is trained on only."""
+    rng = np.random.default_rng(seed)
+    train, test = {}, {}
+    for name, paths in classes.items():
+        order = rng.permutation(len(paths))
+        count = int(round(len(paths) * holdout)) if len(paths) > 1 else 0
+        count = min(max(count, 1 if len(paths) > 1 else 0), len(paths) - 1)
+        test[name] = [paths[i] for i in order[:count]]
+        train[name] = [paths[i] for i in order[count:]]
+    return train, test
+
+
+def _fit(train: Dict[str, List[str]], names: List[str], seed: int):
+    rng = np.random.default_rng(seed)
+    samples, responses = [], []
+    for index, name in enumerate(names):
+        for path in train.get(name, []):
+            crops = augment(_read(path), rng)
+            samples.append(crop_features(crops))
+            responses.extend([index] * len(crops))
+    model = cv2.ml.RTrees_create()
+    model.setMaxDepth(MAX_DEPTH)
+    model.setMinSampleCount(2)
+    model.setCalculateVarImportance(False)
+    model.setTermCriteria((cv2.TERM_CRITERIA_MAX_ITER, TREES, 0))
+    cv2.setRNGSeed(seed)
+    model.train(np.vstack(samples), cv2.ml.ROW_SAMPLE, np.array(responses, np.int32))
+    return model, len(responses)
+
+
+def _votes(model, samples: np.ndarray, classes: int) -> np.ndarray:
+    """Share of the trees voting for each class, one row per sample."""
+    votes = model.getVotes(samples, 0)
+    # The first row holds the class labels the columns stand for.
+    labels, votes = votes[0], votes[1:].astype(np.float64)
+    shares = np.zeros((samples.shape[0], classes))
+    shares[:, labels] = votes
+    return shares / np.maximum(shares.sum(axis=1, keepdims=True), 1)
+
+
+class DefectClassifier:
+    """Defect class of a frame from a random forest over HOG and edge
+    histogram features, trained offline on the dataset folders
+    (python defect_classifier.py) and loaded once per process. The dataset
+    holds whole-part photographs, so the model classifies whole frames
+    (frame_input), not crops around single defects.
+
+    predict() takes a batch of crops; the features of the whole batch are
+    taken in one pass and the forest is evaluated once.
+    """
+
+    def __init__(self, directory: str = DEFECT_CLASSIFIER_DIR,
+                 min_confidence: float = DEFECT_CLASSIFIER_MIN_CONFIDENCE):
+        self.directory = directory
+        self.min_confidence = min_confidence
+        self.model = None
+        self.classes: List[str] = []
+        self.meta: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def available(self) -> bool:
+        self.ensure_loaded()
+        return self.model is not None
+
+    def load(self) -> bool:
+        with self._lock:
+            self._loaded = True
+            try:
+                with open(os.path.join(self.directory, META_NAME), "r") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"No defect classifier in {self.directory}; run python defect_classifier.py")
+                return False
+            if meta.get("version") != CLASSIFIER_VERSION:
+                logger.warning("Defect classifier was trained by another version; retrain it")
+                return False
+            try:
+                model = cv2.ml.RTrees_load(os.path.join(self.directory, MODEL_NAME))
+            except cv2.error as e:
+                logger.error(f"Defect classifier could not be loaded: {e}")
+                return False
+            self.model, self.classes, self.meta = model, meta["classes"], meta
+            # One prediction here, so the first inspection does not pay for warming up.
+            self.predict([np.zeros((CROP_SIZE, CROP_SIZE), np.uint8)])
+            logger.info(f"Defect classifier ready: {len(self.classes)} classes")
+            return True
+
+    def ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def predict(self, crops: Sequence[np.ndarray]) -> Tuple[List[str], np.ndarray]:
+        """(class, confidence) of every crop; the confidence is the share of
+        trees that voted for the class."""
+        if not crops:
+            return [], np.empty(0)
+        shares = _votes(self.model, crop_features(crops), len(self.classes))
+        best = shares.argmax(axis=1)
+        return [self.classes[i] for i in best], shares[np.arange(len(best)), best]
+
+    def classify(self, crops: Sequence[np.ndarray]) -> Optional[str]:
+        """The class of the first crop, or None below min_confidence."""
+        if not self.available or not crops:
+            return None
+        names, confidence = self.predict(crops[:1])
+        return names[0] if confidence[0] >= self.min_confidence else None
+
+    def train(self, dataset: str = DEFECT_FOLDER, holdout: float = 0.3, seed: int = 0) -> Dict[str, Any]:
+        """Train on the dataset and save the model with its report.
+
+        The report comes from a model trained without a held-out share of
+        each class's images and tested on their eight rotations and mirror
+        images, each prepared by frame_input as an inspected frame is; the
+        saved model is then trained on every image.
+        """
+        classes = _dataset(dataset)
+        if not classes:
+            raise RuntimeError(f"No defect images under {dataset}")
+        names = sorted(classes)
+        train, test = split(classes, holdout, seed)
+        report = evaluate(*_fit(train, names, seed), test, names)
+
+        model, samples = _fit(classes, names, seed)
+        os.makedirs(self.directory, exist_ok=True)
+        model.save(os.path.join(self.directory, MODEL_NAME))
+        meta = {"version": CLASSIFIER_VERSION, "classes": names, "crop_size": CROP_SIZE,
+                "images": {n: len(p) for n, p in classes.items()}, "crops": samples,
+                "trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "report": report}
+        with open(os.path.join(self.directory, META_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
+        self._loaded = False
+        self.load()
+        return report
+
+    def metrics(self) -> Dict[str, Any]:
+        self.ensure_loaded()
+        return {"available": self.model is not None, "classes": self.classes,
+                "min_confidence": self.min_confidence, "trained_at": self.meta.get("trained_at"),
+                "report": self.meta.get("report")}
+
+
+def evaluate(model, train_crops: int, test: Dict[str, List[str]], names: List[str],
+             repeat: int = 200) -> Dict[str, Any]:
+    """Accuracy on the held-out images, as inspected frames, and
+    single-core latency per frame."""
+    crops, truth = [], []
+    for index, name in enumerate(names):
+        for path in test.get(name, []):
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            for flipped in (image, cv2.flip(image, 1)):
+                for turns in range(4):
+                    crops.append(frame_input(FramePyramid(np.ascontiguousarray(np.rot90(flipped, turns)))))
+                    truth.append(index)
+    truth = np.array(truth)
+    per_class = {}
+    accuracy = None
+    if crops:
+        predicted = _votes(model, crop_features(crops), len(names)).argmax(axis=1)
+        accuracy = round(float((predicted == truth).mean()), 4)
+        for index, name in enumerate(names):
+            held = truth == index
+            if held.any():
+                per_class[name] = {"crops": int(held.sum()),
+                                   "accuracy": round(float((predicted[held] == index).mean()), 4)}
+
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        crop = np.full((CROP_SIZE * 3, CROP_SIZE * 3), 128, np.uint8)
+        latency = {}
+        for batch in (1, 16):
+            batch_crops = [crop] * batch
+            samples = []
+            for _ in range(repeat // batch + 5):
+                start = time.perf_counter()
+                _votes(model, crop_features(batch_crops), len(names)).argmax(axis=1)
+                samples.append((time.perf_counter() - start) * 1000 / batch)
+            latency[f"batch_{batch}_ms_per_crop"] = round(float(np.median(samples)), 3)
+    finally:
+        cv2.setNumThreads(threads)
+
+    return {
+        "input": "frame",
+        "held_out_crops": len(crops),
+        "accuracy": accuracy,
+        "per_class": per_class,
+        "not_held_out": [n for n in names if n not in per_class],
+        "train_crops": train_crops,
+        "latency": latency,
+    }
+
+
+defect_classifier = DefectClassifier()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python defect_classifier.py [dataset]: train, save and print the report.
+    logging.basicConfig(level=logging.INFO)
+    result = defect_classifier.train(sys.argv[1] if len(sys.argv) > 1 else DEFECT_FOLDER)
+    print(f"held-out accuracy {result['accuracy']} over {result['held_out_crops']} crops")
+    for name, row in result["per_class"].items():
+        print(f"  {name:24s} {row['accuracy']:.2f} ({row['crops']} crops)")
+    if result["not_held_out"]:
+        print("  single image, not held out:", ", ".join(result["not_held_out"]))
+    for name, value in result["latency"].items():
+        print(f"{name}: {value} ms (one core)")
+    print("model in", defect_classifier.directory)
@@ -1,74 +1,171 @@
+from typing import Any, Dict, Optional
+
 import cv2
 import numpy as np
-import os
+from config import DEFECT_SCORE_MIN
+from blob_analysis import analyze_blobs, render_blobs
+from defect_classifier import defect_classifier, frame_input
+from defect_masks import CLOSE_KERNEL, DefectMaskStore, defect_masks, image_residue
+from frame_features import frame_features
+from measurement_engine import extract_profile
+from valve_regions import REGION_NAMES, RegionMap, region_sensitivity
 
-DATASET_PATH = r"D:\C102641-Data\copy_folder\Valve_Final_Inspection - Copy\dataset"
 MIN_DEFECT_AREA = 150
 
 
 class DefectDetector:
-    def __init__(self):
-        self.reference_mask = self._build_reference_mask()
-
-    def _build_reference_mask(self):
-        acc = None
-        count = 0
-
-        for file in os.listdir(DATASET_PATH):
-            if not file.lower().endswith((".jpg", ".png", ".bmp")):
-                continue
-
-            img = cv2.imread(os.path.join(DATASET_PATH, file), cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                continue
-
-            _, binary = cv2.threshold(
-                img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
-            )
-
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
-            body = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
-
-            defect = cv2.subtract(binary, body)
-
-            if acc is None:
-                acc = defect.astype(np.float32)
+    """Multi-class surface defect check against the reference mask of every
+    defect class. The masks are built offline (python defect_masks.py) and
+    only mapped here, so constructing a detector does not read the
+    dataset."""
+
+    def __init__(self, store: DefectMaskStore = defect_masks, min_area: int = MIN_DEFECT_AREA,
+                 min_score: float = DEFECT_SCORE_MIN):
+        self.store = store
+        self.min_area = min_area
+        self.min_score = min_score
+
+    @property
+    def available(self) -> bool:
+        return bool(self.store.masks())
+
+    @property
+    def reference_mask(self):
+        """All class masks combined, at the store's mask size."""
+        return np.maximum.reduce([np.asarray(m) for m in self.store.masks().values()])
+
+    def detect(self, frame, regions: Optional[RegionMap] = None) -> Dict[str, Any]:
+        """Score every defect class in one pass over the frame's blobs.
+
+        The frame's residue is taken at the mask size, as the masks were.
+        The blobs are the parts of it that any class mask marks, opened
+        with a 3x3 kernel, and analysed into one BLOB_DTYPE row each. A
+        blob's score for a class is the mean of that class's mask over the
+        blob (0..1), read for all blobs and classes at once. Each blob of
+        min_area frame pixels or more goes to its best class if that score
+        reaches min_score.
+
+        With the part's regions (valve_regions.RegionMap) only the box
+        around them is searched, blobs outside them are dropped, and each
+        blob takes the region most of it lies in. Its area and score are
+        then weighed by that region's sensitivity (REGION_SENSITIVITY)
+        before the limits are applied; a sensitivity of 0 turns a region's
+        check off.
+
+        blobs holds the rows of those blobs. classes maps every class to
+        its best blob score, its blobs' boxes (x, y, w, h in frame pixels)
+        and their area. defect_type is the class with the largest area, or
+        "OK".
+
+        roi is the box searched, in frame pixels.
+
+        frame is the image or its FrameFeatures bundle; it is not drawn on.
+        """
+        if not self.available:
+            raise RuntimeError("No defect masks; run python defect_masks.py on the dataset folder")
+        features = frame_features(frame)
+        pyramid = features.pyramid
+        names, stack, union = self.store.stack()
+        size = self.store.size
+        gray = cv2.resize(pyramid.gray(pyramid.level_above(size, size)), (size, size),
+                          interpolation=cv2.INTER_AREA)
+        scale = (pyramid.shape[1] / size, pyramid.shape[0] / size)
+
+        x, y, w, h = 0, 0, size, size
+        region_labels = regions.grid(size, size) if regions is not None else None
+        if region_labels is not None:
+            x, y, w, h = cv2.boundingRect(region_labels)
+            if w == 0 or h == 0:
+                region_labels = None
+                x, y, w, h = 0, 0, size, size
             else:
-                acc += defect
-
-            count += 1
-
-        if count == 0:
-            raise RuntimeError("No defect images found in dataset folder")
-
-        return (acc / count).astype(np.uint8)
-
-    def inspect(self, frame):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        _, binary = cv2.threshold(
-            gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
-        )
-
-        defect_mask = cv2.bitwise_and(binary, self.reference_mask)
-
+                # Leave room for the close that finds the notches at the box's edge.
+                pad = CLOSE_KERNEL[0]
+                x, y = max(0, x - pad), max(0, y - pad)
+                w, h = min(size, x + w + 2 * pad) - x, min(size, y + h + 2 * pad) - y
+        window = (slice(y, y + h), slice(x, x + w))
+        live = image_residue(gray[window])
+
+        candidates = cv2.bitwise_and(live, union[window])
+        if region_labels is not None:
+            region_labels = region_labels[window]
+            candidates[region_labels == 0] = 0
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-        defect_mask = cv2.morphologyEx(defect_mask, cv2.MORPH_OPEN, kernel)
-
-        contours, _ = cv2.findContours(
-            defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
-
-        defect_found = False
-
-        for cnt in contours:
-            if cv2.contourArea(cnt) > MIN_DEFECT_AREA:
-                x, y, w, h = cv2.boundingRect(cnt)
-                cv2.rectangle(frame, (x, y), (x + w, y + h),
-                              (0, 0, 255), 2)
-                defect_found = True
-
-        result = "Rejected" if defect_found else "Accepted"
-        defect_type = "Surface Defect" if defect_found else "OK"
-
-        return result, defect_type, frame
+        candidates = cv2.morphologyEx(candidates, cv2.MORPH_OPEN, kernel)
+        if region_labels is not None:
+            blobs, labels = analyze_blobs(candidates, gray[window], scale, offset=(x, y),
+                                          region_labels=region_labels, region_names=REGION_NAMES)
+        else:
+            profile = extract_profile(features.frame, bands={}, pyramid=pyramid)
+            blobs, labels = analyze_blobs(candidates, gray, scale, profile)
+
+        classes = {name: {"score": 0.0, "boxes": [], "area": 0} for name in names}
+        roi = [int(x * scale[0]), int(y * scale[1]), int(np.ceil(w * scale[0])), int(np.ceil(h * scale[1]))]
+        report = {"defect_found": False, "defect_type": "OK", "classes": classes, "blobs": blobs[:0],
+                  "roi": roi}
+        if blobs.size == 0:
+            return report
+
+        # Mask values under every blob pixel, grouped by blob, summed per class.
+        flat = labels.reshape(-1)
+        pixels = np.flatnonzero(flat)
+        pixels = pixels[np.argsort(flat[pixels], kind="stable")]
+        starts = np.searchsorted(flat[pixels], blobs["label"])
+        rows, cols = np.divmod(pixels, w)
+        values = stack.reshape(-1, len(names))[(rows + y) * size + cols + x]
+        sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+        scores = sums / (255.0 * np.diff(np.append(starts, pixels.size))[:, None])
+
+        best = scores.argmax(axis=1)
+        blobs["score"] = scores[np.arange(len(best)), best]
+        blobs["defect_class"] = np.asarray(names)[best]
+        found, inverse = np.unique(blobs["region"], return_inverse=True)
+        weight = np.array([region_sensitivity.get(str(r), 1.0) for r in found])[inverse.reshape(-1)]
+        kept = ((weight > 0) & (blobs["area"] * weight >= self.min_area)
+                & (blobs["score"] * weight >= self.min_score))
+        report["blobs"] = blobs[kept]
+        if not kept.any():
+            return report
+
+        class_scores = np.where(kept[:, None], scores, 0.0).max(axis=0)
+        class_areas = np.bincount(best[kept], weights=blobs["area"][kept], minlength=len(names))
+        for i, name in enumerate(names):
+            classes[name]["score"] = round(float(class_scores[i]), 4)
+            classes[name]["area"] = int(class_areas[i])
+        for b in report["blobs"]:
+            classes[str(b["defect_class"])]["boxes"].append(
+                [int(b["x"]), int(b["y"]), int(b["w"]), int(b["h"])])
+
+        report["defect_found"] = True
+        report["defect_type"] = names[int(np.argmax(class_areas))]
+        return report
+
+    def inspect(self, frame, annotate: bool = False, regions: Optional[RegionMap] = None):
+        """(result, defect_type, image). With annotate the image is a copy
+        of the frame with the defects boxed; otherwise the frame itself,
+        untouched."""
+        features = frame_features(frame)
+        report = self.detect(features, regions)
+        image = render_blobs(features.frame, report["blobs"]) if annotate else features.frame
+
+        result = "Rejected" if report["defect_found"] else "Accepted"
+        return result, report["defect_type"], image
+
+
+defect_detector = DefectDetector()
+
+
+def classify_defect(frame, fallback: str, regions: Optional[RegionMap] = None) -> str:
+    """The defect class of a rejected part.
+
+    The trained classifier names it from the whole frame, the input it was
+    trained and scored on. When the classifier is unsure or not trained, the
+    mask detector's class is used (found within the part's regions when
+    they are given), and fallback when neither gives an answer.
+    """
+    features = frame_features(frame)
+    learned = defect_classifier.classify([frame_input(features.pyramid)])
+    if learned is not None:
+        return learned
+    report = defect_detector.detect(features, regions) if defect_detector.available else None
+    return report["defect_type"] if report is not None and report["defect_found"] else fallback
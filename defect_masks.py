@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import DEFECT_FOLDER, DEFECT_MASK_DIR, DEFECT_MASK_SIZE
+
+logger = logging.getLogger("defect_masks")
+
+MASK_VERSION = 2
+MANIFEST_NAME = "manifest.json"
+CLOSE_KERNEL = (15, 15)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".jfif", ".tiff", ".tif", ".bmp")
+
+
+def class_images(folder: str) -> List[str]:
+    """Image files of one defect class folder, in a stable order."""
+    try:
+        names = sorted(os.listdir(folder))
+    except OSError:
+        return []
+    return [os.path.join(folder, n) for n in names if n.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def content_hash(paths: List[str], size: int = DEFECT_MASK_SIZE) -> str:
+    """SHA-256 of the images' names and bytes and of the build settings, so
+    a mask is rebuilt when an input or the way it is built changes."""
+    digest = hashlib.sha256(f"{MASK_VERSION}:{size}:{CLOSE_KERNEL}".encode())
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def residue(image: np.ndarray, size: int = DEFECT_MASK_SIZE) -> np.ndarray:
+    """What a 15x15 close adds to the Otsu silhouette: the gaps and notches
+    a defect leaves in the part, at size x size."""
+    return image_residue(cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA))
+
+
+def image_residue(image: np.ndarray) -> np.ndarray:
+    """residue() of a grey image at its own size.
+
+    The part is whichever Otsu class covers less of the image border, so
+    dark parts on a light table and light parts on a dark one both come
+    out as foreground.
+    """
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    border = np.concatenate([binary[0], binary[-1], binary[:, 0], binary[:, -1]])
+    if np.count_nonzero(border) > border.size // 2:
+        binary = cv2.bitwise_not(binary)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, CLOSE_KERNEL)
+    body = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+    return cv2.subtract(body, binary)
+
+
+def build_mask(paths: List[str], size: int = DEFECT_MASK_SIZE) -> Tuple[Optional[np.ndarray], int]:
+    """Average residue of the readable images. Returns (mask, images used)."""
+    acc = np.zeros((size, size), np.float32)
+    count = 0
+    for path in paths:
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            logger.warning(f"Defect image unreadable: {path}")
+            continue
+        acc += residue(image, size)
+        count += 1
+    if count == 0:
+        return None, 0
+    return (acc / count).astype(np.uint8), count
+
+
+class DefectMaskStore:
+    """One reference mask per defect class (the subfolders of the dataset),
+    built offline and memory-mapped when the inspection code starts.
+
+    Each mask is saved as {class}-{hash}.npy next to a manifest holding the
+    content hash of its inputs and their mtimes and sizes. load() only
+    stats the dataset: a class whose files look unchanged is mapped as it
+    is, and one that changed is re-hashed and rebuilt only if its hash
+    differs.
+    """
+
+    def __init__(self, dataset: str = DEFECT_FOLDER, directory: str = DEFECT_MASK_DIR,
+                 size: int = DEFECT_MASK_SIZE):
+        self.dataset = dataset
+        self.directory = directory
+        self.size = size
+        self._masks: Dict[str, np.ndarray] = {}
+        self._stack: Optional[Tuple[List[str], np.ndarray, np.ndarray]] = None
+        self._manifest: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.builds = 0
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def classes(self) -> List[str]:
+        try:
+            names = sorted(os.listdir(self.dataset))
+        except OSError:
+            return []
+        return [n for n in names if os.path.isdir(os.path.join(self.dataset, n))]
+
+    @staticmethod
+    def _stats(paths: List[str]) -> Dict[str, List[float]]:
+        stats = {}
+        for path in paths:
+            st = os.stat(path)
+            stats[os.path.basename(path)] = [st.st_mtime, st.st_size]
+        return stats
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != MASK_VERSION or manifest.get("size") != self.size:
+            return {}
+        return manifest.get("classes", {})
+
+    def _write_manifest(self, classes: Dict[str, Any]) -> None:
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": MASK_VERSION, "size": self.size, "classes": classes}, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def build(self, force: bool = False) -> Dict[str, str]:
+        """Bring every class mask in line with the dataset. Returns what was
+        done per class: 'current', 'built' or 'empty'."""
+        with self._lock:
+            return self._build(force)
+
+    def _build(self, force: bool) -> Dict[str, str]:
+        previous = self._read_manifest()
+        if not os.path.isdir(self.dataset):
+            # A station without the dataset runs on the masks built elsewhere.
+            logger.warning(f"Defect dataset not found: {self.dataset}; using the saved masks")
+            self._map(previous)
+            return {name: "current" for name in previous}
+        os.makedirs(self.directory, exist_ok=True)
+        classes, outcome = {}, {}
+        for name in self.classes():
+            paths = class_images(os.path.join(self.dataset, name))
+            stats = self._stats(paths)
+            entry = previous.get(name)
+            current = (entry is not None and not force
+                       and os.path.exists(os.path.join(self.directory, entry["file"])))
+            if current and entry["files"] != stats:
+                # Touched or replaced files: only a different hash means a new mask.
+                digest = content_hash(paths, self.size)
+                current = digest == entry["hash"]
+                if current:
+                    entry = dict(entry, files=stats)
+            if current:
+                classes[name] = entry
+                outcome[name] = "current"
+                continue
+
+            digest = content_hash(paths, self.size)
+            mask, count = build_mask(paths, self.size)
+            if mask is None:
+                outcome[name] = "empty"
+                continue
+            filename = f"{name}-{digest[:16]}.npy"
+            tmp = os.path.join(self.directory, filename + ".tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, mask)
+            os.replace(tmp, os.path.join(self.directory, filename))
+            if entry is not None and entry["file"] != filename:
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except OSError:
+                    pass
+            classes[name] = {"hash": digest, "file": filename, "images": count, "files": stats}
+            outcome[name] = "built"
+            self.builds += 1
+            logger.info(f"Built defect mask {name} from {count} images")
+
+        for name, entry in previous.items():
+            if name not in classes:
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except OSError:
+                    pass
+
+        self._write_manifest(classes)
+        self._map(classes)
+        return outcome
+
+    def _map(self, classes: Dict[str, Any]) -> None:
+        masks = {}
+        for name, entry in classes.items():
+            try:
+                masks[name] = np.load(os.path.join(self.directory, entry["file"]), mmap_mode="r")
+            except (OSError, ValueError) as e:
+                logger.error(f"Defect mask {name} could not be mapped: {e}")
+        self._masks = masks
+        self._manifest = classes
+        self._stack = None
+        self._loaded = True
+
+    def load(self) -> None:
+        """Map the masks, rebuilding only the classes whose inputs changed."""
+        self.build()
+        logger.info(f"Defect masks ready: {len(self._masks)} classes")
+
+    def map_saved(self) -> None:
+        """Map the masks the manifest lists, without checking or rebuilding
+        anything, for processes that must not write the mask directory."""
+        with self._lock:
+            self._map(self._read_manifest())
+
+    def ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def masks(self) -> Dict[str, np.ndarray]:
+        self.ensure_loaded()
+        return self._masks
+
+    def stack(self) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """(class names, masks, union): the class masks stacked along the
+        last axis, and the pixels any class marks. Built once per load."""
+        self.ensure_loaded()
+        entry = self._stack
+        if entry is None:
+            names = sorted(self._masks)
+            stack = np.dstack([np.asarray(self._masks[n]) for n in names])
+            entry = (names, stack, stack.max(axis=2))
+            self._stack = entry
+        return entry
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "classes": {name: {"hash": e["hash"][:16], "images": e["images"]}
+                        for name, e in self._manifest.items()},
+            "size": self.size,
+            "builds": self.builds,
+        }
+
+
+defect_masks = DefectMaskStore()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python defect_masks.py [--force]: build the class masks offline.
+    logging.basicConfig(level=logging.INFO)
+    result = defect_masks.build(force="--force" in sys.argv[1:])
+    for name, status in result.items():
+        print(f"{name:24s} {status}")
+    print("masks in", defect_masks.directory)
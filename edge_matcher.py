@@ -0,0 +1,128 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+HU_EPSILON = 1e-10
+
+# Same weights as image_processing.compare_edge_features.
+SCORE_WEIGHTS = {
+    "area": 0.20,
+    "perimeter": 0.15,
+    "solidity": 0.15,
+    "aspect_ratio": 0.15,
+    "extent": 0.10,
+    "hu": 0.25,
+}
+
+REFERENCE_DTYPE = np.dtype([
+    ("area", np.float64),
+    ("perimeter", np.float64),
+    ("solidity", np.float64),
+    ("aspect_ratio", np.float64),
+    ("extent", np.float64),
+    ("hu_log", np.float64, (7,)),
+])
+
+
+def hu_log(hu_moments):
+    hu = np.asarray(hu_moments, dtype=np.float64)
+    return np.sign(hu) * np.log10(np.abs(hu) + HU_EPSILON)
+
+
+def normalize_part_number(part_number) -> str:
+    return str(part_number).strip()
+
+
+def _ratio(test_value, ref_values):
+    lo = np.minimum(test_value, ref_values)
+    hi = np.maximum(test_value, ref_values)
+    out = np.zeros_like(hi)
+    np.divide(lo, hi, out=out, where=hi > 0)
+    return out
+
+
+class EdgeMatcher:
+    """Scores one test feature dict against every reference in a single
+    vectorized pass. The score is the weighted formula of
+    compare_edge_features, evaluated column-wise over a structured array.
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]]):
+        self.table = np.zeros(len(entries), dtype=REFERENCE_DTYPE)
+        self.names = np.array([e["name"] for e in entries], dtype=object)
+        self.subfolders = np.array([e["subfolder"] for e in entries], dtype=object)
+        self.features = [e["features"] for e in entries]
+
+        self.part_rows: Dict[str, np.ndarray] = {}
+        for part in dict.fromkeys(self.subfolders):
+            self.part_rows[part] = np.flatnonzero(self.subfolders == part)
+
+        for i, f in enumerate(self.features):
+            self.table[i] = (
+                f["area"], f["perimeter"], f["solidity"],
+                f["aspect_ratio"], f["extent"], hu_log(f["hu_moments"]),
+            )
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def has_part(self, part_number: Optional[str]) -> bool:
+        return normalize_part_number(part_number) in self.part_rows
+
+    def _rows(self, part_number: Optional[str]) -> np.ndarray:
+        if part_number is None:
+            return np.arange(len(self.table))
+        return self.part_rows.get(normalize_part_number(part_number), np.empty(0, dtype=np.intp))
+
+    def score(self, test_features: Optional[Dict[str, Any]],
+              part_number: Optional[str] = None) -> np.ndarray:
+        """Scores for every reference, or only for the rows of one part."""
+        rows = self._rows(part_number)
+        if not test_features or rows.size == 0:
+            return np.zeros(rows.size, dtype=np.float64)
+
+        t = self.table if part_number is None else self.table[rows]
+        area_ratio = _ratio(test_features["area"], t["area"])
+        perimeter_ratio = _ratio(test_features["perimeter"], t["perimeter"])
+        solidity_diff = 1 - np.abs(test_features["solidity"] - t["solidity"])
+        aspect_diff = 1 - np.minimum(np.abs(test_features["aspect_ratio"] - t["aspect_ratio"]), 1.0)
+        extent_diff = 1 - np.abs(test_features["extent"] - t["extent"])
+
+        hu_distance = np.sum(np.abs(hu_log(test_features["hu_moments"]) - t["hu_log"]), axis=1)
+        hu_score = np.maximum(0, 1 - hu_distance / 10)
+
+        w = SCORE_WEIGHTS
+        return (
+            w["area"] * area_ratio +
+            w["perimeter"] * perimeter_ratio +
+            w["solidity"] * solidity_diff +
+            w["aspect_ratio"] * aspect_diff +
+            w["extent"] * extent_diff +
+            w["hu"] * hu_score
+        )
+
+    def top_k(self, test_features: Optional[Dict[str, Any]], k: int = 1,
+              part_number: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Best k references with a positive score, highest first.
+
+        Ties keep reference order, so k=1 picks the same reference as the
+        original first-strictly-greater loop. With part_number only that
+        part's references are scored.
+        """
+        rows = self._rows(part_number)
+        scores = self.score(test_features, part_number)
+        if scores.size == 0:
+            return []
+
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [
+            {
+                "score": float(scores[j]),
+                "best_match": self.names[i],
+                "subfolder": self.subfolders[i],
+                "part_number": self.subfolders[i],
+                "features": self.features[i],
+            }
+            for j, i in zip(order, rows[order])
+            if scores[j] > 0
+        ]
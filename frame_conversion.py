@@ -0,0 +1,106 @@
+import ctypes
+import time
+
+import cv2
+import numpy as np
+
+from hik_cam.PixelType_header import (
+    PixelType_Gvsp_Mono8,
+    PixelType_Gvsp_BayerGR8,
+    PixelType_Gvsp_BayerRG8,
+    PixelType_Gvsp_BayerGB8,
+    PixelType_Gvsp_BayerBG8,
+    PixelType_Gvsp_RGB8_Packed,
+    PixelType_Gvsp_BGR8_Packed,
+)
+
+# pixel type -> (source channels, cvtColor code or None for a plain copy).
+# Output is always 3-channel BGR, which is what the inspection code expects.
+CONVERSIONS = {
+    PixelType_Gvsp_Mono8: (1, cv2.COLOR_GRAY2BGR),
+    PixelType_Gvsp_BayerRG8: (1, cv2.COLOR_BayerRGGB2BGR),
+    PixelType_Gvsp_BayerBG8: (1, cv2.COLOR_BayerBGGR2BGR),
+    PixelType_Gvsp_BayerGR8: (1, cv2.COLOR_BayerGRBG2BGR),
+    PixelType_Gvsp_BayerGB8: (1, cv2.COLOR_BayerGBRG2BGR),
+    PixelType_Gvsp_RGB8_Packed: (3, cv2.COLOR_RGB2BGR),
+    PixelType_Gvsp_BGR8_Packed: (3, None),
+}
+
+PIXEL_TYPE_NAMES = {
+    PixelType_Gvsp_Mono8: "Mono8",
+    PixelType_Gvsp_BayerRG8: "BayerRG8",
+    PixelType_Gvsp_BayerBG8: "BayerBG8",
+    PixelType_Gvsp_BayerGR8: "BayerGR8",
+    PixelType_Gvsp_BayerGB8: "BayerGB8",
+    PixelType_Gvsp_RGB8_Packed: "RGB8",
+    PixelType_Gvsp_BGR8_Packed: "BGR8",
+}
+
+
+def is_supported(pixel_type) -> bool:
+    return pixel_type in CONVERSIONS
+
+
+def source_bytes(pixel_type, width, height) -> int:
+    return width * height * CONVERSIONS[pixel_type][0]
+
+
+def output_shape(width, height):
+    return (height, width, 3)
+
+
+def source_view(address, pixel_type, width, height) -> np.ndarray:
+    """NumPy view over an SDK frame buffer. No copy; only valid until the
+    buffer is handed back to the SDK."""
+    channels = CONVERSIONS[pixel_type][0]
+    raw = (ctypes.c_ubyte * (width * height * channels)).from_address(address)
+    view = np.ctypeslib.as_array(raw)
+    return view.reshape((height, width) if channels == 1 else (height, width, channels))
+
+
+def convert_into(src: np.ndarray, pixel_type, out: np.ndarray) -> np.ndarray:
+    """Convert/demosaic src straight into the preallocated BGR buffer out.
+    This is the only copy a frame goes through."""
+    code = CONVERSIONS[pixel_type][1]
+    if code is None:
+        np.copyto(out, src)
+    else:
+        cv2.cvtColor(src, code, dst=out)
+    return out
+
+
+def convert_sdk_frame(address, pixel_type, width, height, out: np.ndarray) -> np.ndarray:
+    return convert_into(source_view(address, pixel_type, width, height), pixel_type, out)
+
+
+def benchmark(width=2448, height=2048, frames=50):
+    """Per-format throughput of convert_sdk_frame over synthetic buffers."""
+    rng = np.random.default_rng(0)
+    out = np.empty(output_shape(width, height), dtype=np.uint8)
+    results = {}
+    for pixel_type, name in PIXEL_TYPE_NAMES.items():
+        n = source_bytes(pixel_type, width, height)
+        raw = (ctypes.c_ubyte * n)()
+        np.ctypeslib.as_array(raw)[:] = rng.integers(0, 256, n, dtype=np.uint8)
+        address = ctypes.addressof(raw)
+
+        convert_sdk_frame(address, pixel_type, width, height, out)
+        start = time.perf_counter()
+        for _ in range(frames):
+            convert_sdk_frame(address, pixel_type, width, height, out)
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            "ms_per_frame": 1000 * elapsed / frames,
+            "mb_per_s": n * frames / elapsed / 1e6,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    w, h = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (2448, 2048)
+    print(f"Frame conversion benchmark ({w}x{h}, single copy into preallocated BGR buffer)")
+    for name, r in benchmark(w, h).items():
+        print(f"{name:10s} {r['ms_per_frame']:8.3f} ms/frame {r['mb_per_s']:10.1f} MB/s")
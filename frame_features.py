@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+from functools import cached_property
+from typing import Any, Dict, Hashable, Optional, Union
+
+import cv2
+import numpy as np
+
+from config import FRAME_FEATURE_CACHE
+from frame_pyramid import FramePyramid
+
+EDGE_LOW = 50
+EDGE_HIGH = 150
+
+
+class FrameFeatures:
+    """Everything the inspection stages derive from one captured frame.
+
+    Each property is computed on first use and kept, so a frame that goes
+    through classification, master matching, measurement and the defect
+    check is converted, blurred, thresholded and edge-traced only once.
+    Full-resolution maps come from level 0 of the frame's pyramid; the
+    classifier's edges, and the contour, moments and hull taken from them,
+    come from the coarse level that covers image_processing.IMAGE_SIZE.
+    """
+
+    def __init__(self, frame: np.ndarray, frame_id: Optional[Hashable] = None):
+        self.frame = frame
+        self.frame_id = frame_id
+        self.pyramid = FramePyramid(frame, frame_id)
+
+    @property
+    def shape(self):
+        return self.frame.shape
+
+    @property
+    def gray(self) -> np.ndarray:
+        return self.pyramid.gray(0)
+
+    @property
+    def blurred(self) -> np.ndarray:
+        return self.pyramid.blurred(0)
+
+    @property
+    def edges(self) -> np.ndarray:
+        return self.pyramid.edges(0, EDGE_LOW, EDGE_HIGH)
+
+    @cached_property
+    def mask(self) -> np.ndarray:
+        """Otsu threshold of the grey frame."""
+        _, binary = cv2.threshold(self.gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return binary
+
+    @cached_property
+    def class_edges(self) -> np.ndarray:
+        """The classifier's edge map, at image_processing.IMAGE_SIZE."""
+        from image_processing import IMAGE_SIZE, detect_edges
+
+        return detect_edges(self.pyramid.gray(self.pyramid.level_above(*IMAGE_SIZE)))
+
+    @cached_property
+    def contour(self) -> Optional[np.ndarray]:
+        """Largest outer contour of the classifier's edge map."""
+        contours, _ = cv2.findContours(self.class_edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return None
+        return max(contours, key=cv2.contourArea)
+
+    @cached_property
+    def moments(self) -> Optional[Dict[str, float]]:
+        return None if self.contour is None else cv2.moments(self.contour)
+
+    @cached_property
+    def hull(self) -> Optional[np.ndarray]:
+        return None if self.contour is None else cv2.convexHull(self.contour)
+
+    @cached_property
+    def edge_features(self) -> Optional[Dict[str, Any]]:
+        """image_processing.extract_edge_features of the classifier's edges."""
+        from image_processing import contour_features
+
+        if self.contour is None:
+            return None
+        return contour_features(self.contour, self.moments, self.hull)
+
+
+class FrameFeatureCache:
+    """The bundles of the most recent frames, keyed by frame ID, so every
+    stage that handles the same frame shares one bundle.
+
+    A cached bundle is only returned for the very array it was built from;
+    a frame ID that comes back with another image gets a new one.
+    """
+
+    def __init__(self, capacity: int = FRAME_FEATURE_CACHE):
+        self.capacity = capacity
+        self._bundles: "OrderedDict[Hashable, FrameFeatures]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame: np.ndarray, frame_id: Optional[Hashable] = None) -> FrameFeatures:
+        """The frame's bundle; without a frame ID a fresh, uncached one."""
+        if frame_id is None:
+            return FrameFeatures(frame)
+        with self._lock:
+            bundle = self._bundles.get(frame_id)
+            if bundle is not None and bundle.frame is frame:
+                self._bundles.move_to_end(frame_id)
+                self.hits += 1
+                return bundle
+            bundle = FrameFeatures(frame, frame_id)
+            self._bundles[frame_id] = bundle
+            self._bundles.move_to_end(frame_id)
+            while len(self._bundles) > self.capacity:
+                self._bundles.popitem(last=False)
+            self.misses += 1
+            return bundle
+
+    def discard(self, frame_id: Hashable) -> None:
+        with self._lock:
+            self._bundles.pop(frame_id, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"frames": len(self._bundles), "capacity": self.capacity,
+                    "hits": self.hits, "misses": self.misses}
+
+
+frame_feature_cache = FrameFeatureCache()
+
+
+def frame_features(frame: Union[np.ndarray, FrameFeatures],
+                   frame_id: Optional[Hashable] = None) -> FrameFeatures:
+    """The bundle for a frame; a bundle passed in is returned as it is."""
+    if isinstance(frame, FrameFeatures):
+        return frame
+    return frame_feature_cache.get(frame, frame_id)
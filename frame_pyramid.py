@@ -0,0 +1,89 @@
+import threading
+from typing import Dict, Hashable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+BLUR_KERNEL = (5, 5)
+MIN_LEVEL_SIDE = 8
+
+
+class FramePyramid:
+    """Grey, blurred and edge maps of one frame at successive halvings.
+
+    Level 0 is the frame's own resolution and level i is 2**i times smaller.
+    Every map is built on first use and kept, so stages that share a
+    pyramid never convert, reduce or blur the same frame twice. Reduced
+    levels are taken straight from the frame by linear decimation, so a
+    level's pixels do not depend on which other levels were built first.
+    """
+
+    def __init__(self, frame: np.ndarray, frame_id: Optional[Hashable] = None):
+        self.frame = frame
+        self.frame_id = frame_id
+        self.shape = frame.shape[:2]
+        self._gray: Dict[int, np.ndarray] = {}
+        self._blurred: Dict[int, np.ndarray] = {}
+        self._edges: Dict[Tuple[int, int, int], np.ndarray] = {}
+        self._lock = threading.RLock()
+        top = 0
+        while min(self.shape) >> (top + 1) >= MIN_LEVEL_SIDE:
+            top += 1
+        self.top = top
+
+    def size(self, level: int) -> Tuple[int, int]:
+        """(width, height) of a level."""
+        return self.shape[1] >> level, self.shape[0] >> level
+
+    def level_within(self, max_side: int) -> int:
+        """The finest level whose longer side is at most max_side."""
+        level = 0
+        while level < self.top and max(self.shape) > max_side << level:
+            level += 1
+        return level
+
+    def level_above(self, width: int, height: int) -> int:
+        """The coarsest level that is still at least width x height."""
+        level = 0
+        while level < self.top:
+            w, h = self.size(level + 1)
+            if w < width or h < height:
+                break
+            level += 1
+        return level
+
+    def gray(self, level: int = 0) -> np.ndarray:
+        image = self._gray.get(level)
+        if image is None:
+            with self._lock:
+                image = self._gray.get(level)
+                if image is None:
+                    image = self.frame
+                    if level:
+                        # Linear decimation reads only the two middle pixels of each block.
+                        image = cv2.resize(image, self.size(level), interpolation=cv2.INTER_LINEAR)
+                    if image.ndim == 3:
+                        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                    self._gray[level] = image
+        return image
+
+    def blurred(self, level: int = 0) -> np.ndarray:
+        image = self._blurred.get(level)
+        if image is None:
+            with self._lock:
+                image = self._blurred.get(level)
+                if image is None:
+                    image = cv2.GaussianBlur(self.gray(level), BLUR_KERNEL, 0)
+                    self._blurred[level] = image
+        return image
+
+    def edges(self, level: int = 0, low: int = 50, high: int = 150) -> np.ndarray:
+        key = (level, low, high)
+        image = self._edges.get(key)
+        if image is None:
+            with self._lock:
+                image = self._edges.get(key)
+                if image is None:
+                    image = cv2.Canny(self.blurred(level), low, high)
+                    self._edges[key] = image
+        return image
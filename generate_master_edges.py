@@ -3,13 +3,15 @@ import numpy as np
 import pandas as pd
 import os
 import re
+from calibration import calibration_store
 
 EXCEL_PATH = r"D:\C102641-Data\copy_folder\Valve_Final_Inspection\Valve_Details.xlsx"
 MASTER_DIR = "masters"
 os.makedirs(MASTER_DIR, exist_ok=True)
 
 IMG_W, IMG_H = 1024, 1024 
-PIXELS_PER_MM = 8
+# Masters are drawn at the scale this station's camera was calibrated to.
+PIXELS_PER_MM = 1.0 / calibration_store.scale().mm_per_px
 
 def extract_number(val):
     if pd.isna(val): return 0.0
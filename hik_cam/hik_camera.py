@@ -11,11 +11,13 @@ os.add_dll_directory(SDK_DLL_PATH)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.dirname(BASE_DIR))
 
 from MvCameraControl_class import MvCamera
 from CameraParams_const import *
 from CameraParams_header import *
 from PixelType_header import *
+import frame_conversion
 
 class HikCamera:
     def __init__(self):
@@ -46,7 +48,15 @@ class HikCamera:
         self.is_open = True
         print("Hikrobot camera opened")
 
-    def read(self, timeout=1000, retries=5):
+    def read(self, timeout=1000, retries=5, out=None):
+        """Grab one frame as (ok, BGR array).
+
+        The array belongs to the caller: each read returns a new one, so
+        earlier frames are never overwritten. A caller that is done with a
+        frame can pass it back as out to have the next frame converted into
+        it instead, as with cv2.VideoCapture.read(image); it is used when
+        its shape matches the frame.
+        """
         if not self.is_open:
             raise RuntimeError("Camera not opened")
 
@@ -67,30 +77,17 @@ class HikCamera:
             pixel_type = frame_out.stFrameInfo.enPixelType
             buf_len = frame_out.stFrameInfo.nFrameLen
 
-            buffer = ctypes.string_at(frame_out.pBufAddr, buf_len)
-            img = np.frombuffer(buffer, dtype=np.uint8)
-            if pixel_type == PixelType_Gvsp_Mono8:
-                img = img.reshape(h, w)
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-
-            elif pixel_type in (
-                PixelType_Gvsp_BayerBG8,
-                PixelType_Gvsp_BayerRG8,
-                PixelType_Gvsp_BayerGB8,
-                PixelType_Gvsp_BayerGR8,
-            ):
-                img = img.reshape(h, w)
-                img = cv2.cvtColor(img, cv2.COLOR_BAYER_BG2BGR)
-
-            elif pixel_type == PixelType_Gvsp_RGB8_Packed:
-                img = img.reshape(h, w, 3)
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-
-            else:
+            if not frame_conversion.is_supported(pixel_type):
                 print("Unsupported pixel type:", pixel_type)
                 return False, None
+            if buf_len < frame_conversion.source_bytes(pixel_type, w, h):
+                return False, None
 
-            return True, img
+            shape = frame_conversion.output_shape(w, h)
+            if out is None or out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+                out = np.empty(shape, dtype=np.uint8)
+            frame_conversion.convert_sdk_frame(frame_out.pBufAddr, pixel_type, w, h, out)
+            return True, out
 
         finally:
             self.cam.MV_CC_FreeImageBuffer(frame_out)
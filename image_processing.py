@@ -1,9 +1,10 @@
 import cv2
+import math
 import numpy as np
 import os
 import logging
-from config import TRAINED_IMAGES_FOLDER
-from utils import get_all_images_from_subfolders
+from latency_trace import span
+from frame_features import frame_features
 
 IMAGE_SIZE = (256, 256)
 CANNY_LOW = 50
@@ -39,20 +40,33 @@ def extract_edge_features(edges):
     if not contours:
         return None
 
-    largest_contour = max(contours, key=cv2.contourArea)
+    return contour_features(max(contours, key=cv2.contourArea))
 
+
+def contour_features(largest_contour, moments=None, hull=None):
+    """Shape features of a contour; moments and hull are reused when the
+    caller already has them."""
     area = cv2.contourArea(largest_contour)
     perimeter = cv2.arcLength(largest_contour, True)
 
-    hull = cv2.convexHull(largest_contour)
+    if hull is None:
+        hull = cv2.convexHull(largest_contour)
     hull_area = cv2.contourArea(hull)
     solidity = area / hull_area if hull_area > 0 else 0
 
-    x, y, w, h = cv2.boundingRect(largest_contour)
-    aspect_ratio = float(w) / h if h > 0 else 0
-    extent = area / (w * h) if w * h > 0 else 0
+    if moments is None:
+        moments = cv2.moments(largest_contour)
+
+    # Box along the principal axis, so aspect ratio and extent do not
+    # change with the part's orientation.
+    angle = 0.5 * math.atan2(2 * moments['mu11'], moments['mu20'] - moments['mu02'])
+    points = largest_contour.reshape(-1, 2).astype(np.float64)
+    along = points @ np.array([math.cos(angle), math.sin(angle)])
+    across = points @ np.array([-math.sin(angle), math.cos(angle)])
+    w, h = np.ptp(across) + 1, np.ptp(along) + 1
+    aspect_ratio = float(w / h)
+    extent = float(area / (w * h))
 
-    moments = cv2.moments(largest_contour)
     hu_moments = cv2.HuMoments(moments).flatten()
 
     return {
@@ -128,20 +142,44 @@ def detect_defect_from_edges(test_features, ref_features):
     return "Edge_Mismatch"
 
 
-def process_image_web(frame, filename):
+def process_image_web(frame, filename, part_number=None, fallback_to_global=True, trace=None):
+    """frame is the image or its FrameFeatures bundle."""
+    features = frame_features(frame, filename)
+    outcome = inspect_image(features, filename, part_number, fallback_to_global, trace)
+    result_img_path = outcome[2]
+    if result_img_path:
+        # ✅ Save ONLY real captured image (NO drawing, NO overlay)
+        ensure_dir_exists(os.path.dirname(result_img_path))
+        with span(trace, "disk_write"):
+            cv2.imwrite(result_img_path, features.frame)
+    return outcome
+
+
+def inspect_image(frame, filename, part_number=None, fallback_to_global=True, trace=None):
+    """Same result tuple as process_image_web, without writing the image.
+
+    The returned path is where the image is expected to be stored; callers
+    that persist asynchronously write it themselves. frame is the image or
+    its FrameFeatures bundle; an image is looked up by filename, so later
+    stages on the same frame reuse its bundle.
+    """
     try:
-        resized_frame = cv2.resize(frame, IMAGE_SIZE)
+        features = frame_features(frame, filename)
 
         # Extract features for test image
-        test_edges = detect_edges(resized_frame)
-        test_features = extract_edge_features(test_edges)
+        with span(trace, "edge_detection"):
+            # Built here so each stage is timed on its own.
+            features.class_edges
+        with span(trace, "feature_extraction"):
+            test_features = features.edge_features
 
         if not test_features:
             return "Error", 0.0, None, "No edges detected", "Unknown", "Unknown", "Unknown"
 
-        ref_images = get_all_images_from_subfolders(TRAINED_IMAGES_FOLDER)
+        from reference_index import reference_index
+        matcher = reference_index.matcher()
 
-        if not ref_images:
+        if not len(matcher):
             return "Error", 0.0, None, "No reference images", "Unknown", "Unknown", "Unknown"
 
         best_score = 0.0
@@ -149,24 +187,23 @@ def process_image_web(frame, filename):
         best_subfolder = None
         best_ref_features = None
 
-        for ref_path in ref_images:
-            ref_img = cv2.imread(ref_path)
-            if ref_img is None:
-                continue
-
-            ref_edges = detect_edges(ref_img)
-            ref_features = extract_edge_features(ref_edges)
-
-            if not ref_features:
-                continue
-
-            score = compare_edge_features(test_features, ref_features)
-
-            if score > best_score:
-                best_score = score
-                best_match = os.path.splitext(os.path.basename(ref_path))[0]
-                best_subfolder = os.path.basename(os.path.dirname(ref_path))
-                best_ref_features = ref_features
+        scope = None
+        if part_number:
+            if matcher.has_part(part_number):
+                scope = part_number
+            elif fallback_to_global:
+                logging.warning(f"No references trained for part {part_number}, falling back to global search")
+            else:
+                return "Error", 0.0, None, f"No references for part {part_number}", "Unknown", "Unknown", "Unknown"
+
+        with span(trace, "matching"):
+            matches = matcher.top_k(test_features, k=1, part_number=scope)
+        if matches:
+            best = matches[0]
+            best_score = best["score"]
+            best_match = best["best_match"]
+            best_subfolder = best["subfolder"]
+            best_ref_features = best["features"]
 
         best_score = round(float(best_score), 4)
 
@@ -175,12 +212,13 @@ def process_image_web(frame, filename):
             defect_type = "OK"
         else:
             result = "Rejected"
-            defect_type = detect_defect_from_edges(test_features, best_ref_features)
+            from defect_detector import classify_defect
+
+            with span(trace, "defect_classification"):
+                defect_type = classify_defect(
+                    features, detect_defect_from_edges(test_features, best_ref_features))
 
-        # ✅ Save ONLY real captured image (NO drawing, NO overlay)
         result_img_path = os.path.join("static/uploads", filename)
-        ensure_dir_exists(os.path.dirname(result_img_path))
-        cv2.imwrite(result_img_path, frame)
 
         if best_subfolder:
             part_number = best_subfolder
@@ -204,7 +242,32 @@ def process_image_web(frame, filename):
         return "Error", 0.0, None, "Unknown", "Unknown", "Unknown", "Unknown"
 
 
-def pixels_to_mm(pixels, scale=0.05):
+def train_reference_edges(part_number, image_path):
+    from reference_index import reference_index
+
+    entry = reference_index.add_image(image_path)
+    if entry is None:
+        return None, None
+
+    return get_edge_visualization(image_path), entry["features"]
+
+
+def get_edge_visualization(image_path):
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
+
+    edges = frame_features(img).class_edges
+    overlay = cv2.resize(img, IMAGE_SIZE)
+    overlay[edges != 0] = (0, 255, 0)
+    return overlay
+
+
+def pixels_to_mm(pixels, scale=None):
+    """Image-plane pixels to mm; scale defaults to the station's calibrated mm per pixel."""
+    if scale is None:
+        from calibration import calibration_store
+        scale = calibration_store.scale().mm_per_px
     try:
         return pixels * scale
     except Exception:
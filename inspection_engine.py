@@ -3,39 +3,66 @@ import cv2
 import time
 from datetime import datetime
 from camera_manager import capture_frame
-from database_manager import DatabaseManager
+from inspection_writer import inspection_writer
+from master_templates import master_templates, match_frame, draw_match
+from frame_features import frame_features
+from defect_detector import classify_defect
+from valve_regions import valve_regions
+from latency_trace import InspectionTrace, span
 
 UPLOAD_DIR = "static/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-db = DatabaseManager()
 def run_inspection(part_number: str = "UNKNOWN"):
+    trace = InspectionTrace()
+    row = None
+    try:
+        success, row = _run_inspection(part_number, trace)
+        return success
+    finally:
+        if row is None:
+            trace.finish()
+        else:
+            row.add_done_callback(lambda _: trace.finish())
+
+
+def _run_inspection(part_number: str, trace: InspectionTrace):
    
-    frame = capture_frame()
+    frame = capture_frame(trace=trace)
 
     if frame is None:
         print("No frame available")
-        return False
+        return False, None
     if not os.path.exists(UPLOAD_DIR):
         os.makedirs(UPLOAD_DIR, exist_ok=True)
     timestamp = int(time.time())
     filename = f"inspect_{part_number}_{timestamp}"
     image_path = os.path.join(UPLOAD_DIR, f"{filename}.jpg")
-    master = load_master_contour(part_number)
-    processed_frame, status_text = process_frame(frame, master)
-    result = "PASS" if "PASS" in status_text else "FAIL"
+    master = master_templates.get(part_number)
+    if master is None:
+        print(f"No master edges for part {part_number}")
+        return False, None
+    features = frame_features(frame, filename)
+    score, live_edges = match_frame(features, master)
+    processed_frame = draw_match(frame, master, live_edges, score)
+    result = score["status"]
     try:
-        success = cv2.imwrite(image_path, processed_frame)
+        with span(trace, "disk_write"):
+            success = cv2.imwrite(image_path, processed_frame)
         if not success:
             print(f"Failed to save image to {image_path}")
-            return False
+            return False, None
         print(f"Image saved to {image_path}")
     except Exception as e:
         print(f"Error saving image: {e}")
-        return False
-    defect_type = "None" if result == "PASS" else "Geometric Mismatch"
+        return False, None
+    if result == "PASS":
+        defect_type = "None"
+    else:
+        regions = valve_regions.locate(part_number, score["pose"], frame.shape)
+        defect_type = classify_defect(features, "Geometric Mismatch", regions)
     try:
-        db_result = db.insert_inspection(
+        row = inspection_writer.submit(
             data={
                 "part_number": part_number,
                 "image_name": filename + ".jpg", 
@@ -46,14 +73,11 @@ def run_inspection(part_number: str = "UNKNOWN"):
                 "best_match": None,
                 "location": "Station_1",
                 "shifts": "Day"
-            }
+            },
+            trace=trace
         )
-        if db_result:
-            print(f"Inspection stored in database (ID: {db_result})")
-            return True
-        else:
-            print("Failed to store inspection in database")
-            return False
+        print(f"Inspection {filename} queued for the database")
+        return True, row
     except Exception as e:
         print(f"Database error: {e}")
-        return False
+        return False, None
@@ -0,0 +1,182 @@
+import os
+import math
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from config import REFERENCE_INDEX_PATH
+
+logger = logging.getLogger("inspection_executor")
+
+# Worker-process state, populated by _init_worker. Attachments are kept per
+# parent slot, so a slot that is re-created replaces its old mapping.
+_worker_segments: Dict[int, shared_memory.SharedMemory] = {}
+_worker_index_stamp: Optional[int] = None
+_worker_catalog_digest: Optional[str] = None
+
+
+def _index_stamp() -> Optional[int]:
+    try:
+        return os.stat(REFERENCE_INDEX_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _init_worker(catalog_rows, catalog_origin) -> None:
+    """Workers only read what the parent builds: the saved reference index
+    and defect masks are mapped as they are, and the spec table is the
+    parent's. Rebuilding any of them is left to the parent process."""
+    global _worker_index_stamp, _worker_catalog_digest
+    from defect_classifier import defect_classifier
+    from defect_masks import defect_masks
+    from reference_index import reference_index
+    from valve_catalog import valve_catalog
+
+    reference_index.read_only = True
+    reference_index.load()
+    reference_index.matcher()
+    # Reloads follow the parent's table (see _run_inspection), not a TTL of their own.
+    valve_catalog.ttl = math.inf
+    valve_catalog.adopt(catalog_rows, catalog_origin)
+    _worker_catalog_digest = valve_catalog.digest
+    defect_masks.map_saved()
+    defect_classifier.load()
+    _worker_index_stamp = _index_stamp()
+
+
+def _attach(slot: int, name: str, nbytes: int) -> shared_memory.SharedMemory:
+    """The worker's mapping of a slot's segment. When the parent has
+    re-created the slot (new name) or the frame no longer fits, the old
+    mapping is closed and dropped before the new one is attached."""
+    segment = _worker_segments.get(slot)
+    if segment is not None and (segment.name.lstrip("/") != name.lstrip("/") or segment.size < nbytes):
+        del _worker_segments[slot]
+        try:
+            segment.close()
+        except BufferError:
+            # A view of it is still alive; the mapping goes with the last one.
+            logger.warning(f"Shared frame {segment.name} still in use; released when its views are")
+        segment = None
+    if segment is None:
+        segment = shared_memory.SharedMemory(name=name)
+        _worker_segments[slot] = segment
+    return segment
+
+
+def _run_inspection(slot: int, segment_name: str, shape: Tuple[int, ...], dtype: str,
+                    filename: str, part_number: Optional[str], fallback_to_global: bool,
+                    catalog_digest: Optional[str] = None):
+    global _worker_index_stamp, _worker_catalog_digest
+    from frame_features import frame_feature_cache
+    from image_processing import inspect_image
+    from latency_trace import InspectionTrace
+    from reference_index import reference_index
+    from valve_catalog import valve_catalog
+
+    stamp = _index_stamp()
+    if stamp != _worker_index_stamp:
+        reference_index.load()
+        _worker_index_stamp = stamp
+    if catalog_digest != _worker_catalog_digest:
+        # The parent's table changed; read the source once for this change.
+        _worker_catalog_digest = catalog_digest
+        valve_catalog.load()
+
+    dtype = np.dtype(dtype)
+    segment = _attach(slot, segment_name, int(np.prod(shape)) * dtype.itemsize)
+    frame = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    trace = InspectionTrace(filename)
+    try:
+        outcome = inspect_image(frame, filename, part_number, fallback_to_global, trace)
+    finally:
+        # The bundle views the slot, which the parent refills for the next frame.
+        frame_feature_cache.discard(filename)
+    return outcome, trace.events
+
+
+class _FrameSlot:
+    def __init__(self, index: int):
+        self.index = index
+        self.segment: Optional[shared_memory.SharedMemory] = None
+
+    def store(self, frame: np.ndarray) -> str:
+        if self.segment is None or self.segment.size < frame.nbytes:
+            self.close()
+            self.segment = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+        view = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self.segment.buf)
+        np.copyto(view, frame)
+        return self.segment.name
+
+    def close(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+
+class ProcessInspectionExecutor:
+    """Runs inspect_image in a pool of worker processes.
+
+    Each worker maps the saved reference index and defect masks and takes
+    the parent's valve catalog once at startup; only the parent builds or
+    writes them. Frames are copied into a shared-memory slot and only the slot
+    name, shape and dtype are pickled; a slot is reused once its task is
+    done. Workers reload the reference index when its file changes.
+    """
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: "queue.Queue[_FrameSlot]" = queue.Queue()
+        self._all_slots = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                return
+            from valve_catalog import valve_catalog
+
+            self._pool = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                             initargs=valve_catalog.snapshot())
+            # One slot per process plus one being filled while the others run.
+            for index in range(self.processes + 1):
+                slot = _FrameSlot(index)
+                self._all_slots.append(slot)
+                self._slots.put(slot)
+            logger.info(f"Process inspection executor started with {self.processes} workers")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is None:
+                return
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            for slot in self._all_slots:
+                slot.close()
+            self._all_slots = []
+            self._slots = queue.Queue()
+
+    def inspect(self, frame: np.ndarray, filename: str, part_number: Optional[str] = None,
+                fallback_to_global: bool = True, trace=None) -> Any:
+        from valve_catalog import valve_catalog
+
+        self.start()
+        frame = np.ascontiguousarray(frame)
+        slot = self._slots.get()
+        try:
+            name = slot.store(frame)
+            future = self._pool.submit(_run_inspection, slot.index, name, frame.shape, frame.dtype.str,
+                                       filename, part_number, fallback_to_global, valve_catalog.digest)
+            outcome, events = future.result()
+            if trace is not None:
+                for event in events:
+                    trace.add(*event)
+            return outcome
+        finally:
+            self._slots.put(slot)
@@ -0,0 +1,322 @@
+import os
+import queue
+import logging
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+import camera_manager
+from calibration import calibration_store
+from config import (
+    INSPECTION_WORKERS,
+    ACQUIRE_QUEUE_SIZE,
+    INSPECT_QUEUE_SIZE,
+    PERSIST_QUEUE_SIZE,
+    INSPECTION_EXECUTOR,
+    INSPECTION_PROCESSES,
+)
+from frame_features import frame_feature_cache
+from image_processing import inspect_image, ensure_dir_exists
+from latency_trace import InspectionTrace, span
+
+logger = logging.getLogger("inspection_pipeline")
+
+_STOP = object()
+
+
+class PipelineBusy(RuntimeError):
+    pass
+
+
+class StageQueue:
+    """Bounded queue between two pipeline stages with backpressure metrics."""
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.put_count = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.put_wait_total = 0.0
+        self.put_wait_max = 0.0
+
+    def put(self, item, block: bool = True, timeout: Optional[float] = None) -> None:
+        start = time.perf_counter()
+        try:
+            self._q.put(item, block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.put_count += 1
+            self.put_wait_total += waited
+            self.put_wait_max = max(self.put_wait_max, waited)
+            self.max_depth = max(self.max_depth, self._q.qsize())
+
+    def get(self, timeout: Optional[float] = None):
+        return self._q.get(timeout=timeout)
+
+    def put_stop(self) -> None:
+        self._q.put(_STOP)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "depth": self._q.qsize(),
+                "capacity": self.maxsize,
+                "max_depth": self.max_depth,
+                "processed": self.put_count,
+                "rejected": self.rejected,
+                "avg_put_wait_ms": round(1000 * self.put_wait_total / self.put_count, 3) if self.put_count else 0.0,
+                "max_put_wait_ms": round(1000 * self.put_wait_max, 3),
+            }
+
+
+class InspectionJob:
+    def __init__(self, filename: str, part_number: Optional[str] = None,
+                 fallback_to_global: bool = True, frame: Optional[np.ndarray] = None,
+                 record: Optional[Dict[str, Any]] = None, trigger: bool = False):
+        self.filename = filename
+        self.part_number = part_number
+        self.fallback_to_global = fallback_to_global
+        self.frame = frame
+        self.record = record
+        self.trigger = trigger
+        self.trace = InspectionTrace(filename)
+        self.result: Future = Future()
+        self.persisted: Future = Future()
+
+
+class InspectionPipeline:
+    """Capture -> inspect -> persist, each stage decoupled by a bounded queue.
+
+    The request thread only waits for the inspection verdict; the JPEG write
+    and the optional DB insert happen on the persistence stage. Images that
+    are still waiting to be written are served from memory by pending_image.
+    """
+
+    def __init__(self, workers: Optional[int] = None,
+                 upload_folder: str = os.path.join("static", "uploads"),
+                 executor: str = INSPECTION_EXECUTOR):
+        self.executor = executor
+        self._process_executor = None
+        if executor == "process":
+            from inspection_executor import ProcessInspectionExecutor
+            self._process_executor = ProcessInspectionExecutor(workers or INSPECTION_PROCESSES)
+            workers = self._process_executor.processes
+        self.workers = max(1, workers or INSPECTION_WORKERS)
+        self.upload_folder = upload_folder
+        self.acquire_q = StageQueue("acquire", ACQUIRE_QUEUE_SIZE)
+        self.inspect_q = StageQueue("inspect", INSPECT_QUEUE_SIZE)
+        self.persist_q = StageQueue("persist", PERSIST_QUEUE_SIZE)
+        self._threads: List[threading.Thread] = []
+        self._pending: Dict[str, np.ndarray] = {}
+        self._pending_lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._running = False
+        self.errors = 0
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        if self._process_executor is not None:
+            self._process_executor.start()
+        self._spawn("acquire", self._acquire_loop)
+        for i in range(self.workers):
+            self._spawn(f"inspect-{i}", self._inspect_loop)
+        self._spawn("persist", self._persist_loop)
+        logger.info(f"Inspection pipeline started with {self.workers} inspection workers")
+
+    def stop(self) -> None:
+        if not self._running:
+            return
+        self._running = False
+        self.acquire_q.put_stop()
+        for t in self._threads:
+            t.join(timeout=5)
+        self._threads = []
+        if self._process_executor is not None:
+            self._process_executor.shutdown()
+
+    def _spawn(self, name: str, target) -> None:
+        t = threading.Thread(target=target, name=f"pipeline-{name}", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def next_filename(self, prefix: str = "capture") -> str:
+        return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{next(self._counter)}_{prefix}.jpg"
+
+    def submit(self, part_number: Optional[str] = None, fallback_to_global: bool = True,
+               frame: Optional[np.ndarray] = None, record: Optional[Dict[str, Any]] = None,
+               filename: Optional[str] = None, trigger: bool = False) -> InspectionJob:
+        """Queue an inspection. Without a frame the acquisition stage grabs
+        the latest camera frame, or with trigger=True fires a software
+        trigger and waits for the frame it produces; camera frames are
+        undistorted with the camera's calibration on the way out of the
+        ring. Raises PipelineBusy when the stage is full."""
+        if not self._running:
+            self.start()
+        job = InspectionJob(filename or self.next_filename(), part_number,
+                            fallback_to_global, frame, record, trigger)
+        if frame is not None:
+            job.trace.mark("frame_arrival")
+        try:
+            self.acquire_q.put(job, block=False)
+        except queue.Full:
+            raise PipelineBusy("Inspection pipeline is saturated")
+        return job
+
+    def _acquire_loop(self) -> None:
+        while True:
+            job = self.acquire_q.get()
+            if job is _STOP:
+                for _ in range(self.workers):
+                    self.inspect_q.put_stop()
+                return
+            try:
+                if job.frame is None and job.trigger:
+                    job.frame = self._triggered_frame(job)
+                elif job.frame is None:
+                    job.frame = camera_manager.capture_frame(trace=job.trace,
+                                                             transform=calibration_store.undistort)
+                if job.frame is None:
+                    self._abandon(job, RuntimeError("Camera frame not available"))
+                    continue
+                with self._pending_lock:
+                    self._pending[job.filename] = job.frame
+                self.inspect_q.put(job)
+            except Exception as e:
+                self.errors += 1
+                self._abandon(job, e)
+
+    def _abandon(self, job: InspectionJob, error: Exception) -> None:
+        """End a job that leaves the pipeline before the persist stage:
+        both futures fail with error and the trace is still recorded."""
+        with self._pending_lock:
+            self._pending.pop(job.filename, None)
+        frame_feature_cache.discard(job.filename)
+        for future in (job.result, job.persisted):
+            if not future.done():
+                future.set_exception(error)
+        job.trace.finish()
+
+    def _triggered_frame(self, job: InspectionJob) -> Optional[np.ndarray]:
+        token = camera_manager.software_trigger(trace=job.trace)
+        if token is None:
+            return None
+        ref = camera_manager.wait_for_trigger_frame(token, trace=job.trace)
+        if ref is None:
+            return None
+        with ref:
+            return calibration_store.undistort(ref.frame)
+
+    def _inspect_loop(self) -> None:
+        while True:
+            job = self.inspect_q.get()
+            if job is _STOP:
+                self.persist_q.put_stop()
+                return
+            job.trace.mark("dequeue")
+            try:
+                inspect = inspect_image if self._process_executor is None else self._process_executor.inspect
+                outcome = inspect(job.frame, job.filename, job.part_number, job.fallback_to_global, job.trace)
+                job.result.set_result(outcome)
+            except Exception as e:
+                self.errors += 1
+                logger.exception("Inspection stage failed")
+                job.result.set_exception(e)
+            self.persist_q.put(job)
+
+    def _persist_loop(self) -> None:
+        stops = 0
+        while True:
+            job = self.persist_q.get()
+            if job is _STOP:
+                stops += 1
+                if stops >= self.workers:
+                    return
+                continue
+            try:
+                outcome = self._persist(job)
+            except Exception as e:
+                self.errors += 1
+                logger.exception(f"Persisting {job.filename} failed")
+                job.persisted.set_exception(e)
+                job.trace.finish()
+            else:
+                if isinstance(outcome, Future):
+                    # The DB row is written behind; resolve once it has an id.
+                    outcome.add_done_callback(lambda f, job=job: self._row_written(job, f))
+                else:
+                    job.persisted.set_result(outcome)
+                    job.trace.finish()
+            finally:
+                with self._pending_lock:
+                    self._pending.pop(job.filename, None)
+                frame_feature_cache.discard(job.filename)
+
+    def _row_written(self, job: InspectionJob, row: Future) -> None:
+        if row.exception() is not None:
+            self.errors += 1
+            job.persisted.set_exception(row.exception())
+        else:
+            job.persisted.set_result(row.result())
+        job.trace.finish()
+
+    def _persist(self, job: InspectionJob) -> Any:
+        path = os.path.join(self.upload_folder, job.filename)
+        ensure_dir_exists(self.upload_folder)
+        with span(job.trace, "image_encode"):
+            ok, buffer = cv2.imencode(".jpg", job.frame)
+        if not ok:
+            raise IOError(f"Failed to encode {job.filename}")
+        with span(job.trace, "disk_write"):
+            with open(path, "wb") as f:
+                f.write(buffer.tobytes())
+
+        if job.record is None or job.result.exception() is not None:
+            return True
+
+        from inspection_writer import inspection_writer
+
+        result, best_score, _, best_match, defect_type, part_number, part_name = job.result.result()
+        data = {
+            "part_number": part_number,
+            "part_name": part_name,
+            "image_name": job.filename,
+            "ssim_score": best_score,
+            "result": result,
+            "best_match": best_match,
+            "defect_type": defect_type,
+            "timestamp": datetime.now(),
+        }
+        data.update(job.record)
+        return inspection_writer.submit(data, trace=job.trace)
+
+    def pending_image(self, filename: str) -> Optional[np.ndarray]:
+        with self._pending_lock:
+            return self._pending.get(filename)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "running": self._running,
+            "executor": self.executor,
+            "workers": self.workers,
+            "errors": self.errors,
+            "pending_writes": len(self._pending),
+            "stages": {q.name: q.metrics() for q in (self.acquire_q, self.inspect_q, self.persist_q)},
+        }
+
+
+inspection_pipeline = InspectionPipeline()
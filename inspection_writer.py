@@ -0,0 +1,390 @@
+import os
+import json
+import uuid
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyodbc
+
+from config import (
+    INSPECTION_WRITER_BATCH,
+    INSPECTION_WRITER_INTERVAL,
+    INSPECTION_WRITER_BUFFER,
+    INSPECTION_SPOOL_PATH,
+    INSPECTION_SPOOL_RETRY,
+)
+
+logger = logging.getLogger("inspection_writer")
+
+# Errors caused by the rows themselves rather than the server being unreachable.
+ROW_ERRORS = (pyodbc.DataError, pyodbc.IntegrityError, pyodbc.ProgrammingError)
+# How many submitted keys lookup() can still answer for.
+RECENT_KEYS = 4096
+
+
+class DuplicateKey(RuntimeError):
+    pass
+
+
+class _Record:
+    __slots__ = ("key", "data", "future", "trace", "enqueued")
+
+    def __init__(self, data: Dict[str, Any], trace=None, key: Optional[str] = None):
+        self.key = key or uuid.uuid4().hex
+        self.data = data
+        self.future: Future = Future()
+        self.trace = trace
+        self.enqueued = time.time()
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class InspectionWriter:
+    """Write-behind buffer for inspection rows.
+
+    submit() returns a Future for the row id straight away; the row's key,
+    known at submit time, can be passed to lookup() later for its state and
+    id. The key is written to the spool with the row. A background
+    thread flushes the buffer in one transaction when batch_size rows are
+    waiting or the oldest has waited flush_interval seconds. If the database
+    is unreachable the batch is appended to a JSON-lines spool on disk and
+    replayed, in order, once the server answers again; the futures of
+    spooled rows resolve when the replay commits.
+    """
+
+    def __init__(self, db=None, batch_size: int = INSPECTION_WRITER_BATCH,
+                 flush_interval: float = INSPECTION_WRITER_INTERVAL,
+                 max_buffer: int = INSPECTION_WRITER_BUFFER,
+                 spool_path: str = INSPECTION_SPOOL_PATH,
+                 retry_interval: float = INSPECTION_SPOOL_RETRY):
+        self._db = db
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_buffer = max(self.batch_size, max_buffer)
+        self.spool_path = spool_path
+        self.retry_interval = retry_interval
+        self._buffer: List[_Record] = []
+        self._cond = threading.Condition()
+        self._spool_lock = threading.Lock()
+        self._spooled: Dict[str, _Record] = {}
+        self._recent: "OrderedDict[str, Future]" = OrderedDict()
+        self._spool_rows = self._count_spool()
+        self._next_retry = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._flush_requested = False
+        self._flush_ms: deque = deque(maxlen=512)
+        self.stats = {
+            "submitted": 0, "flushes": 0, "rows_written": 0, "rows_failed": 0,
+            "rows_spooled": 0, "rows_replayed": 0, "last_error": None,
+        }
+
+    @property
+    def db(self):
+        if self._db is None:
+            from database_manager import db_manager
+            self._db = db_manager
+        return self._db
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="inspection-writer", daemon=True)
+        self._thread.start()
+        logger.info(f"Inspection writer started (batch {self.batch_size}, interval {self.flush_interval}s)")
+
+    def stop(self, timeout: float = 10) -> None:
+        """Flush what is buffered (spooling it if the DB is down) and stop."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def submit(self, data: Dict[str, Any], trace=None, key: Optional[str] = None) -> Future:
+        """Queue a row. Raises DuplicateKey when key is one the writer
+        still holds."""
+        if not self._running:
+            self.start()
+        record = _Record(dict(data), trace, key)
+        with self._cond:
+            # A second row under a held key would take over the first one's
+            # lookup and spool entry and leave its future unresolved.
+            if record.key in self._recent or record.key in self._spooled:
+                raise DuplicateKey(f"Inspection key {record.key} is already in use")
+            self._remember(record)
+            self.stats["submitted"] += 1
+            if len(self._buffer) < self.max_buffer:
+                self._buffer.append(record)
+                # Wake the writer to start the flush timer, or flush a full batch.
+                if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                    self._cond.notify()
+                return record.future
+        # Buffer full: go straight to disk rather than block the caller.
+        self._spool([record])
+        return record.future
+
+    def _remember(self, record: _Record) -> None:
+        """Called with self._cond held."""
+        self._recent[record.key] = record.future
+        self._recent.move_to_end(record.key)
+        while len(self._recent) > RECENT_KEYS:
+            self._recent.popitem(last=False)
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """State of a submitted row: queued, spooled, written (with its id)
+        or rejected. None for a key this writer does not remember."""
+        with self._cond:
+            future = self._recent.get(key)
+        if future is None:
+            return None
+        if not future.done():
+            return {"key": key, "status": "spooled" if key in self._spooled else "queued"}
+        error = future.exception()
+        if error is not None:
+            return {"key": key, "status": "rejected", "error": str(error)}
+        row_id = future.result()
+        return {"key": key, "status": "written", "id": None if row_id is True else row_id}
+
+    def flush(self) -> None:
+        """Ask the writer thread to flush now instead of waiting for the timer."""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+
+    def _next_batch(self) -> Optional[List[_Record]]:
+        with self._cond:
+            while True:
+                now = time.time()
+                if not self._running or self._flush_requested or len(self._buffer) >= self.batch_size:
+                    break
+                timeout = None
+                if self._buffer:
+                    timeout = self._buffer[0].enqueued + self.flush_interval - now
+                if self._spool_rows:
+                    retry_in = self._next_retry - now
+                    timeout = retry_in if timeout is None else min(timeout, retry_in)
+                if timeout is not None and timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+            self._flush_requested = False
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            if not batch and not self._running and not self._spool_rows:
+                return None
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if self._spool_rows and time.time() >= self._next_retry:
+                self._replay()
+            if batch:
+                if self._spool_rows:
+                    # Keep rows in order behind what is already spooled.
+                    self._spool(batch)
+                else:
+                    self._flush(batch)
+            if not self._running and not self._buffer:
+                return
+
+    def _flush(self, batch: List[_Record]) -> None:
+        start = time.time()
+        try:
+            ids = self.db.write_inspection_batch([r.data for r in batch])
+        except ROW_ERRORS as e:
+            logger.warning(f"Batch of {len(batch)} rejected ({e}); retrying rows one by one")
+            written = self._write_rows(batch)
+            if written < len(batch):
+                self._spool(batch[written:])
+            return
+        except Exception as e:
+            logger.error(f"Inspection flush failed, spooling {len(batch)} rows: {e}")
+            self._outage(e)
+            self._spool(batch)
+            return
+        self._finish(batch, ids, start)
+
+    def _write_rows(self, records: List[_Record]) -> int:
+        """Insert rows one at a time so a bad row cannot hold back the rest.
+        Returns how many were dealt with before the server became unreachable."""
+        for i, record in enumerate(records):
+            start = time.time()
+            try:
+                ids = self.db.write_inspection_batch([record.data])
+            except ROW_ERRORS as e:
+                self._reject(record, e)
+                continue
+            except Exception as e:
+                self._outage(e)
+                return i
+            self._finish([record], ids, start)
+        return len(records)
+
+    def _outage(self, error: Exception) -> None:
+        self.stats["last_error"] = str(error)
+        self._next_retry = time.time() + self.retry_interval
+
+    def _reject(self, record: _Record, error: Exception) -> None:
+        """Keep a row the database refuses next to the spool instead of retrying it forever."""
+        logger.error(f"Inspection {record.data.get('image_name')} rejected by the database: {error}")
+        self.stats["rows_failed"] += 1
+        self.stats["last_error"] = str(error)
+        try:
+            with self._spool_lock:
+                self._ensure_spool_dir()
+                with open(self.spool_path + ".rejected", "a") as f:
+                    f.write(json.dumps({"key": record.key, "error": str(error), "data": record.data},
+                                       default=_encode) + "\n")
+        except OSError as e:
+            logger.error(f"Could not record rejected inspection: {e}")
+        record.future.set_exception(error)
+
+    def _finish(self, batch: List[_Record], ids: List[Any], start: float) -> None:
+        end = time.time()
+        self._flush_ms.append(1000 * (end - start))
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += len(batch)
+        for record, row_id in zip(batch, ids):
+            if record.trace is not None:
+                record.trace.add("db_queue", record.enqueued, start)
+                record.trace.add("db_insert", start, end)
+            record.future.set_result(row_id if row_id is not None else True)
+
+    def _ensure_spool_dir(self) -> None:
+        directory = os.path.dirname(self.spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _count_spool(self) -> int:
+        try:
+            with open(self.spool_path) as f:
+                return sum(1 for line in f if line.strip())
+        except OSError:
+            return 0
+
+    def _spool(self, records: List[_Record]) -> None:
+        with self._spool_lock:
+            self._ensure_spool_dir()
+            with open(self.spool_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps({"key": record.key, "data": record.data}, default=_encode) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            for record in records:
+                self._spooled[record.key] = record
+            self._spool_rows += len(records)
+            self.stats["rows_spooled"] += len(records)
+
+    def _replay(self) -> None:
+        """Write spooled rows back in batches; keep whatever is left on failure."""
+        with self._spool_lock:
+            try:
+                with open(self.spool_path) as f:
+                    lines = [line for line in f if line.strip()]
+            except OSError:
+                self._spool_rows = 0
+                return
+
+        done = 0
+        while done < len(lines):
+            chunk = [json.loads(line, object_hook=_decode) for line in lines[done:done + self.batch_size]]
+            records = [self._spooled.pop(item["key"], None) or self._respooled(item) for item in chunk]
+            start = time.time()
+            try:
+                ids = self.db.write_inspection_batch([r.data for r in records])
+            except ROW_ERRORS:
+                written = self._write_rows(records)
+            except Exception as e:
+                self._outage(e)
+                written = 0
+            else:
+                self._finish(records, ids, start)
+                written = len(records)
+            self.stats["rows_replayed"] += written
+            done += written
+            if written < len(records):
+                # Still down: hand the unwritten futures back for the next attempt.
+                for record in records[written:]:
+                    self._spooled[record.key] = record
+                logger.warning(f"Spool replay stopped after {done} rows: {self.stats['last_error']}")
+                break
+
+        with self._spool_lock:
+            # Rows spooled while we were replaying were appended after `lines`.
+            try:
+                with open(self.spool_path) as f:
+                    current = [line for line in f if line.strip()]
+            except OSError:
+                current = lines
+            remaining = current[done:]
+            if remaining:
+                tmp = self.spool_path + ".tmp"
+                with open(tmp, "w") as f:
+                    f.writelines(remaining)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.spool_path)
+            else:
+                os.remove(self.spool_path)
+            self._spool_rows = len(remaining)
+        if done:
+            logger.info(f"Replayed {done} spooled inspection rows, {len(remaining)} left")
+
+    def _respooled(self, item: Dict[str, Any]) -> _Record:
+        """A record for a row spooled by an earlier run."""
+        record = _Record(item["data"], key=item["key"])
+        with self._cond:
+            self._remember(record)
+        return record
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            depth = len(self._buffer)
+            oldest = time.time() - self._buffer[0].enqueued if self._buffer else 0.0
+        flush_ms = np.fromiter(self._flush_ms, dtype=np.float64)
+        out = {
+            "running": self._running,
+            "queue_depth": depth,
+            "oldest_queued_ms": round(1000 * oldest, 3),
+            "spool_depth": self._spool_rows,
+            "batch_size": self.batch_size,
+            "flush_interval_s": self.flush_interval,
+        }
+        out.update(self.stats)
+        if flush_ms.size:
+            p50, p95 = np.percentile(flush_ms, [50, 95])
+            out["flush_ms"] = {
+                "p50": round(float(p50), 3),
+                "p95": round(float(p95), 3),
+                "max": round(float(flush_ms.max()), 3),
+            }
+        return out
+
+
+inspection_writer = InspectionWriter()
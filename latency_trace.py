@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import LATENCY_LOG_PATH, LATENCY_WINDOW
+
+logger = logging.getLogger("latency_trace")
+
+STAGES = (
+    "trigger",
+    "frame_arrival",
+    "dequeue",
+    "edge_detection",
+    "feature_extraction",
+    "matching",
+    "image_encode",
+    "disk_write",
+    "db_queue",
+    "db_insert",
+)
+
+_ids = itertools.count(1)
+
+
+class InspectionTrace:
+    """Wall-clock timeline of one inspection.
+
+    mark() records a point in time (trigger, frame arrival, dequeue); its
+    latency is the gap since the previous event. span() records a stage with
+    its own start and end. Timestamps are time.time() so they line up with
+    the camera ring's frame timestamps.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or str(next(_ids))
+        self.events: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def mark(self, stage: str, timestamp: Optional[float] = None) -> None:
+        ts = time.time() if timestamp is None else timestamp
+        self.add(stage, ts, ts)
+
+    def add(self, stage: str, start: float, end: float) -> None:
+        with self._lock:
+            self.events.append((stage, start, end))
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time())
+
+    def durations(self) -> Dict[str, float]:
+        """Milliseconds per stage, plus 'total' from first to last event."""
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e[1])
+        out: Dict[str, float] = {}
+        previous_end = None
+        for stage, start, end in events:
+            if start == end:
+                if previous_end is not None:
+                    out[stage] = 1000 * max(0.0, start - previous_end)
+            else:
+                out[stage] = 1000 * (end - start)
+            previous_end = end if previous_end is None else max(previous_end, end)
+        if events:
+            out["total"] = 1000 * (max(e[2] for e in events) - events[0][1])
+        return out
+
+    def finish(self) -> None:
+        latency_recorder.record(self)
+
+
+@contextmanager
+def span(trace: Optional[InspectionTrace], stage: str):
+    """trace.span(stage) that is a no-op when no trace is being collected."""
+    if trace is None:
+        yield
+    else:
+        with trace.span(stage):
+            yield
+
+
+class LatencyRecorder:
+    """Rolling per-stage latency windows with percentile snapshots, and an
+    optional JSON-lines log of every finished trace."""
+
+    def __init__(self, window: int = LATENCY_WINDOW, log_path: Optional[str] = LATENCY_LOG_PATH):
+        self.window = window
+        self.log_path = log_path or None
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, trace: InspectionTrace) -> None:
+        durations = trace.durations()
+        with self._lock:
+            self.count += 1
+            for stage, ms in durations.items():
+                self._samples.setdefault(stage, deque(maxlen=self.window)).append(ms)
+        if self.log_path:
+            self._log(trace, durations)
+
+    def _log(self, trace: InspectionTrace, durations: Dict[str, float]) -> None:
+        try:
+            directory = os.path.dirname(self.log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps({
+                    "trace_id": trace.trace_id,
+                    "start": trace.events[0][1] if trace.events else None,
+                    "stages_ms": {k: round(v, 3) for k, v in durations.items()},
+                }) + "\n")
+        except Exception as e:
+            logger.error(f"Failed to write latency log: {e}")
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            samples = {stage: np.fromiter(values, dtype=np.float64) for stage, values in self._samples.items()}
+        out = {}
+        for stage in list(STAGES) + sorted(set(samples) - set(STAGES)):
+            values = samples.get(stage)
+            if values is None or values.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            out[stage] = {
+                "count": int(values.size),
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "p99_ms": round(float(p99), 3),
+                "max_ms": round(float(values.max()), 3),
+            }
+        return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self.count = 0
+
+
+latency_recorder = LatencyRecorder()
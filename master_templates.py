@@ -0,0 +1,237 @@
+import os
+import re
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from config import (MASTER_DIR, MASTER_EDGE_SIZE, MASTER_TOLERANCE_PX, MASTER_OVERLAP_THRESHOLD,
+                    POSE_ALIGN)
+from frame_features import FrameFeatures, frame_features
+from pose import Pose, distance_pyramid, estimate_pose, silhouette_pose
+
+logger = logging.getLogger("master_templates")
+
+EDGE_LOW = 50
+EDGE_HIGH = 150
+MASTER_SUFFIX = "_master.jpg"
+
+
+def sanitize_part_number(part_number) -> str:
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', str(part_number))
+
+
+def edge_pixels(edges: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(rows, cols) of the non-zero pixels of a sparse edge map.
+
+    The map is scanned eight pixels at a time as 64-bit words and only the
+    non-zero words are expanded, which is several times faster than a
+    pixel-by-pixel scan on a multi-megapixel frame.
+    """
+    flat = np.ascontiguousarray(edges).reshape(-1)
+    if flat.size % 8:
+        points = cv2.findNonZero(edges)
+        if points is None:
+            return np.empty(0, np.intp), np.empty(0, np.intp)
+        points = points.reshape(-1, 2)
+        return points[:, 1], points[:, 0]
+    words = np.flatnonzero(flat.view(np.uint64))
+    offset_rows, offset_cols = np.nonzero(flat.reshape(-1, 8)[words])
+    index = words[offset_rows] * 8 + offset_cols
+    return np.divmod(index, edges.shape[1])
+
+
+def extract_edges(frame) -> np.ndarray:
+    """Canny edges of an image or FrameFeatures bundle, at full resolution."""
+    return frame_features(frame).pyramid.edges(0, EDGE_LOW, EDGE_HIGH)
+
+
+class MasterTemplate:
+    """A part's master edge drawing, prepared once for scoring at the
+    working resolution.
+
+    dilated marks every pixel within tolerance of a master edge and
+    distance holds the distance to the nearest master edge, so scoring a
+    live edge map is one lookup at its edge pixels followed by a sum.
+
+    scale is template pixels per master drawing pixel; the drawing is at
+    the camera's calibrated scale, so it is also the scale from frame to
+    template once a frame's pose is known. pose (centroid and head-to-tip
+    axis of the outline) and the distance pyramid serve the pose search.
+    """
+
+    def __init__(self, part_number: str, edges: np.ndarray, tolerance: float = MASTER_TOLERANCE_PX,
+                 mtime: Optional[float] = None, scale: float = 1.0):
+        self.part_number = part_number
+        self.edges = edges
+        self.tolerance = tolerance
+        self.mtime = mtime
+        self.scale = scale
+        self.size = (edges.shape[1], edges.shape[0])
+        self.distance = cv2.distanceTransform(cv2.bitwise_not(edges), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        # The master dilated by a disk of the tolerance radius.
+        self.dilated = (self.distance <= tolerance).astype(np.uint8)
+        self.pose = silhouette_pose(edges)
+        self.pyramid = distance_pyramid(self.distance)
+        self._display: Dict[Tuple[int, int], np.ndarray] = {}
+
+    @classmethod
+    def from_file(cls, part_number: str, path: str, size: int = MASTER_EDGE_SIZE,
+                  tolerance: float = MASTER_TOLERANCE_PX) -> "MasterTemplate":
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Master edge image could not be read: {path}")
+        resized = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+        # Area averaging turns thin lines grey; anything clearly above black is edge.
+        _, edges = cv2.threshold(resized, 64, 255, cv2.THRESH_BINARY)
+        return cls(part_number, edges, tolerance, os.path.getmtime(path), size / image.shape[1])
+
+    def _lookup(self, rows: np.ndarray, cols: np.ndarray, shape,
+                pose: Optional[Pose] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Template coordinates of live edge pixels.
+
+        With a pose the pixels are carried into the master frame by it,
+        and those that land outside are held at the border. Without one the
+        live map is stretched onto the template the same way the master
+        drawing was.
+        """
+        if pose is None:
+            h, w = shape[:2]
+            return rows * self.size[1] // h, cols * self.size[0] // w
+        xs, ys = pose.apply(cols, rows)
+        xs = np.clip(np.rint(xs), 0, self.size[0] - 1).astype(np.intp)
+        ys = np.clip(np.rint(ys), 0, self.size[1] - 1).astype(np.intp)
+        return ys, xs
+
+    def score(self, live_edges: np.ndarray, pose: Optional[Pose] = None) -> Dict[str, Any]:
+        """overlap: share of live edge pixels within tolerance of the master.
+        chamfer: their mean distance to the master, in template pixels."""
+        rows, cols = edge_pixels(live_edges)
+        return self.score_pixels(rows, cols, live_edges.shape, pose)
+
+    def score_pixels(self, rows: np.ndarray, cols: np.ndarray, shape,
+                     pose: Optional[Pose] = None) -> Dict[str, Any]:
+        ys, xs = self._lookup(rows, cols, shape, pose)
+        if xs.size == 0:
+            return {"overlap": 0.0, "chamfer": None, "live_pixels": 0}
+        return {
+            "overlap": float(np.count_nonzero(self.dilated[ys, xs])) / xs.size,
+            "chamfer": float(self.distance[ys, xs].mean()),
+            "live_pixels": int(xs.size),
+        }
+
+    def display_mask(self, shape) -> np.ndarray:
+        """The master edges stretched to a frame of the given shape, for overlays."""
+        key = (shape[0], shape[1])
+        mask = self._display.get(key)
+        if mask is None:
+            mask = cv2.resize(self.edges, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+            self._display[key] = mask
+        return mask
+
+
+class MasterTemplateStore:
+    """Master templates from masters/{part}_master.jpg, built once per part
+    and rebuilt only when the master image changes on disk."""
+
+    def __init__(self, directory: str = MASTER_DIR, size: int = MASTER_EDGE_SIZE,
+                 tolerance: float = MASTER_TOLERANCE_PX):
+        self.directory = directory
+        self.size = size
+        self.tolerance = tolerance
+        self._templates: Dict[str, MasterTemplate] = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def path(self, part_number) -> str:
+        return os.path.join(self.directory, f"{sanitize_part_number(part_number)}{MASTER_SUFFIX}")
+
+    def get(self, part_number) -> Optional[MasterTemplate]:
+        key = sanitize_part_number(part_number)
+        path = self.path(part_number)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._templates.pop(key, None)
+            return None
+        template = self._templates.get(key)
+        if template is not None and template.mtime == mtime:
+            return template
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None or template.mtime != mtime:
+                try:
+                    template = MasterTemplate.from_file(key, path, self.size, self.tolerance)
+                except ValueError as e:
+                    logger.error(str(e))
+                    return None
+                self._templates[key] = template
+                self.builds += 1
+            return template
+
+    def part_numbers(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(n[:-len(MASTER_SUFFIX)] for n in names if n.endswith(MASTER_SUFFIX))
+
+    def preload(self) -> int:
+        loaded = sum(1 for part_number in self.part_numbers() if self.get(part_number) is not None)
+        logger.info(f"Prepared {loaded} master templates at {self.size}x{self.size}")
+        return loaded
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"templates": len(self._templates), "builds": self.builds, "size": self.size,
+                "tolerance_px": self.tolerance}
+
+
+master_templates = MasterTemplateStore()
+
+
+def match_frame(frame: Union[np.ndarray, FrameFeatures], template: MasterTemplate,
+                threshold: float = MASTER_OVERLAP_THRESHOLD,
+                align: bool = POSE_ALIGN) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Score a frame's edges against a master. Returns (score, live edges).
+    frame is the image or its FrameFeatures bundle.
+
+    With align the valve's pose is estimated first and the live edge pixels
+    are carried into the master frame by it, so the score does not depend
+    on where the part lies. score["pose"] is None when no pose was found;
+    the frame is then stretched onto the template as before.
+    """
+    features = frame_features(frame)
+    edges = extract_edges(features)
+    rows, cols = edge_pixels(edges)
+    pose = estimate_pose(features.frame, rows, cols, template, pyramid=features.pyramid) if align else None
+    score = template.score_pixels(rows, cols, edges.shape, pose)
+    score["pose"] = pose.as_dict() if pose is not None else None
+    score["status"] = "PASS" if score["overlap"] >= threshold else "FAIL"
+    return score, edges
+
+
+def draw_match(frame: np.ndarray, template: MasterTemplate, live_edges: np.ndarray,
+               score: Dict[str, Any]) -> np.ndarray:
+    """Master edges in blue and live edges in green over the frame, with the verdict."""
+    overlay = frame.copy()
+    if score.get("pose"):
+        # The pose maps frame to template, so the master is drawn through its inverse.
+        master = cv2.warpAffine(template.edges, np.array(score["pose"]["matrix"]),
+                                (frame.shape[1], frame.shape[0]),
+                                flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+    else:
+        master = template.display_mask(frame.shape)
+    cv2.add(overlay, (204, 0, 0, 0), dst=overlay, mask=master)
+    cv2.add(overlay, (0, 204, 0, 0), dst=overlay, mask=live_edges)
+    cv2.putText(
+        overlay,
+        f"{score['status']} ({score['overlap'] * 100:.1f}%)",
+        (30, 50),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        1.2,
+        (0, 255, 0) if score["status"] == "PASS" else (0, 0, 255),
+        3
+    )
+    return overlay
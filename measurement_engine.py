@@ -0,0 +1,466 @@
+import os
+import math
+import time
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import MEASUREMENT_MM_PER_PX, TRAINED_IMAGES_FOLDER
+from frame_pyramid import FramePyramid
+from tolerances import unit_mismatch
+
+logger = logging.getLogger("measurement_engine")
+
+# Spec columns the engine measures, in the order of the value arrays.
+FEATURE_COLUMNS = ("Stem Diameter", "Head Diameter", "Groove Diameter", "Overall Length", "End Radius")
+# Sizes in mm a spec value can plausibly have for each feature; a cell that
+# falls outside belongs to another column and is not judged against.
+FEATURE_RANGES_MM = {
+    "Stem Diameter": (2.0, 20.0),
+    "Head Diameter": (10.0, 80.0),
+    "Groove Diameter": (2.0, 20.0),
+    "Overall Length": (40.0, 400.0),
+    "End Radius": (0.1, 10.0),
+}
+
+# ROI bands along the axis, as fractions of the overall length measured from
+# the head face towards the stem tip. Head, stem, groove and tip feed
+# FEATURE_COLUMNS; an optional third value overrides PROFILE_STEP. The
+# groove and the tip corner are read at every pixel, the rest more sparsely.
+PROFILE_BANDS = {
+    "head": (0.0, 0.15, 2.0),
+    "neck": (0.15, 0.35, 2.0),
+    "stem": (0.35, 0.80, 2.0),
+    "groove": (0.85, 0.98),
+    "tip": (0.80, 1.0),
+}
+# Distance in pixels between perpendicular profiles.
+PROFILE_STEP = 1.0
+# The silhouette is segmented on the frame reduced by the smallest power of
+# two that brings its longer side within this.
+SEGMENT_MAX_SIDE = 320
+
+CANNY_LOW = 50
+CANNY_HIGH = 150
+# Silhouettes smaller than this share of the frame are treated as noise.
+MIN_SILHOUETTE_FRACTION = 0.002
+
+
+class ScaleModel:
+    """mm-per-pixel conversion for measurements taken in the image plane."""
+
+    def __init__(self, mm_per_px: float = MEASUREMENT_MM_PER_PX, source: str = "config"):
+        self.mm_per_px = float(mm_per_px)
+        self.source = source
+
+    @classmethod
+    def from_reference(cls, measured_px: float, known_mm: float) -> "ScaleModel":
+        """Scale from a feature of known size, e.g. the overall length of a golden part."""
+        if measured_px <= 0:
+            raise ValueError("Reference feature was not measured")
+        return cls(known_mm / measured_px, source="reference")
+
+    def to_mm(self, pixels):
+        return np.asarray(pixels, dtype=np.float64) * self.mm_per_px
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"mm_per_px": self.mm_per_px, "source": self.source}
+
+
+scale_model = ScaleModel()
+
+
+class EdgeBand:
+    """Sub-pixel edges of the silhouette across one band of stations.
+
+    stations are fractions of the overall length from the head face; left
+    and right are the edge offsets in pixels from the axis, NaN where no
+    edge was found inside the sampled window.
+    """
+
+    __slots__ = ("name", "stations", "distance", "left", "right", "origin", "axis")
+
+    def __init__(self, name: str, stations: np.ndarray, distance: np.ndarray,
+                 left: np.ndarray, right: np.ndarray, origin, axis):
+        self.name = name
+        self.stations = stations
+        self.distance = distance
+        self.left = left
+        self.right = right
+        self.origin = origin
+        self.axis = axis
+
+    @property
+    def widths(self) -> np.ndarray:
+        return self.right - self.left
+
+    @property
+    def centers(self) -> np.ndarray:
+        """Offset of the mid-line from the axis at each station; its spread is the runout."""
+        return (self.right + self.left) / 2
+
+    def points(self) -> np.ndarray:
+        """(x, y) image coordinates of the edges found in this band."""
+        found = np.isfinite(self.left)
+        axis = np.asarray(self.axis)
+        normal = np.array([-axis[1], axis[0]])
+        along = np.asarray(self.origin) + self.distance[found, None] * axis
+        return np.concatenate([along + self.left[found, None] * normal,
+                               along + self.right[found, None] * normal])
+
+
+class ValveProfile:
+    """Edges of the valve silhouette sampled perpendicular to its axis.
+
+    The axis runs from the head face (distance 0) to the stem tip
+    (distance length_px); bands holds one EdgeBand per sampled ROI band.
+    """
+
+    def __init__(self, bands: Dict[str, EdgeBand], length_px: float, origin, axis,
+                 centroid, angle: float, contour: np.ndarray, complete: bool):
+        self.bands = bands
+        self.length_px = length_px
+        self.origin = origin
+        self.axis = axis
+        self.centroid = centroid
+        self.angle = angle
+        self.contour = contour
+        self.complete = complete
+
+    def band(self, name: str) -> np.ndarray:
+        band = self.bands.get(name)
+        return band.widths if band is not None else np.empty(0)
+
+    def diameters(self) -> Dict[str, np.ndarray]:
+        """Width in pixels at every station, per band."""
+        return {name: band.widths for name, band in self.bands.items()}
+
+    def edge_points(self) -> np.ndarray:
+        """(x, y) image coordinates of every edge found, for overlays."""
+        points = [band.points() for band in self.bands.values()]
+        return np.concatenate(points) if points else np.empty((0, 2))
+
+
+def _silhouette(blur: np.ndarray):
+    _, mask = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+    if np.count_nonzero(border) > border.size / 2:
+        # Backlit: dark part on a bright background.
+        mask = cv2.bitwise_not(mask)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if not contours:
+        return None, None
+    contour = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(contour) < MIN_SILHOUETTE_FRACTION * mask.size:
+        return None, None
+    filled = np.zeros_like(mask)
+    cv2.drawContours(filled, [contour], -1, 255, -1)
+    return filled, contour
+
+
+def _gray(image: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def _sample(frame: np.ndarray, origin, axis, t: np.ndarray, s: np.ndarray) -> np.ndarray:
+    """Grey levels on the grid origin + t * axis + s * normal, one row per t.
+    Only the sampled pixels are converted to grey."""
+    ax, ay = np.float32(axis[0]), np.float32(axis[1])
+    t = t.astype(np.float32)[:, None]
+    s = s.astype(np.float32)[None, :]
+    map_x = (t * ax + np.float32(origin[0])) - s * ay
+    map_y = (t * ay + np.float32(origin[1])) + s * ax
+    return _gray(cv2.remap(frame, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE))
+
+
+def _crossings(occupancy: np.ndarray, s: np.ndarray):
+    """Outermost 0.5 crossings of each row, interpolated between samples.
+
+    Rows whose silhouette reaches the end of the window get NaN, since the
+    edge may lie beyond it.
+    """
+    inside = occupancy >= 0.5
+    n = occupancy.shape[1]
+    rows = np.arange(occupancy.shape[0])
+    first = np.argmax(inside, axis=1)
+    last = n - 1 - np.argmax(inside[:, ::-1], axis=1)
+    # argmax gives 0 for a row with no part pixels, which fails the first test.
+    valid = (first > 0) & (last < n - 1)
+    first[first == 0] = 1
+    last[last == n - 1] = n - 2
+    step = s[1] - s[0]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        before, at = occupancy[rows, first - 1], occupancy[rows, first]
+        left = s[first] - step * (at - 0.5) / (at - before)
+        at, after = occupancy[rows, last], occupancy[rows, last + 1]
+        right = s[last] + step * (at - 0.5) / (at - after)
+    left[~valid] = np.nan
+    right[~valid] = np.nan
+    return left, right
+
+
+def contour_axis(contour: np.ndarray) -> Tuple[Tuple[float, float], float, np.ndarray]:
+    """(centroid, angle, axis) of a silhouette contour from its moments.
+
+    angle is the principal axis in radians; axis is the unit vector along
+    it, pointing from the head (the wider end) to the tip.
+    """
+    m = cv2.moments(contour)
+    centroid = (m["m10"] / m["m00"], m["m01"] / m["m00"])
+    angle = 0.5 * math.atan2(2 * m["mu11"], m["mu20"] - m["mu02"])
+    axis = np.array([math.cos(angle), math.sin(angle)])
+
+    points = contour.reshape(-1, 2) - centroid
+    t = points @ axis
+    s = points @ np.array([-axis[1], axis[0]])
+    tenth = 0.1 * (t.max() - t.min())
+    near_low, near_high = t < t.min() + tenth, t > t.max() - tenth
+    if np.ptp(s[near_high]) > np.ptp(s[near_low]):
+        axis = -axis
+    return centroid, angle, axis
+
+
+def extract_profile(frame: np.ndarray, bands: Dict[str, tuple] = None,
+                    step: float = PROFILE_STEP,
+                    pyramid: Optional[FramePyramid] = None) -> Optional[ValveProfile]:
+    """Locate the valve's edges to a fraction of a pixel along its axis.
+
+    The silhouette is segmented on a reduced copy of the frame, which is
+    enough for the principal axis, the ends and the grey levels of part and
+    background. Full-resolution pixels are then read only along lines
+    perpendicular to the axis inside each ROI band, and every edge is put
+    where the interpolated profile crosses halfway between the two levels.
+
+    bands maps a band name to (start, end) or (start, end, step), as
+    fractions of the overall length from the head face; PROFILE_BANDS by
+    default. The reduced copy comes from the frame's pyramid when the
+    caller shares one.
+    """
+    bands = PROFILE_BANDS if bands is None else bands
+
+    pyramid = pyramid or FramePyramid(frame)
+    level = pyramid.level_within(SEGMENT_MAX_SIDE)
+    factor = 2 ** level
+    blur = pyramid.blurred(level)
+    mask, contour = _silhouette(blur)
+    if mask is None:
+        return None
+
+    h, w = mask.shape
+    x, y, bw, bh = cv2.boundingRect(contour)
+    complete = x > 0 and y > 0 and x + bw < w and y + bh < h
+
+    inner = cv2.erode(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    near = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    part_pixels = blur[inner > 0]
+    fg = float(np.median(part_pixels)) if part_pixels.size else float(np.median(blur[mask > 0]))
+    outside = blur[near == 0]
+    bg = float(np.median(outside)) if outside.size else float(np.median(blur[mask == 0]))
+    if abs(fg - bg) < 1:
+        return None
+
+    # Reduced pixel i covers full-resolution pixels factor*i .. factor*(i+1) - 1.
+    offset = (factor - 1) / 2
+    centroid, angle, axis = contour_axis(contour)
+    centroid = (centroid[0] * factor + offset, centroid[1] * factor + offset)
+
+    points = contour.reshape(-1, 2) * factor + offset - centroid
+    t = points @ axis
+    s = points @ np.array([-axis[1], axis[0]])
+
+    # Refine both ends on the centreline at full resolution.
+    pad = 2 * factor + 2
+    line = np.arange(t.min() - pad, t.max() + pad, 0.25)
+    level = _sample(frame, centroid, axis, line, np.zeros(2, np.float64))[:, 0].astype(np.float32)
+    level = (level - bg) / (fg - bg)
+    head_t, tip_t = _crossings(level[None, :], line)
+    head_t, tip_t = float(head_t[0]), float(tip_t[0])
+    if not (np.isfinite(head_t) and np.isfinite(tip_t)):
+        head_t, tip_t = float(t.min()), float(t.max())
+    length = tip_t - head_t
+    origin = np.asarray(centroid) + head_t * axis
+    t = t - head_t
+
+    profile_bands = {}
+    for name, spec in bands.items():
+        start, end = spec[0] * length, spec[1] * length
+        band_step = spec[2] if len(spec) > 2 else step
+        stations = np.arange(start + band_step / 2, end, band_step)
+        if stations.size == 0:
+            continue
+        # Only as wide as the silhouette gets within this band.
+        within = (t >= start - pad) & (t <= end + pad)
+        half = (np.abs(s[within]).max() if within.any() else np.abs(s).max()) + pad
+        across = np.arange(-half, half + 1.0, 1.0)
+        grey = _sample(frame, origin, axis, stations, across)
+        # Smooth across the edge only, so neighbouring stations stay independent.
+        grey = cv2.GaussianBlur(grey.astype(np.float32), (5, 1), 0)
+        left, right = _crossings((grey - bg) / (fg - bg), across)
+        profile_bands[name] = EdgeBand(name, stations / length, stations, left, right,
+                                       tuple(origin), tuple(axis))
+
+    return ValveProfile(profile_bands, length, tuple(origin), tuple(axis), centroid, angle,
+                        contour * factor + int(offset), complete)
+
+
+def _band_stat(widths: np.ndarray, reduce) -> float:
+    widths = widths[np.isfinite(widths)]
+    return float(reduce(widths)) if widths.size else np.nan
+
+
+def feature_pixels(profile: ValveProfile) -> np.ndarray:
+    """Every feature of FEATURE_COLUMNS in pixels, from the band profiles."""
+    stem_d = _band_stat(profile.band("stem"), np.median)
+    tip = profile.bands.get("tip")
+    if tip is not None:
+        from_face = profile.length_px - tip.distance
+        order = np.argsort(from_face)
+        end_radius = end_radius_px(tip.widths[order], stem_d, from_face[order])
+    else:
+        end_radius = np.nan
+    return np.array([
+        stem_d,
+        _band_stat(profile.band("head"), np.max),
+        _band_stat(profile.band("groove"), np.min),
+        profile.length_px,
+        end_radius,
+    ])
+
+
+def end_radius_px(tip_widths: np.ndarray, stem_d: float, from_face: np.ndarray,
+                  step: float = 0.25) -> float:
+    """Corner radius of the stem tip, fitted to the widths measured at the
+    given distances from the tip face.
+
+    A corner of radius r narrows the profile at distance x < r from the face
+    by 2 * (r - sqrt(r^2 - (r - x)^2)). Every candidate radius up to the stem
+    radius is scored at once and the best least-squares fit is returned.
+    """
+    if not np.isfinite(stem_d) or stem_d <= 0:
+        return np.nan
+    keep = np.isfinite(tip_widths) & (from_face >= 0) & (from_face <= stem_d / 2)
+    observed, x = tip_widths[keep], from_face[keep]
+    if observed.size < 2:
+        return np.nan
+    radii = np.arange(step, stem_d / 2 + step, step)[:, None]
+    inside = np.clip(radii - x, 0, None)
+    predicted = stem_d - 2 * (radii - np.sqrt(np.clip(radii ** 2 - inside ** 2, 0, None)))
+    predicted[inside == 0] = stem_d
+    errors = ((predicted - observed) ** 2).sum(axis=1)
+    return float(radii[np.argmin(errors), 0])
+
+
+def spec_error(column: str, tolerance) -> Optional[str]:
+    """Why a compiled spec cell cannot be a size limit for column, or None.
+
+    The cell must be a size in mm (tolerances.unit_mismatch), must carry a
+    nominal or two limits rather than a lone Max/Min, and must lie within
+    FEATURE_RANGES_MM.
+    """
+    if tolerance is None or not tolerance.parsed or tolerance.kind == "text":
+        return None
+    if unit_mismatch(column, tolerance):
+        return f"unit {tolerance.unit} does not fit {column}"
+    if tolerance.nominal is None and (tolerance.lower is None or tolerance.upper is None):
+        return f"one-sided limit {tolerance.raw!r} is not a size"
+    size = tolerance.nominal if tolerance.nominal is not None else (tolerance.lower + tolerance.upper) / 2
+    low, high = FEATURE_RANGES_MM.get(column, (0.0, np.inf))
+    if not low <= size <= high:
+        return f"{size:g} mm is not a plausible {column}"
+    return None
+
+
+def spec_limits(spec) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Optional[str]]]:
+    """(nominal, lower, upper, errors) for FEATURE_COLUMNS. Features whose
+    cell fails spec_error get no nominal or limits and its reason in errors."""
+    nominal, lower, upper = spec.limits(FEATURE_COLUMNS)
+    errors = [spec_error(column, spec.tolerance(column)) for column in FEATURE_COLUMNS]
+    for i, error in enumerate(errors):
+        if error is not None:
+            nominal[i], lower[i], upper[i] = np.nan, -np.inf, np.inf
+    return nominal, lower, upper, errors
+
+
+def measure(frame: np.ndarray, spec=None, scale: Optional[ScaleModel] = None,
+            bands: Optional[Dict[str, tuple]] = None,
+            pyramid: Optional[FramePyramid] = None) -> Dict[str, Any]:
+    """Measure every feature of FEATURE_COLUMNS and judge them against the
+    spec's compiled tolerances in one vectorized step."""
+    scale = scale or scale_model
+    profile = extract_profile(frame, bands, pyramid=pyramid)
+    if profile is None:
+        return {"profile": None, "features": {}, "complete": False}
+
+    pixels = feature_pixels(profile)
+    measured = scale.to_mm(pixels)
+    if spec is not None:
+        nominal, lower, upper, errors = spec_limits(spec)
+    else:
+        nominal = np.full(len(FEATURE_COLUMNS), np.nan)
+        lower = np.full(len(FEATURE_COLUMNS), -np.inf)
+        upper = np.full(len(FEATURE_COLUMNS), np.inf)
+        errors = [None] * len(FEATURE_COLUMNS)
+    judged = np.isfinite(lower) | np.isfinite(upper)
+    passed = (measured >= lower) & (measured <= upper)
+
+    features = {}
+    for i, column in enumerate(FEATURE_COLUMNS):
+        features[column] = {
+            "measured_px": round(float(pixels[i]), 3) if np.isfinite(pixels[i]) else None,
+            "measured_mm": round(float(measured[i]), 3) if np.isfinite(measured[i]) else None,
+            "nominal": None if np.isnan(nominal[i]) else float(nominal[i]),
+            "expected_min": float(lower[i]) if np.isfinite(lower[i]) else None,
+            "expected_max": float(upper[i]) if np.isfinite(upper[i]) else None,
+            "status": ("PASS" if passed[i] else "FAIL") if judged[i] and np.isfinite(measured[i]) else "N/A",
+            "spec_error": errors[i],
+        }
+    return {"profile": profile, "features": features, "complete": profile.complete, "scale": scale.as_dict()}
+
+
+def benchmark(folder: str = TRAINED_IMAGES_FOLDER, repeat: int = 3) -> List[Dict[str, Any]]:
+    """Time a full-frame Canny pass against the profile engine on every
+    image under folder."""
+    from utils import get_all_images_from_subfolders
+
+    results = []
+    for path in get_all_images_from_subfolders(folder):
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), CANNY_LOW, CANNY_HIGH)
+        canny_ms = 1000 * (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outcome = measure(frame)
+        engine_ms = 1000 * (time.perf_counter() - start) / repeat
+
+        results.append({
+            "image": os.path.relpath(path, folder),
+            "shape": frame.shape[:2],
+            "canny_ms": round(canny_ms, 2),
+            "engine_ms": round(engine_ms, 2),
+            "complete": outcome["complete"],
+            "pixels": {c: f["measured_px"] for c, f in outcome["features"].items()},
+        })
+    return results
+
+
+if __name__ == "__main__":
+    rows = benchmark()
+    for row in rows:
+        px = row["pixels"]
+        print(f"{row['image'][:45]:45s} {str(row['shape']):13s} canny {row['canny_ms']:7.2f} ms  "
+              f"engine {row['engine_ms']:7.2f} ms  complete={row['complete']!s:5s} "
+              f"stem={px.get('Stem Diameter')} head={px.get('Head Diameter')} len={px.get('Overall Length')}")
+    if rows:
+        print(f"mean canny {np.mean([r['canny_ms'] for r in rows]):.2f} ms, "
+              f"mean engine {np.mean([r['engine_ms'] for r in rows]):.2f} ms over {len(rows)} images")
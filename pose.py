@@ -0,0 +1,167 @@
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import (POSE_LEVELS, POSE_ITERATIONS, POSE_ANGLE_STEP_DEG, POSE_MAX_POINTS,
+                    POSE_TRUNCATE_PX)
+from frame_pyramid import FramePyramid
+from measurement_engine import contour_axis, extract_profile
+
+# The 27 moves of one search step: angle, x and y each by -1, 0 or +1 steps.
+MOVES = np.array([(a, x, y) for a in (-1, 0, 1) for x in (-1, 0, 1) for y in (-1, 0, 1)],
+                 dtype=np.float64)
+
+
+class Pose:
+    """Rigid transform from frame pixels to template pixels.
+
+    matrix is the 2x3 affine matrix (rotation, the fixed frame-to-template
+    scale and translation); angle is the rotation in degrees and cost the
+    truncated mean distance of the live edges to the master after the search.
+    """
+
+    def __init__(self, matrix: np.ndarray, angle: float, cost: float, evaluations: int):
+        self.matrix = matrix
+        self.angle = angle
+        self.cost = cost
+        self.evaluations = evaluations
+
+    def apply(self, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        m = self.matrix
+        return m[0, 0] * xs + m[0, 1] * ys + m[0, 2], m[1, 0] * xs + m[1, 1] * ys + m[1, 2]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "angle": round(self.angle, 2),
+            "shift": [round(float(self.matrix[0, 2]), 1), round(float(self.matrix[1, 2]), 1)],
+            "cost": round(self.cost, 3),
+            "evaluations": self.evaluations,
+            "matrix": self.matrix.tolist(),
+        }
+
+
+def silhouette_pose(edges: np.ndarray) -> Optional[Tuple[Tuple[float, float], np.ndarray]]:
+    """(centroid, head-to-tip axis) of the area closed by an edge drawing's
+    outer contour, as for a master's outline."""
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if not contours:
+        return None
+    contour = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(contour) <= 0:
+        return None
+    centroid, _, axis = contour_axis(contour)
+    return centroid, axis
+
+
+def distance_pyramid(distance: np.ndarray, levels: int = POSE_LEVELS,
+                     truncate: float = POSE_TRUNCATE_PX) -> List[np.ndarray]:
+    """The master's distance transform, truncated and halved level by level.
+
+    Level i is 2**i times smaller and holds distances in template pixels,
+    so costs read at different levels stay comparable. Every level has a
+    one-pixel border at the truncation distance, so points that fall off
+    the template can be clamped onto it instead of being masked out.
+    """
+    levels_out = [np.minimum(distance, truncate).astype(np.float32)]
+    for _ in range(1, levels):
+        top = levels_out[-1]
+        if min(top.shape) < 16:
+            break
+        levels_out.append(cv2.resize(top, (top.shape[1] // 2, top.shape[0] // 2),
+                                     interpolation=cv2.INTER_AREA))
+    return [cv2.copyMakeBorder(level, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=truncate)
+            for level in levels_out]
+
+
+def _costs(level: np.ndarray, shrink: float, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """Mean distance, on a padded pyramid level, for each row of candidate
+    template coordinates."""
+    h, w = level.shape
+    # Nearest pixel, shifted by the border.
+    scale = np.float32(1.0 / shrink)
+    cols = np.clip(xs * scale + 1.5, 0, w - 1).astype(np.int32)
+    rows = np.clip(ys * scale + 1.5, 0, h - 1).astype(np.int32)
+    return np.take(level, rows * w + cols).mean(axis=1)
+
+
+def estimate_pose(frame: np.ndarray, rows: np.ndarray, cols: np.ndarray, template,
+                  iterations: int = POSE_ITERATIONS, angle_step: float = POSE_ANGLE_STEP_DEG,
+                  max_points: int = POSE_MAX_POINTS,
+                  pyramid: Optional[FramePyramid] = None) -> Optional[Pose]:
+    """Rotation and translation that carry the frame's valve onto the master.
+
+    The first guess lines up the centroids and head-to-tip axes of the two
+    silhouettes. It is refined by a coarse-to-fine search over the master's
+    distance pyramid: at each level the angle and shift move by one step in
+    whichever of the 27 directions lowers the truncated chamfer cost of a
+    subsample of the live edges, for at most `iterations` moves, and the
+    steps halve from level to level. The work per frame is therefore bounded
+    by levels * iterations * 27 lookups of at most max_points points.
+
+    rows and cols are the live edge pixels. Returns None when either
+    silhouette cannot be found.
+    """
+    if template.pose is None:
+        return None
+    profile = extract_profile(frame, bands={}, pyramid=pyramid)
+    if profile is None:
+        return None
+    if cols.size == 0:
+        return None
+    stride = max(1, cols.size // max_points)
+    xs, ys = cols[::stride].astype(np.float64), rows[::stride].astype(np.float64)
+
+    (mx, my), master_axis = template.pose
+    lx, ly = profile.centroid
+    live_axis = profile.axis
+    scale = template.scale
+    base = math.degrees(math.atan2(master_axis[1], master_axis[0])
+                        - math.atan2(live_axis[1], live_axis[0]))
+    # Frame points relative to the live centroid, at template scale.
+    px = ((xs - lx) * scale).astype(np.float32)
+    py = ((ys - ly) * scale).astype(np.float32)
+
+    def place(candidates, thin):
+        # Single precision halves the work and is ample at template scale.
+        candidates = candidates.astype(np.float32)
+        theta = np.radians(candidates[:, :1])
+        c, s = np.cos(theta), np.sin(theta)
+        x, y = px[::thin], py[::thin]
+        return c * x - s * y + mx + candidates[:, 1:2], s * x + c * y + my + candidates[:, 2:3]
+
+    pyramid = template.pyramid
+
+    # The head end of a poorly lit part can be misjudged, so the coarse
+    # level also tries the guess turned half a revolution.
+    top = len(pyramid) - 1
+    guesses = np.array([[base, 0.0, 0.0], [base + 180.0, 0.0, 0.0]])
+    costs = _costs(pyramid[top], 2.0 ** top, *place(guesses, 2 ** top))
+    evaluations = 2
+    angle, dx, dy = guesses[int(np.argmin(costs))]
+
+    for index in range(top, -1, -1):
+        # Coarser levels cannot resolve finer detail, so they read fewer points.
+        level, shrink, thin = pyramid[index], 2.0 ** index, 2 ** index
+        step = np.array([angle_step * shrink, shrink, shrink])
+        best = float(_costs(level, shrink, *place(np.array([[angle, dx, dy]]), thin))[0])
+        evaluations += 1
+        for _ in range(iterations):
+            candidates = np.array([angle, dx, dy]) + MOVES * step
+            costs = _costs(level, shrink, *place(candidates, thin))
+            evaluations += len(MOVES)
+            move = int(np.argmin(costs))
+            if costs[move] >= best:
+                break
+            best = float(costs[move])
+            angle, dx, dy = candidates[move]
+
+    angle, dx, dy = float(angle), float(dx), float(dy)
+    theta = math.radians(angle)
+    c, s = math.cos(theta) * scale, math.sin(theta) * scale
+    matrix = np.array([
+        [c, -s, mx + dx - c * lx + s * ly],
+        [s, c, my + dy - s * lx - c * ly],
+    ])
+    return Pose(matrix, (angle + 180.0) % 360.0 - 180.0, best, evaluations)
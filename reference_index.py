@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+import cv2
+
+from config import TRAINED_IMAGES_FOLDER, REFERENCE_INDEX_PATH
+from edge_matcher import EdgeMatcher
+from frame_features import FrameFeatures
+from utils import get_all_images_from_subfolders
+
+INDEX_VERSION = 3
+
+logger = logging.getLogger("reference_index")
+
+
+class ReferenceIndex:
+    """Edge features of every trained reference image, kept in memory and
+    mirrored to a JSON file so a restart does not re-decode the references.
+
+    Entries are keyed by the image path relative to the trained folder and
+    carry the file's mtime/size, so only new or changed images are
+    re-processed when the index is refreshed.
+    """
+
+    def __init__(self, trained_folder: str = TRAINED_IMAGES_FOLDER,
+                 index_path: str = REFERENCE_INDEX_PATH, read_only: bool = False):
+        self.trained_folder = trained_folder
+        self.index_path = index_path
+        # A read-only index serves the saved file as it is: no refresh, no writes.
+        self.read_only = read_only
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._matcher: Optional[EdgeMatcher] = None
+        self._matcher_version = -1
+        self.version = 0
+
+    def _key(self, path: str) -> str:
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(self.trained_folder))
+        return rel.replace(os.sep, "/")
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return {"mtime": st.st_mtime, "size": st.st_size}
+
+    def _compute_entry(self, path: str, stat: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        img = cv2.imread(path)
+        if img is None:
+            logger.warning(f"Reference image unreadable: {path}")
+            return None
+
+        features = FrameFeatures(img).edge_features
+        if not features:
+            logger.warning(f"No edges found in reference image: {path}")
+            return None
+
+        return {
+            "subfolder": os.path.basename(os.path.dirname(path)),
+            "name": os.path.splitext(os.path.basename(path))[0],
+            "mtime": stat["mtime"],
+            "size": stat["size"],
+            "features": features,
+        }
+
+    def load(self) -> None:
+        """Load the persisted index and bring it in line with the folder."""
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(self.index_path):
+                try:
+                    with open(self.index_path, "r") as f:
+                        data = json.load(f)
+                    if data.get("version") == INDEX_VERSION:
+                        self._entries = data.get("entries", {})
+                except Exception as e:
+                    logger.warning(f"Reference index unreadable, rebuilding: {e}")
+            self._loaded = True
+            if self.read_only:
+                self._bump()
+                logger.info(f"Reference index mapped read-only: {len(self._entries)} images")
+            else:
+                self.refresh()
+
+    def ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def refresh(self) -> int:
+        """Re-process new or modified images and drop deleted ones.
+
+        Only stats the files; images whose mtime and size match the stored
+        entry are not decoded again. Returns the number of changed entries.
+        """
+        with self._lock:
+            seen = set()
+            changed = 0
+            for path in get_all_images_from_subfolders(self.trained_folder):
+                key = self._key(path)
+                seen.add(key)
+                stat = self._stat(path)
+                if stat is None:
+                    continue
+                entry = self._entries.get(key)
+                if entry and entry["mtime"] == stat["mtime"] and entry["size"] == stat["size"]:
+                    continue
+                new_entry = self._compute_entry(path, stat)
+                if new_entry is None:
+                    self._entries.pop(key, None)
+                else:
+                    self._entries[key] = new_entry
+                changed += 1
+
+            for key in [k for k in self._entries if k not in seen]:
+                del self._entries[key]
+                changed += 1
+
+            if changed:
+                self._bump()
+            logger.info(f"Reference index ready: {len(self._entries)} images ({changed} updated)")
+            return changed
+
+    def add_image(self, path: str) -> Optional[Dict[str, Any]]:
+        """Index (or re-index) a single reference image, e.g. after training."""
+        self.ensure_loaded()
+        stat = self._stat(path)
+        if stat is None:
+            return None
+        entry = self._compute_entry(path, stat)
+        with self._lock:
+            key = self._key(path)
+            if entry is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = entry
+            self._bump()
+        return entry
+
+    def remove_image(self, path: str) -> None:
+        with self._lock:
+            if self._entries.pop(self._key(path), None) is not None:
+                self._bump()
+
+    def entries(self) -> List[Dict[str, Any]]:
+        self.ensure_loaded()
+        with self._lock:
+            return [self._entries[k] for k in sorted(self._entries)]
+
+    def matcher(self) -> EdgeMatcher:
+        """Vectorized scorer over the current entries, rebuilt only after
+        the index changes."""
+        self.ensure_loaded()
+        with self._lock:
+            if self._matcher is None or self._matcher_version != self.version:
+                self._matcher = EdgeMatcher(self.entries())
+                self._matcher_version = self.version
+            return self._matcher
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _bump(self) -> None:
+        self.version += 1
+        self._save()
+
+    def _save(self) -> None:
+        if self.read_only:
+            return
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION, "entries": self._entries}, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.error(f"Failed to save reference index: {e}")
+
+
+reference_index = ReferenceIndex()
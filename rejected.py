@@ -13,21 +13,21 @@ def load_defect_counts_from_db():
     counts = defaultdict(int)
     try:
        
-        connection = db_manager.get_connection() 
-        if connection:
-            cursor = connection.cursor()
-            cursor.execute("""
-                SELECT Defect_type, COUNT(*) 
-                FROM inspections 
-                WHERE Result = 'Rejected'
-                GROUP BY Defect_type
-            """)
-            results = cursor.fetchall()
-            cursor.close()  
-            for defect_type, count in results:
-                defect_type = defect_type.strip() if defect_type else "Unknown"
-                counts[defect_type] += count
-        print("Defect counts from DB:", counts)
+        with db_manager.connection() as connection:
+            if connection:
+                cursor = connection.cursor()
+                cursor.execute("""
+                    SELECT Defect_type, COUNT(*) 
+                    FROM inspections 
+                    WHERE Result = 'Rejected'
+                    GROUP BY Defect_type
+                """)
+                results = cursor.fetchall()
+                cursor.close()  
+                for defect_type, count in results:
+                    defect_type = defect_type.strip() if defect_type else "Unknown"
+                    counts[defect_type] += count
+            print("Defect counts from DB:", counts)
     except Exception as e:
         print("[DB ERROR]", e)
     return dict(counts)
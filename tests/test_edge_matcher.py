@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from edge_matcher import EdgeMatcher
+from image_processing import compare_edge_features
+
+PARTS = ("48465", "48460", "46152")
+
+
+def feature_dict(rng):
+    return {
+        "area": float(rng.uniform(500, 5000)),
+        "perimeter": float(rng.uniform(100, 900)),
+        "solidity": float(rng.uniform(0.5, 1.0)),
+        "aspect_ratio": float(rng.uniform(0.1, 4.0)),
+        "extent": float(rng.uniform(0.3, 1.0)),
+        "hu_moments": list(rng.normal(0, 1e-3, 7) * 10.0 ** -rng.integers(0, 6, 7)),
+    }
+
+
+@pytest.fixture(scope="module")
+def references():
+    rng = np.random.default_rng(7)
+    entries = [{"name": f"ref_{i}.jpg", "subfolder": PARTS[i % len(PARTS)], "features": feature_dict(rng)}
+               for i in range(60)]
+    # A zero-area reference and an exact duplicate exercise the guards and tie order.
+    entries[5]["features"]["area"] = 0.0
+    entries[40]["features"] = dict(entries[10]["features"])
+    return entries
+
+
+@pytest.fixture(scope="module")
+def tests():
+    rng = np.random.default_rng(11)
+    return [feature_dict(rng) for _ in range(20)]
+
+
+def scalar_best(test, entries):
+    """The original loop: first reference with a strictly greater score."""
+    best_score, best = 0.0, None
+    for entry in entries:
+        score = compare_edge_features(test, entry["features"])
+        if score > best_score:
+            best_score, best = score, entry
+    return best_score, best
+
+
+def test_scores_match_scalar_formula(references, tests):
+    matcher = EdgeMatcher(references)
+    for test in tests:
+        expected = [compare_edge_features(test, e["features"]) for e in references]
+        np.testing.assert_allclose(matcher.score(test), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_best_match_matches_scalar_loop(references, tests):
+    matcher = EdgeMatcher(references)
+    for test in tests + [dict(references[10]["features"])]:
+        best_score, best = scalar_best(test, references)
+        match = matcher.top_k(test, k=1)[0]
+        assert match["score"] == pytest.approx(best_score, abs=1e-12)
+        assert match["best_match"] == best["name"]
+        assert match["subfolder"] == best["subfolder"]
+
+
+def test_top_k_is_the_scalar_ranking(references, tests):
+    matcher = EdgeMatcher(references)
+    for test in tests:
+        scores = [compare_edge_features(test, e["features"]) for e in references]
+        ranked = sorted(range(len(references)), key=lambda i: -scores[i])[:5]
+        assert [m["best_match"] for m in matcher.top_k(test, k=5)] == [references[i]["name"] for i in ranked]
+
+
+def test_part_scoping_matches_scalar_loop_over_that_part(references, tests):
+    matcher = EdgeMatcher(references)
+    for part in PARTS:
+        scoped = [e for e in references if e["subfolder"] == part]
+        for test in tests:
+            np.testing.assert_allclose(matcher.score(test, part),
+                                       [compare_edge_features(test, e["features"]) for e in scoped],
+                                       rtol=1e-12, atol=1e-12)
+            best_score, best = scalar_best(test, scoped)
+            match = matcher.top_k(test, k=1, part_number=part)[0]
+            assert match["best_match"] == best["name"]
+            assert match["subfolder"] == part
+            assert match["score"] == pytest.approx(best_score, abs=1e-12)
+
+
+def test_unknown_part_and_empty_features(references, tests):
+    matcher = EdgeMatcher(references)
+    assert matcher.top_k(tests[0], part_number="99999") == []
+    assert not matcher.has_part("99999")
+    assert matcher.top_k(None) == []
+    assert matcher.top_k({}) == []
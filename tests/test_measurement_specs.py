@@ -0,0 +1,56 @@
+import math
+
+import pytest
+
+from config import VALVE_CSV_PATH
+from measurement_engine import FEATURE_COLUMNS, spec_limits
+from valve_catalog import ValveCatalog
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    catalog = ValveCatalog(source="csv", csv_path=VALVE_CSV_PATH)
+    assert catalog.load()
+    return catalog
+
+
+def limits_of(catalog, part_number):
+    nominal, lower, upper, errors = spec_limits(catalog.spec(part_number))
+    return {column: (nominal[i], lower[i], upper[i], errors[i]) for i, column in enumerate(FEATURE_COLUMNS)}
+
+
+def test_known_part_has_sane_size_limits(catalog):
+    limits = limits_of(catalog, "48465")
+
+    nominal, lower, upper, error = limits["Stem Diameter"]
+    assert error is None
+    assert 5.45 < lower < upper < 5.48
+
+    nominal, lower, upper, error = limits["Head Diameter"]
+    assert error is None
+    assert (lower, upper) == pytest.approx((24.9, 25.1))
+
+    nominal, _, _, error = limits["Overall Length"]
+    assert error is None
+    assert nominal == pytest.approx(122.83)
+
+
+def test_every_part_has_a_plausible_stem(catalog):
+    for part_number in catalog.part_numbers():
+        nominal, lower, upper, error = limits_of(catalog, part_number)["Stem Diameter"]
+        assert error is None, part_number
+        assert 5.4 < lower < upper < 5.5, part_number
+
+
+def test_cells_that_are_not_sizes_are_not_judged(catalog):
+    # 48460's Head Diameter cell holds a runout ('0.05 Max').
+    nominal, lower, upper, error = limits_of(catalog, "48460")["Head Diameter"]
+    assert error is not None
+    assert math.isnan(nominal) and lower == -math.inf and upper == math.inf
+
+
+def test_shifted_rows_are_realigned(catalog):
+    spec = catalog.spec("48465")
+    assert spec.get("Face Chamfer") == "C0.3"
+    assert spec.get("Valve Weight") == "0.040Kg"
+    assert not catalog.unit_mismatches() or all(p != "48465" for p, _, _ in catalog.unit_mismatches())
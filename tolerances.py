@@ -0,0 +1,301 @@
+import re
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Columns of the spec table that are identifiers rather than specs.
+ID_COLUMNS = ("Part Number", "Part Name")
+
+KINDS = ("bilateral", "deviation", "range", "max", "min", "basic", "reference", "text", "unparsed")
+
+_NUM = r"\d+(?:\.\d+)?|\.\d+"
+_ANGLE = re.compile(r"(\d+(?:\.\d+)?)\s*°\s*(?:(\d+(?:\.\d+)?)\s*')?")
+_MINUTES = re.compile(r"(\d+(?:\.\d+)?)\s*'")
+_PAREN = re.compile(r"\(([^)]*)\)")
+_ROUGHNESS = re.compile(r"(?<![A-Za-z])(Rmax|Ra|Rz)(?![A-Za-z])")
+_HARDNESS_HV = re.compile(r"(?i)h\s*v\s*(?:\(\s*(?:" + _NUM + r")\s*\)|" + _NUM + r")?")
+_HRC = re.compile(r"(?i)hrc")
+_MM = re.compile(r"(?i)(?<=[\d\s])mm\b")
+_KG = re.compile(r"(?i)(?<=[\d\s])kg\b")
+_MIN = re.compile(r"(?i)(?<![a-z])min(?![a-z])\.?")
+_MAX = re.compile(r"(?i)(?<![a-z])max(?![a-z])\.?")
+_REF = re.compile(r"(?i)(?<![a-z])ref(?![a-z])\.?")
+_DEEP = re.compile(r"(?i)\bdeep\b")
+_TO = re.compile(r"(?i)\bto\b")
+_OR = re.compile(r"(?i)\s+or\s+")
+_RADIUS = re.compile(r"(?<![A-Za-z])R\s*(?=[\d.])")
+_CHAMFER = re.compile(r"^C(?=[\d.])")
+_CHAMFER_ANGLE = re.compile(r"\*\s*[\d.]+\s*°")
+
+_SINGLE = re.compile(r"^(" + _NUM + r")$")
+_BILATERAL = re.compile(r"^(" + _NUM + r")±(" + _NUM + r")$")
+_RANGE = re.compile(r"^(" + _NUM + r")[/-](" + _NUM + r")$")
+_DEVIATION = re.compile(r"^(" + _NUM + r")([+-](?:" + _NUM + r"))/?([+-](?:" + _NUM + r"))?$")
+
+
+class Tolerance:
+    """A spec cell compiled to numbers.
+
+    lower/upper are the acceptance limits (None = unbounded on that side),
+    nominal the drawing value when there is one. qualifier is 'R' for a
+    radius and 'C' for a chamfer callout. Cells that are plain text, such
+    as identification marks or finishing processes, get kind 'text'; cells
+    with numbers that match none of the notations get kind 'unparsed'.
+    """
+
+    __slots__ = ("raw", "kind", "nominal", "lower", "upper", "unit", "qualifier", "note")
+
+    def __init__(self, raw: str, kind: str, nominal: Optional[float] = None,
+                 lower: Optional[float] = None, upper: Optional[float] = None,
+                 unit: Optional[str] = None, qualifier: Optional[str] = None,
+                 note: Optional[str] = None):
+        self.raw = raw
+        self.kind = kind
+        self.nominal = nominal
+        self.lower = lower
+        self.upper = upper
+        self.unit = unit
+        self.qualifier = qualifier
+        self.note = note
+
+    @property
+    def parsed(self) -> bool:
+        return self.kind != "unparsed"
+
+    @property
+    def has_limits(self) -> bool:
+        return self.lower is not None or self.upper is not None
+
+    def contains(self, value: float) -> Optional[bool]:
+        """True/False against the limits, None when the spec has none."""
+        if not self.has_limits:
+            return None
+        if self.lower is not None and value < self.lower:
+            return False
+        if self.upper is not None and value > self.upper:
+            return False
+        return True
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Tolerance({self.raw!r}, {self.kind}, [{self.lower}, {self.upper}] {self.unit or ''})"
+
+
+def _to_degrees(match) -> str:
+    degrees = float(match.group(1))
+    if match.group(2):
+        degrees += float(match.group(2)) / 60
+    return repr(round(degrees, 6))
+
+
+def _round(value: float) -> float:
+    return round(value, 6)
+
+
+def parse_tolerance(raw: Any) -> Optional[Tolerance]:
+    """Compile one spec cell. Returns None for an empty cell."""
+    if raw is None:
+        return None
+    if isinstance(raw, (int, float)) and not isinstance(raw, bool):
+        if isinstance(raw, float) and math.isnan(raw):
+            return None
+        return Tolerance(str(raw), "basic", nominal=float(raw), unit="mm")
+    text = str(raw).strip()
+    if not text:
+        return None
+
+    s = text.replace("+/-", "±")
+    unit = qualifier = None
+    notes: List[str] = []
+    reference = is_min = is_max = False
+
+    alternatives = _OR.split(s)
+    if len(alternatives) > 1:
+        s = alternatives[0]
+        notes.append("alternatives: " + " | ".join(alternatives[1:]))
+
+    if _CHAMFER_ANGLE.search(s):
+        notes.append("at " + _CHAMFER_ANGLE.search(s).group(0).lstrip("* "))
+        s = _CHAMFER_ANGLE.sub("", s)
+
+    # Parentheses hold a hardness criterion for a case depth ("1 mm Min (Hv 450)"),
+    # a test load ("(HV0.2) 600 Min") or, around the whole value, a reference dimension.
+    for match in list(_PAREN.finditer(s)):
+        inner = match.group(1)
+        numbers = [float(n) for n in re.findall(_NUM, inner)]
+        if re.search(r"(?i)h\s*v", inner) and any(n >= 50 for n in numbers):
+            notes.append(inner.strip())
+            s = s.replace(match.group(0), " ")
+        elif re.search(r"(?i)h\s*v", inner):
+            unit = "HV"
+            s = s.replace(match.group(0), " ")
+        elif match.start() == 0 and numbers:
+            reference = True
+            s = s.replace(match.group(0), re.findall(_NUM, inner)[0])
+    if _REF.search(s):
+        reference = True
+        s = _REF.sub(" ", s)
+
+    if _ROUGHNESS.search(s):
+        unit = _ROUGHNESS.search(s).group(1)
+        s = _ROUGHNESS.sub(" ", s)
+        is_max = True  # a roughness value is an upper limit
+    if _HRC.search(s):
+        unit = "HRC"
+        s = _HRC.sub(" ", s)
+    if _HARDNESS_HV.search(s):
+        unit = "HV"
+        s = _HARDNESS_HV.sub(" ", s)
+    if _KG.search(s):
+        unit = "kg"
+        s = _KG.sub(" ", s)
+    if _MM.search(s):
+        unit = "mm"
+        s = _MM.sub(" ", s)
+    s = _DEEP.sub(" ", s)
+    if _MIN.search(s):
+        is_min = True
+        s = _MIN.sub(" ", s)
+    if _MAX.search(s):
+        is_max = True
+        s = _MAX.sub(" ", s)
+    s = _TO.sub("/", s)
+    if _RADIUS.search(s):
+        qualifier = "R"
+        s = _RADIUS.sub("", s)
+    if _CHAMFER.search(s.strip()):
+        qualifier = "C"
+        s = _CHAMFER.sub("", s.strip())
+    if "°" in s:
+        unit = "deg"
+        s = _ANGLE.sub(_to_degrees, s)
+        s = _MINUTES.sub(lambda m: repr(round(float(m.group(1)) / 60, 6)), s)
+
+    note = "; ".join(notes) or None
+    expr = re.sub(r"\s+", "", s)
+    if re.search(r"[A-Za-z]", expr) or not re.search(r"\d", expr):
+        kind = "text" if re.match(r"[A-Za-z]", text) else "unparsed"
+        return Tolerance(text, kind, note=note)
+    unit = unit or "mm"
+
+    def build(kind, nominal=None, lower=None, upper=None):
+        return Tolerance(text, kind,
+                         nominal=None if nominal is None else _round(nominal),
+                         lower=None if lower is None else _round(lower),
+                         upper=None if upper is None else _round(upper),
+                         unit=unit, qualifier=qualifier, note=note)
+
+    m = _SINGLE.match(expr)
+    if m:
+        value = float(m.group(1))
+        if is_min:
+            return build("min", lower=value)
+        if is_max:
+            return build("max", upper=value)
+        return build("reference" if reference else "basic", nominal=value)
+
+    m = _BILATERAL.match(expr)
+    if m:
+        nominal, tol = float(m.group(1)), float(m.group(2))
+        return build("bilateral", nominal, nominal - tol, nominal + tol)
+
+    m = _RANGE.match(expr)
+    if m:
+        a, b = float(m.group(1)), float(m.group(2))
+        # "0.3-0.5" is a range; "4.66-0.1" is a one-sided deviation, handled below.
+        if "/" in expr or b > a:
+            return build("range", (a + b) / 2, min(a, b), max(a, b))
+
+    m = _DEVIATION.match(expr)
+    if m:
+        nominal = float(m.group(1))
+        deviations = [float(d) for d in m.groups()[1:] if d is not None]
+        if len(deviations) == 1:
+            deviations.append(0.0)
+        return build("deviation", nominal, nominal + min(deviations), nominal + max(deviations))
+
+    return Tolerance(text, "unparsed", note=note)
+
+
+def compile_tolerances(fields: Dict[str, Any], skip: Iterable[str] = ID_COLUMNS) -> Dict[str, Tolerance]:
+    """Compile every non-empty spec cell of one part."""
+    skip = set(skip)
+    out = {}
+    for column, raw in fields.items():
+        if column in skip:
+            continue
+        tolerance = parse_tolerance(raw)
+        if tolerance is not None:
+            out[column] = tolerance
+    return out
+
+
+# Unit a column should compile to, from keywords in its name. Catches cells
+# that have slid into the wrong column, e.g. a roughness under a diameter.
+_COLUMN_UNITS = (
+    ("finish", ("Ra", "Rz", "Rmax")),
+    ("hardness", ("HRC", "HV")),
+    ("weight", ("kg",)),
+    ("angle", ("deg",)),
+    ("diameter", ("mm",)),
+    ("length", ("mm",)),
+    ("radius", ("mm",)),
+)
+
+
+def expected_units(column: str) -> Optional[Tuple[str, ...]]:
+    name = column.lower()
+    for keyword, units in _COLUMN_UNITS:
+        if keyword in name:
+            return units
+    return None
+
+
+def unit_mismatch(column: str, tolerance: Tolerance) -> bool:
+    units = expected_units(column)
+    return units is not None and tolerance.unit is not None and tolerance.unit not in units
+
+
+def limits(tolerances: Dict[str, Tolerance], columns: Iterable[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(nominal, lower, upper) arrays for the given columns. Missing values
+    are NaN for the nominal and -inf/+inf for the limits."""
+    columns = list(columns)
+    nominal = np.full(len(columns), np.nan)
+    lower = np.full(len(columns), -np.inf)
+    upper = np.full(len(columns), np.inf)
+    for i, column in enumerate(columns):
+        tolerance = tolerances.get(column)
+        if tolerance is None:
+            continue
+        if tolerance.nominal is not None:
+            nominal[i] = tolerance.nominal
+        if tolerance.lower is not None:
+            lower[i] = tolerance.lower
+        if tolerance.upper is not None:
+            upper[i] = tolerance.upper
+    return nominal, lower, upper
+
+
+if __name__ == "__main__":
+    from collections import Counter
+
+    from valve_catalog import ValveCatalog
+
+    catalog = ValveCatalog(source="csv")
+    catalog.load()
+    kinds = Counter()
+    for part_number in catalog.part_numbers():
+        for column, tolerance in catalog.spec(part_number).tolerances.items():
+            kinds[tolerance.kind] += 1
+    print("Compiled spec cells by kind:", dict(kinds))
+    report = catalog.parse_report()
+    print(f"{len(report)} cells could not be parsed")
+    for part_number, column, raw in report:
+        print(f"  {part_number:>8s}  {column:40s} {raw!r}")
+    mismatches = catalog.unit_mismatches()
+    print(f"{len(mismatches)} cells have a unit that does not fit their column")
+    for part_number, column, raw in mismatches:
+        print(f"  {part_number:>8s}  {column:40s} {raw!r}")
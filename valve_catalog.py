@@ -0,0 +1,299 @@
+import os
+import csv
+import json
+import hashlib
+import math
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import VALVE_CSV_PATH, VALVE_SPEC_SOURCE, VALVE_CATALOG_TTL
+from tolerances import Tolerance, compile_tolerances, limits, parse_tolerance, unit_mismatch
+
+logger = logging.getLogger("valve_catalog")
+
+PART_NUMBER_COLUMN = "Part Number"
+PART_NAME_COLUMN = "Part Name"
+
+
+def normalize_part_number(part_number) -> str:
+    """'48465', ' 48465 ', 48465 and 48465.0 all map to '48465'."""
+    if part_number is None:
+        return ""
+    text = str(part_number).strip()
+    if text.endswith(".0") and text[:-2].isdigit():
+        text = text[:-2]
+    return text
+
+
+def _clean(value) -> Any:
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+
+def rows_digest(rows: List[Dict[str, Any]]) -> str:
+    return hashlib.sha1(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def extra_cell_position(header: List[str], rows: List[List[str]]) -> int:
+    """Where rows with one cell more than the header have the cell that has
+    no header of its own.
+
+    Every position is tried at once: cells before it are read under their
+    own header and cells after it under the previous one. The position
+    whose reading leaves the fewest cells with a unit that contradicts
+    their column (tolerances.unit_mismatch) wins; ties go to the latest.
+    """
+    n = len(header)
+    here = np.zeros(n)
+    after = np.zeros(n)
+    for row in rows:
+        compiled = [parse_tolerance(cell.strip()) if cell.strip() else None for cell in row]
+        for j, column in enumerate(header):
+            here[j] += compiled[j] is not None and unit_mismatch(column, compiled[j])
+            after[j] += compiled[j + 1] is not None and unit_mismatch(column, compiled[j + 1])
+    # cost[p] = mismatches of header[:p] over row[:p] plus header[p:] over row[p + 1:].
+    cost = np.concatenate([[0], np.cumsum(here)]) + np.concatenate([np.cumsum(after[::-1])[::-1], [0]])
+    return int(n - np.argmin(cost[::-1]))
+
+
+class ValveSpec:
+    """One row of the valve spec table. Column names are stripped of the
+    stray whitespace the spreadsheet export leaves on them, and every spec
+    cell is compiled to a Tolerance when the row is loaded."""
+
+    __slots__ = ("part_number", "part_name", "fields", "tolerances")
+
+    def __init__(self, fields: Dict[str, Any]):
+        self.fields = fields
+        self.part_number = normalize_part_number(fields.get(PART_NUMBER_COLUMN))
+        self.part_name = fields.get(PART_NAME_COLUMN)
+        self.tolerances: Dict[str, Tolerance] = compile_tolerances(fields)
+
+    def get(self, column: str, default=None) -> Any:
+        value = self.fields.get(column)
+        return default if value is None else value
+
+    def tolerance(self, column: str) -> Optional[Tolerance]:
+        return self.tolerances.get(column)
+
+    def limits(self, columns: Iterable[str]):
+        """(nominal, lower, upper) arrays for the given columns."""
+        return limits(self.tolerances, columns)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.fields)
+
+
+class ValveCatalog:
+    """The valve spec table, loaded once and shared by the insert path, the
+    specs API and the measurement code.
+
+    Rows come from the Valve_Details table, or from Valve_Details.csv when
+    the database is unavailable (VALVE_SPEC_SOURCE=auto) or when configured
+    to use the CSV only. The table is reloaded after ttl seconds, or as soon
+    as the CSV changes on disk, on a background thread while the current
+    rows stay in use; a failed reload keeps the previous rows.
+    """
+
+    def __init__(self, source: str = VALVE_SPEC_SOURCE, csv_path: str = VALVE_CSV_PATH,
+                 ttl: float = VALVE_CATALOG_TTL):
+        self.source = source
+        self.csv_path = csv_path
+        self.ttl = ttl
+        self._specs: Dict[str, ValveSpec] = {}
+        self._lock = threading.Lock()
+        self._loaded_at: Optional[float] = None
+        self._csv_mtime: Optional[float] = None
+        self._rows: List[Dict[str, Any]] = []
+        self.loaded_from: Optional[str] = None
+        self.digest: Optional[str] = None
+        self.version = 0
+
+    def _csv_stamp(self) -> Optional[float]:
+        try:
+            return os.stat(self.csv_path).st_mtime
+        except OSError:
+            return None
+
+    def _read_db(self) -> Optional[List[Dict[str, Any]]]:
+        from database_manager import db_manager
+
+        return db_manager.fetch_valve_details()
+
+    def _read_csv(self) -> Optional[List[Dict[str, Any]]]:
+        if not os.path.exists(self.csv_path):
+            logger.error(f"Valve spec CSV not found: {self.csv_path}")
+            return None
+        with open(self.csv_path, newline="", encoding="utf-8", errors="replace") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return []
+            rows = list(reader)
+        header = [c.strip() for c in header]
+        shifted = [row for row in rows if len(row) == len(header) + 1]
+        if shifted:
+            position = extra_cell_position(header, shifted)
+            logger.warning(f"{len(shifted)} valve spec rows have a cell with no header at column "
+                           f"{position + 1} (between {header[position - 1]!r} and {header[position]!r}); "
+                           f"it is dropped and the cells after it are moved back under their headers")
+            rows = [row[:position] + row[position + 1:] if len(row) == len(header) + 1 else row
+                    for row in rows]
+        return [dict(zip(header, row)) for row in rows]
+
+    def load(self) -> bool:
+        """(Re)load the spec table. Returns False and keeps the current rows
+        if no source could be read."""
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> bool:
+        rows, origin = None, None
+        if self.source in ("auto", "db"):
+            rows, origin = self._read_db(), "db"
+        if rows is None and self.source in ("auto", "csv"):
+            rows, origin = self._read_csv(), "csv"
+        self._loaded_at = time.monotonic()
+        self._csv_mtime = self._csv_stamp()
+        if rows is None:
+            logger.warning("Valve spec table could not be loaded; keeping the previous rows")
+            return False
+        digest = rows_digest(rows)
+        if digest == self.digest:
+            # Same rows: nothing built on the catalog needs to change.
+            self.loaded_from = origin
+            return True
+        self._apply(rows, origin, digest)
+        return True
+
+    def snapshot(self) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """(rows, origin) of the current table, for adopt() in another process."""
+        self.ensure_fresh()
+        return self._rows, self.loaded_from
+
+    def adopt(self, rows: List[Dict[str, Any]], origin: Optional[str]) -> None:
+        """Serve rows read by another process instead of reading the source."""
+        digest = rows_digest(rows)
+        with self._lock:
+            self._loaded_at = time.monotonic()
+            self._csv_mtime = self._csv_stamp()
+            self._apply(rows, origin, digest)
+
+    def _apply(self, rows: List[Dict[str, Any]], origin: Optional[str], digest: str) -> None:
+        specs = {}
+        for row in rows:
+            spec = ValveSpec({str(k).strip(): _clean(v) for k, v in row.items()})
+            if spec.part_number:
+                specs[spec.part_number] = spec
+        self._specs = specs
+        self._rows = rows
+        self.digest = digest
+        self.loaded_from = origin
+        self.version += 1
+        logger.info(f"Loaded {len(specs)} valve specs from {origin}")
+        unparsed = self.parse_report()
+        if unparsed:
+            logger.warning(f"{len(unparsed)} valve spec cells could not be parsed, e.g. "
+                           + ", ".join(f"{p}/{c}={r!r}" for p, c, r in unparsed[:3]))
+        mismatched = self.unit_mismatches()
+        if mismatched:
+            logger.warning(f"{len(mismatched)} valve spec cells have a unit that does not fit their "
+                           f"column; check the spec table for shifted columns")
+        return True
+
+    def _stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        if time.monotonic() - self._loaded_at > self.ttl:
+            return True
+        return self.loaded_from == "csv" and self._csv_stamp() != self._csv_mtime
+
+    def ensure_fresh(self) -> None:
+        if not self._stale():
+            return
+        if self._loaded_at is None:
+            # Nothing to serve yet, so every caller waits for the first load.
+            with self._lock:
+                if self._loaded_at is None:
+                    self._load()
+            return
+        # Later reloads run in the background, since a database that is down
+        # can hold one for the whole connection timeout; callers keep the
+        # current rows until it finishes.
+        if self._lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh, name="valve-catalog-refresh", daemon=True).start()
+
+    def _refresh(self) -> None:
+        """Reload with the lock ensure_fresh took on this thread's behalf."""
+        try:
+            if self._stale():
+                self._load()
+        except Exception as e:
+            logger.error(f"Valve spec reload failed: {e}")
+        finally:
+            self._lock.release()
+
+    def spec(self, part_number) -> Optional[ValveSpec]:
+        self.ensure_fresh()
+        return self._specs.get(normalize_part_number(part_number))
+
+    def has_part(self, part_number) -> bool:
+        return self.spec(part_number) is not None
+
+    def part_name(self, part_number) -> Optional[str]:
+        spec = self.spec(part_number)
+        return spec.part_name if spec is not None else None
+
+    def part_names(self, part_numbers: Iterable[Any]) -> Dict[str, Optional[str]]:
+        self.ensure_fresh()
+        specs = self._specs
+        out = {}
+        for part_number in part_numbers:
+            key = normalize_part_number(part_number)
+            spec = specs.get(key)
+            out[key] = spec.part_name if spec is not None else None
+        return out
+
+    def part_numbers(self) -> List[str]:
+        self.ensure_fresh()
+        return sorted(self._specs)
+
+    def parse_report(self) -> List[Tuple[str, str, str]]:
+        """(part number, column, raw value) of every cell the tolerance compiler rejected."""
+        return [
+            (part_number, column, tolerance.raw)
+            for part_number, spec in sorted(self._specs.items())
+            for column, tolerance in spec.tolerances.items()
+            if not tolerance.parsed
+        ]
+
+    def unit_mismatches(self) -> List[Tuple[str, str, str]]:
+        """(part number, column, raw value) of cells whose unit contradicts the column name."""
+        return [
+            (part_number, column, tolerance.raw)
+            for part_number, spec in sorted(self._specs.items())
+            for column, tolerance in spec.tolerances.items()
+            if unit_mismatch(column, tolerance)
+        ]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "parts": len(self._specs),
+            "version": self.version,
+            "loaded_from": self.loaded_from,
+            "age_s": None if self._loaded_at is None else round(time.monotonic() - self._loaded_at, 1),
+            "ttl_s": self.ttl,
+        }
+
+
+valve_catalog = ValveCatalog()
@@ -0,0 +1,187 @@
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import REGION_MARGIN_PX, REGION_SENSITIVITY
+from master_templates import MasterTemplate, master_templates, sanitize_part_number
+from measurement_engine import PROFILE_BANDS
+from valve_catalog import valve_catalog
+
+logger = logging.getLogger("valve_regions")
+
+# Label i + 1 of a region map is REGION_NAMES[i]; 0 is outside the part.
+REGION_NAMES = ("head", "seat", "neck", "stem", "groove", "tip")
+
+# Where each region ends, as a fraction of the length from the head face,
+# when the spec does not say. Each region starts where the previous one ends.
+REGION_ENDS = {"head": 0.04, "seat": 0.15, "neck": 0.35, "stem": 0.88, "groove": 0.95, "tip": 1.0}
+GROOVE_HALF_WIDTH = 0.035
+
+
+def parse_sensitivity(text: str) -> Dict[str, float]:
+    """'groove=1.5,seat=1.5' -> {'groove': 1.5, 'seat': 1.5}."""
+    sensitivity = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            sensitivity[name.strip()] = float(value)
+    return sensitivity
+
+
+region_sensitivity = parse_sensitivity(REGION_SENSITIVITY)
+
+
+def _nominal(spec, column: str) -> Optional[float]:
+    tolerance = spec.tolerance(column)
+    return tolerance.nominal if tolerance is not None else None
+
+
+def region_ends(spec=None) -> Dict[str, float]:
+    """REGION_ENDS, with the head and groove placed from the spec's
+    dimensions where it gives them.
+
+    The head ends at its thickness and the groove is centred where
+    Datam to Groove puts it along Datam to End. Values that would put a
+    region outside its neighbours (as the shifted cells of some rows do)
+    are ignored.
+    """
+    ends = dict(REGION_ENDS)
+    if spec is None:
+        return ends
+    length = _nominal(spec, "Datam to End") or _nominal(spec, "Overall Length")
+    if not length:
+        return ends
+    thickness = _nominal(spec, "Head Tickness 1") or _nominal(spec, "Head Tickness 2")
+    if thickness and 0 < thickness / length < ends["seat"]:
+        ends["head"] = thickness / length
+    groove = _nominal(spec, "Datam to Groove")
+    if groove:
+        centre = groove / length
+        if ends["neck"] + GROOVE_HALF_WIDTH < centre < 1.0 - GROOVE_HALF_WIDTH:
+            ends["stem"] = centre - GROOVE_HALF_WIDTH
+            ends["groove"] = centre + GROOVE_HALF_WIDTH
+    return ends
+
+
+class RegionTemplate:
+    """A part's region masks, in the coordinates of its master template.
+
+    labels holds the region of every pixel of the master silhouette,
+    widened by margin template pixels so that damage to the outline still
+    falls inside it. The silhouette is cut across its head-to-tip axis at
+    the fractions of ends.
+    """
+
+    def __init__(self, template: MasterTemplate, ends: Dict[str, float],
+                 margin: float = REGION_MARGIN_PX, catalog_version: int = 0):
+        self.part_number = template.part_number
+        self.mtime = template.mtime
+        self.catalog_version = catalog_version
+        self.ends = ends
+        self.labels = np.zeros(template.edges.shape, np.uint8)
+
+        contours, _ = cv2.findContours(template.edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if not contours or template.pose is None:
+            return
+        contour = max(contours, key=cv2.contourArea)
+        silhouette = np.zeros_like(self.labels)
+        cv2.drawContours(silhouette, [contour], -1, 255, -1)
+        if margin > 0:
+            size = 2 * int(round(margin)) + 1
+            silhouette = cv2.dilate(silhouette, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+
+        (cx, cy), axis = template.pose
+        t = (contour.reshape(-1, 2) - (cx, cy)) @ axis
+        head, tip = t.min(), t.max()
+        ys, xs = np.nonzero(silhouette)
+        fraction = (((xs - cx) * axis[0] + (ys - cy) * axis[1]) - head) / (tip - head)
+        bounds = np.array([ends[name] for name in REGION_NAMES[:-1]])
+        self.labels[ys, xs] = np.searchsorted(bounds, fraction, side="right") + 1
+
+    def locate(self, matrix: np.ndarray, shape) -> "RegionMap":
+        """The regions of a frame of the given shape whose pose (frame to
+        template) is matrix."""
+        return RegionMap(self, np.asarray(matrix, np.float64), shape[:2])
+
+    def profile_bands(self) -> Dict[str, tuple]:
+        """PROFILE_BANDS with the groove band cut down to the part's groove
+        region and the head band to its head and seat, so the measurement
+        reads only the stations that hold those features."""
+        bands = dict(PROFILE_BANDS)
+        bands["head"] = (0.0, self.ends["seat"]) + tuple(PROFILE_BANDS["head"][2:])
+        bands["groove"] = (self.ends["stem"], self.ends["groove"]) + tuple(PROFILE_BANDS["groove"][2:])
+        return bands
+
+
+class RegionMap:
+    """A part's regions placed on one frame by the frame's pose."""
+
+    def __init__(self, template: RegionTemplate, matrix: np.ndarray, shape: Tuple[int, int]):
+        self.template = template
+        self.matrix = matrix
+        self.shape = shape
+        self._grids: Dict[Tuple[int, int], np.ndarray] = {}
+
+    def grid(self, width: int, height: int) -> np.ndarray:
+        """Region labels of the frame resampled to width x height, the way
+        cv2.resize stretches the frame onto that grid."""
+        key = (width, height)
+        labels = self._grids.get(key)
+        if labels is None:
+            sx, sy = self.shape[1] / width, self.shape[0] / height
+            # Grid pixel centres land at (i + 0.5) * scale - 0.5 in the frame.
+            to_frame = np.array([[sx, 0.0, 0.5 * sx - 0.5], [0.0, sy, 0.5 * sy - 0.5], [0.0, 0.0, 1.0]])
+            matrix = self.matrix @ to_frame
+            labels = cv2.warpAffine(self.template.labels, matrix, (width, height),
+                                    flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            self._grids[key] = labels
+        return labels
+
+
+class RegionStore:
+    """Region templates per part, built from the part's master and spec the
+    first time the part is inspected and rebuilt only when either changes."""
+
+    def __init__(self, margin: float = REGION_MARGIN_PX):
+        self.margin = margin
+        self._regions: Dict[str, RegionTemplate] = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def get(self, part_number) -> Optional[RegionTemplate]:
+        template = master_templates.get(part_number)
+        if template is None:
+            return None
+        key = sanitize_part_number(part_number)
+        version = valve_catalog.version
+        regions = self._regions.get(key)
+        if regions is not None and regions.mtime == template.mtime and regions.catalog_version == version:
+            return regions
+        with self._lock:
+            regions = self._regions.get(key)
+            if regions is None or regions.mtime != template.mtime or regions.catalog_version != version:
+                regions = RegionTemplate(template, region_ends(valve_catalog.spec(part_number)),
+                                         self.margin, version)
+                self._regions[key] = regions
+                self.builds += 1
+                logger.info(f"Built region masks for {key}: {regions.ends}")
+            return regions
+
+    def locate(self, part_number, pose: Optional[Dict[str, Any]], shape) -> Optional[RegionMap]:
+        """The part's regions on a frame, from match_frame's score["pose"];
+        None without a master or a pose."""
+        if not pose:
+            return None
+        regions = self.get(part_number)
+        return regions.locate(pose["matrix"], shape) if regions is not None else None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"parts": len(self._regions), "builds": self.builds, "margin_px": self.margin,
+                "sensitivity": region_sensitivity}
+
+
+valve_regions = RegionStore()